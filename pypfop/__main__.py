@@ -0,0 +1,6 @@
+import sys
+
+from pypfop.cli import main
+
+
+sys.exit(main())
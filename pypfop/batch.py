@@ -0,0 +1,155 @@
+import os
+import time
+import itertools
+import collections
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+)
+
+from pypfop.conversion import xml_to_fo_with_style
+
+
+BatchResult = collections.namedtuple(
+    'BatchResult', ('index', 'params', 'document', 'error', 'timings'),
+    defaults=(None, )
+)
+BatchResult.__doc__ = """Outcome of one of the documents of a batch.
+
+`document` is the value returned by the builder (the path of the
+generated document) or None if the generation failed, in which case
+`error` is the raised exception. `timings` has the seconds spent on
+the ``render`` (with the XSL-FO translation) and ``build`` stages that
+were completed.
+"""
+
+
+class _Renderer:
+    """Picklable version of the render and XSL-FO stages of
+    `DocumentGenerator._generate_xslfo`, to run them on another process.
+    """
+
+    def __init__(self, template, ssheets, defparams, fragment_cache=None,
+                 fo_schema=None, resource_cache=None):
+        self.template = template
+        self.ssheets = ssheets
+        self.defparams = defparams
+        self.fragment_cache = fragment_cache
+        self.fo_schema = fo_schema
+        self.resource_cache = resource_cache
+
+    def __call__(self, params):
+        """Return the XSL-FO of `params` and the seconds it took."""
+        start = time.perf_counter()
+        params = dict(params)
+        params.update(self.defparams)
+        if self.fragment_cache is None:
+            xslfo = xml_to_fo_with_style(
+                self.template.render(params), self.ssheets,
+                resources=self.resource_cache
+            )
+        else:
+            fragments = self.fragment_cache.scope(
+                self.template, self.ssheets
+            )
+            with fragments:
+                xml = self.template.render(params)
+            xslfo = xml_to_fo_with_style(
+                xml, self.ssheets, fragments=fragments,
+                resources=self.resource_cache
+            )
+        if self.fo_schema is not None:
+            self.fo_schema.validate(xslfo)
+        return xslfo, time.perf_counter() - start
+
+
+def _timed_build(builder, xslfo, out_format, log):
+    start = time.perf_counter()
+    document = builder(xslfo, out_format, log)
+    return document, time.perf_counter() - start
+
+
+def generate_many(generator, iterable_of_params, workers=None,
+                  executor=None, build_workers=None, out_format=None,
+                  ordered=True, max_pending=None):
+    """Generate a document for each of the params of `iterable_of_params`
+    yielding a `BatchResult` for each one of them.
+
+    The template rendering and the XSL-FO translation run on `executor`
+    (by default a process pool of `workers` processes) and the documents
+    are built with `generator.builder` on a pool of `build_workers`
+    threads. The results are yielded in the same order of the params or,
+    with `ordered=False`, as soon as they are completed.
+
+    No more than `max_pending` documents (by default twice the number of
+    workers) are in flight or waiting to be yielded at any given time,
+    the params are consumed only as fast as the results are.
+    """
+    if out_format is None:
+        out_format = generator.out_format
+    else:
+        out_format = generator._check_out_format(out_format)
+    workers = workers or os.cpu_count() or 1
+    build_workers = build_workers or workers
+    max_pending = max_pending or 2 * max(workers, build_workers)
+    renderer = _Renderer(
+        generator.template, generator.ssheets, generator.defparams,
+        generator.fragment_cache, generator.fo_schema,
+        generator.resource_cache
+    )
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(workers)
+    build_executor = ThreadPoolExecutor(build_workers)
+    params_iter = enumerate(iterable_of_params)
+    running = {}  # future -> (stage, index, params, timings)
+    completed = {}  # index -> BatchResult, only used when ordered.
+    next_index = 0
+
+    def submit_render():
+        for index, params in itertools.islice(params_iter, 1):
+            future = executor.submit(renderer, params)
+            running[future] = ('render', index, params, {})
+            return True
+        return False
+
+    try:
+        exhausted = False
+        while True:
+            while not exhausted and \
+              len(running) + len(completed) < max_pending:
+                exhausted = not submit_render()
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, index, params, timings = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    value, timings[stage] = future.result()
+                if error is None and stage == 'render':
+                    build_future = build_executor.submit(
+                        _timed_build, generator.builder, value,
+                        out_format, generator.log
+                    )
+                    running[build_future] = ('build', index, params, timings)
+                    continue
+                if error is None:
+                    result = BatchResult(index, params, value, None, timings)
+                else:
+                    generator.log.debug(
+                        'Unable to generate the document %s: %r', index, error
+                    )
+                    result = BatchResult(index, params, None, error, timings)
+                if ordered:
+                    completed[index] = result
+                else:
+                    yield result
+            while next_index in completed:
+                yield completed.pop(next_index)
+                next_index += 1
+    finally:
+        for future in running:
+            future.cancel()
+        build_executor.shutdown(wait=True)
+        if own_executor:
+            executor.shutdown(wait=True)
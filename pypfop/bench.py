@@ -0,0 +1,328 @@
+"""Benchmarks of the stages of the generation of a document.
+
+The documents are built from the ``examples/simple_table`` template and
+style sheets, scaled to any number of rows, columns and extra css rules.
+Each stage is timed separately: the rendering of the template, the
+application of the style sheets, the translation to XSL-FO and each one
+of the builders, which run against stand-ins of the fop command, the
+FOP worker and the fops server (unless `--fop-cmd` is given), so no
+Java is required. Run it from a checkout of pypfop (or give the
+`--example-dir` of one) with::
+
+    python -m pypfop.bench --rows 5000 > results.json
+
+The results are printed as JSON, to compare them across commits.
+"""
+import os
+import sys
+import json
+import shlex
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+
+import lxml.etree
+
+import pypfop
+import pypfop.templates.mako
+from pypfop import builder, conversion
+from pypfop.testing import FakeFopsHandler, start_server
+
+
+# The examples are not installed, only a checkout of pypfop has them,
+# otherwise the --example-dir is required.
+EXAMPLE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'examples', 'simple_table'
+)
+EXAMPLE_TEMPLATE = 'simple-table.fo.mako'
+EXAMPLE_SHEET = os.path.join('css', 'simple_table.css')
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur')
+
+# Stand-in of the fop command line: ``-q -fo - -<format> <output>``.
+FAKE_FOP = '''\
+import sys
+document = sys.stdin.buffer.read()
+output = sys.argv[-1]
+if output == '-':
+    sys.stdout.buffer.write(document)
+else:
+    with open(output, 'wb') as outfile:
+        outfile.write(document)
+'''
+# Stand-in of pypfop/workers/FopWorker.java.
+FAKE_FOP_WORKER = '''\
+import sys
+stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+for header in iter(stdin.readline, b''):
+    out_format, length = header.split()
+    document = stdin.read(int(length))
+    stdout.write(b'OK %d\\n' % len(document))
+    stdout.write(document)
+    stdout.flush()
+'''
+
+
+def example_params(rows, cols=4):
+    """Return the params of the simple table with `rows` and `cols`."""
+    return {
+        'header': ['Column {}'.format(col) for col in range(cols)],
+        'rows': [[' '.join(WORDS[(row + col) % len(WORDS):])
+                  for col in range(cols)]
+                 for row in range(rows)]
+    }
+
+
+def example_template(example_dir=EXAMPLE_DIR):
+    factory = pypfop.templates.mako.Factory(example_dir)
+    return factory(EXAMPLE_TEMPLATE)
+
+
+def render_example(rows, cols=4, example_dir=EXAMPLE_DIR):
+    """Return the xml of the example table with `rows` and `cols`."""
+    return example_template(example_dir).render(example_params(rows, cols))
+
+
+def write_extra_rules(directory, count):
+    """Write a style sheet with `count` rules, like the ones of a big
+    corporate style sheet that barely match the table, return its path.
+    """
+    path = os.path.join(directory, 'extra-{}.css'.format(count))
+    with open(path, 'w') as sheet:
+        for num in range(count):
+            sheet.write([
+                '.style-{0} table-cell {{ color: #{0:06x}; }}\n',
+                'table-cell.kind-{0} > block {{ font-size: {0}pt; }}\n',
+                '#block-{0} {{ padding: {0}mm; }}\n',
+                'table-row[title="{0}"] block {{ margin: {0}mm; }}\n',
+            ][num % 4].format(num))
+    return path
+
+
+def timeit(func, repeat):
+    """Return the best time, in seconds, of `repeat` calls to `func`."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_css(xml, sheets, repeat):
+    """Time the single pass `RuleIndex` engine against the former
+    application of the XPath query of each rule on the whole tree.
+    """
+    results = {}
+    for name, inline_css in (('by_rule', conversion._inline_css_by_rule),
+                             ('indexed', conversion._inline_css_indexed)):
+        # the trees are parsed out of the timing.
+        trees = [lxml.etree.fromstring(xml) for _ in range(repeat)]
+        results[name] = timeit(lambda: inline_css(trees.pop(), sheets),
+                               repeat)
+    results['speedup'] = results['by_rule'] / results['indexed']
+    return results
+
+
+def bench_stages(template, params, sheets, repeat):
+    """Time each stage of `DocumentGenerator.generate` up to the XSL-FO,
+    return the timings, the sizes of the documents and the XSL-FO.
+    """
+    xml = template.render(params)
+    styled = conversion._apply_css_sheets(xml, *sheets)
+    xslfo = conversion.xml_to_fo_with_style(xml, sheets)
+    timings = {
+        'render': timeit(lambda: template.render(params), repeat),
+        'apply_css_sheets': timeit(
+            lambda: conversion._apply_css_sheets(xml, *sheets), repeat
+        ),
+        'translate_to_fo': timeit(
+            lambda: conversion.translate_to_fo(styled, None), repeat
+        ),
+        'xml_to_fo_with_style': timeit(
+            lambda: conversion.xml_to_fo_with_style(xml, sheets), repeat
+        ),
+    }
+    sizes = {'xml': len(xml), 'xslfo': len(xslfo),
+             'rules': len(conversion.compile_css_sheets(*sheets))}
+    return timings, sizes, xslfo
+
+
+class FakeServices:
+    """The fake fop command, FOP worker and fops server of the builders,
+    use it as a context manager to clean them up.
+    """
+
+    def __init__(self, fop_cmd=None, worker_cmd=None):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.fop_cmd = fop_cmd or self._script('fop.py', FAKE_FOP)
+        self.worker_cmd = worker_cmd or \
+            self._script('fop_worker.py', FAKE_FOP_WORKER)
+        self.server = start_server(FakeFopsHandler)
+        self.host, self.port = self.server.server_address
+
+    def _script(self, name, source):
+        path = os.path.join(self._tempdir.name, name)
+        with open(path, 'w') as script:
+            script.write(source)
+        return ' '.join(shlex.quote(arg) for arg in (sys.executable, path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        self._tempdir.cleanup()
+
+
+def _subprocess_builder(services):
+    fop_cmd, *args = shlex.split(services.fop_cmd)
+    return builder.SubprocessBuilder(fop_cmd, args)
+
+
+def _async_subprocess_builder(services):
+    fop_cmd, *args = shlex.split(services.fop_cmd)
+    return builder.AsyncSubprocessBuilder(fop_cmd, args)
+
+
+BUILDERS = {
+    'subprocess': _subprocess_builder,
+    'worker_pool': lambda services: builder.WorkerPoolBuilder(
+        services.worker_cmd, workers=1, prestart=True
+    ),
+    'fops': lambda services: builder.FopsBuilder(
+        services.host, services.port
+    ),
+    'pooled_fops': lambda services: builder.PooledFopsBuilder(
+        [(services.host, services.port)], raw_body=True
+    ),
+    'async_subprocess': _async_subprocess_builder,
+    'async_fops': lambda services: builder.AsyncFopsBuilder(
+        services.host, services.port, raw_body=True
+    ),
+}
+
+
+def _close(doc_builder):
+    close = getattr(doc_builder, 'close', None)
+    if close is not None:
+        close()
+
+
+def bench_builder(doc_builder, xslfo, repeat, out_format='pdf'):
+    """Return the best time to build `xslfo` with `doc_builder`, which
+    is closed afterwards.
+    """
+    log = logging.getLogger('pypfop.bench')
+    if not isinstance(doc_builder, builder.AsyncBuilder):
+        try:
+            return timeit(
+                lambda: doc_builder(xslfo, out_format, log,
+                                    output=builder.OUTPUT_BYTES),
+                repeat
+            )
+        finally:
+            _close(doc_builder)
+
+    async def run():
+        # all the builds share a loop, to reuse the connections.
+        best = None
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                await doc_builder(xslfo, out_format, log,
+                                  output=builder.OUTPUT_BYTES)
+                elapsed = time.perf_counter() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+        finally:
+            _close(doc_builder)
+        return best
+    return asyncio.run(run())
+
+
+def bench_builders(names, services, xslfo, repeat):
+    return {name: bench_builder(BUILDERS[name](services), xslfo, repeat)
+            for name in names}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m pypfop.bench',
+        description='Benchmark the stages of the document generation.'
+    )
+    parser.add_argument('--rows', type=int, action='append',
+                        help='rows of the table, can be used multiple '
+                             'times (default: 1000 and 5000)')
+    parser.add_argument('--cols', type=int, action='append',
+                        help='columns of the table, can be used multiple '
+                             'times (default: 4)')
+    parser.add_argument('--rules', type=int, action='append',
+                        help='number of extra css rules, can be used '
+                             'multiple times (default: 0 and 300)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='take the best time out of REPEAT runs')
+    parser.add_argument('--builder', action='append', choices=BUILDERS,
+                        help='builder to time, can be used multiple '
+                             'times (default: all of them)')
+    parser.add_argument('--no-builders', action='store_true',
+                        help="don't time the builders")
+    parser.add_argument('--fop-cmd',
+                        help='fop command of the subprocess builders '
+                             '(default: a fake fop)')
+    parser.add_argument('--worker-cmd',
+                        help='FOP worker command of the worker pool '
+                             '(default: a fake worker)')
+    has_example = os.path.isdir(EXAMPLE_DIR)
+    parser.add_argument('--example-dir',
+                        default=EXAMPLE_DIR if has_example else None,
+                        required=not has_example,
+                        help='directory of the simple_table example of '
+                             'pypfop (default: the one of the checkout)')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    example_sheet = os.path.join(args.example_dir, EXAMPLE_SHEET)
+    template = example_template(args.example_dir)
+    builders = [] if args.no_builders else (args.builder or list(BUILDERS))
+    results = []
+    with tempfile.TemporaryDirectory() as tempdir, \
+            FakeServices(args.fop_cmd, args.worker_cmd) as services:
+        for rows in args.rows or [1000, 5000]:
+            for cols in args.cols or [4]:
+                params = example_params(rows, cols)
+                xml = template.render(params)
+                for rules in args.rules or [0, 300]:
+                    sheets = [example_sheet]
+                    if rules:
+                        sheets.append(write_extra_rules(tempdir, rules))
+                    stages, sizes, xslfo = bench_stages(
+                        template, params, sheets, args.repeat
+                    )
+                    results.append({
+                        'rows': rows, 'cols': cols, 'extra_rules': rules,
+                        'sizes': sizes, 'stages': stages,
+                        'css': bench_css(xml, sheets, args.repeat),
+                        'builders': bench_builders(
+                            builders, services, xslfo, args.repeat
+                        ),
+                    })
+    json.dump({'version': pypfop.__version__,
+               'python': platform.python_version(),
+               'repeat': args.repeat,
+               'results': results},
+              sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,17 @@
 import os
+import queue
+import shlex
+import gzip
+import zlib
+import time
+import base64
+import asyncio
+import functools
+import http.client
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 import tempfile
+import threading
 import shutil
 from http import HTTPStatus
 from urllib import request
@@ -9,24 +20,182 @@ from urllib.parse import urlencode, urljoin
 
 
 from pypfop.exceptions import BuilderError
+from pypfop.instrumentation import instrumentation
 
 
 FOP_ENV_VAR = 'FOP_CMD'
+OUTPUT_PATH = 'path'
+OUTPUT_BYTES = 'bytes'
+OUTPUT_CHUNKS = 'chunks'
+CHUNK_SIZE = 64 * 1024
+FOP_WORKER_ENV_VAR = 'FOP_WORKER_CMD'
+FOP_WORKER_SOURCE = os.path.join(
+    os.path.dirname(__file__), 'workers', 'FopWorker.java'
+)
+
+
+def check_output(output):
+    """Verify that `output` is a supported output target of the builders:
+
+    - ``None`` or ``OUTPUT_PATH``: the document is written to a temporary
+      file and its path is returned (the default).
+    - ``OUTPUT_BYTES``: the content of the document is returned.
+    - ``OUTPUT_CHUNKS``: an iterator of the chunks of the document is
+      returned.
+    - A file object (or a socket) on which the document gets written,
+      the same object is returned.
+    """
+    if output in (None, OUTPUT_PATH, OUTPUT_BYTES, OUTPUT_CHUNKS):
+        return output
+    if isinstance(output, str) or \
+       not (hasattr(output, 'write') or hasattr(output, 'sendall')):
+        raise BuilderError('Unsupported output target {!r}'.format(output))
+    return output
+
+
+def _is_path_output(output):
+    return output is None or output == OUTPUT_PATH
+
+
+def is_xslfo_stream(xslfo):
+    """Return True if `xslfo` is an iterable of chunks of XSL-FO instead
+    of the whole document (check `DocumentGenerator.generate`).
+    """
+    return not isinstance(xslfo, (bytes, str))
+
+
+def join_xslfo(xslfo):
+    """Return the whole document of `xslfo`, consuming its chunks
+    if it is a stream.
+    """
+    if is_xslfo_stream(xslfo):
+        return b''.join(xslfo)
+    return xslfo
+
+
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _build_span(builder, xslfo, out_format):
+    span = instrumentation.span(
+        'build', builder=type(builder).__name__, format=out_format
+    )
+    if isinstance(xslfo, (bytes, str)):
+        span.set(bytes_in=len(xslfo))
+    return span
+
+
+def instrumented(call):
+    """Decorator of the `__call__` of the builders, to build each
+    document inside a ``build`` span of the `instrumentation`.
+    """
+    if asyncio.iscoroutinefunction(call):
+        @functools.wraps(call)
+        async def async_wrapper(self, xslfo, out_format, log, output=None):
+            with _build_span(self, xslfo, out_format) as span:
+                document = await call(self, xslfo, out_format, log, output)
+                if isinstance(document, bytes):
+                    span.set(bytes_out=len(document))
+                return document
+        return async_wrapper
+
+    @functools.wraps(call)
+    def wrapper(self, xslfo, out_format, log, output=None):
+        with _build_span(self, xslfo, out_format) as span:
+            document = call(self, xslfo, out_format, log, output)
+            if isinstance(document, bytes):
+                span.set(bytes_out=len(document))
+            return document
+    return wrapper
+
+
+def _get_tempfile(oformat, tempdir=None):
+    fdesc, ofilepath = tempfile.mkstemp('.{}'.format(oformat), dir=tempdir)
+    os.close(fdesc)
+    return ofilepath
+
+
+def deliver(chunks, out_format, output, tempdir=None):
+    """Send the iterable of `chunks` of a document (built or cached) to
+    `output`, check `check_output` for the supported targets. The
+    documents of the path output are written on `tempdir`.
+    """
+    if _is_path_output(output):
+        ofilepath = _get_tempfile(out_format, tempdir)
+        with open(ofilepath, 'wb') as outfile:
+            for chunk in chunks:
+                outfile.write(chunk)
+        return ofilepath
+    if output == OUTPUT_BYTES:
+        return b''.join(chunks)
+    if output == OUTPUT_CHUNKS:
+        return iter(chunks)
+    write = getattr(output, 'write', None) or output.sendall
+    for chunk in chunks:
+        write(chunk)
+    return output
+
+
+class _StreamBody:
+    """Iterable body of a request that can be sent only once."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.started = False
+
+    def __iter__(self):
+        self.started = True
+        return iter(self.chunks)
 
 
 class Builder:
     tempdir = tempfile.gettempdir()
+    # The builders that can be called from several threads at the same
+    # time build the documents of `build_many` concurrently.
+    concurrent_formats = False
+    # The builders that consume the XSL-FO as it is generated, the
+    # rest get the whole document (check `is_xslfo_stream`).
+    streaming_input = False
 
     def _get_tempfile(self, oformat):
-        fdesc, ofilepath = tempfile.mkstemp(
-            '.{}'.format(oformat), dir=self.tempdir
-        )
-        os.close(fdesc)
-        return ofilepath
+        return _get_tempfile(oformat, self.tempdir)
+
+    def _deliver(self, chunks, out_format, output):
+        """Send the iterable of `chunks` of the document to `output`,
+        check `deliver`.
+        """
+        return deliver(chunks, out_format, output, self.tempdir)
 
-    def __call__(self, xslfo, out_format, log):
+    def __call__(self, xslfo, out_format, log, output=None):
         raise NotImplementedError()
 
+    def build_many(self, xslfo, out_formats, log, output=None):
+        """Build a document for each one of the `out_formats` from the
+        same `xslfo`, return a dictionary with the document by format.
+        """
+        # keep the support of the builders without outputs.
+        args = (log, ) if output is None else (log, output)
+        if len(out_formats) > 1:
+            # a stream can be read only once.
+            xslfo = join_xslfo(xslfo)
+        if self.concurrent_formats and len(out_formats) > 1:
+            with ThreadPoolExecutor(len(out_formats)) as executor:
+                futures = [
+                    (out_format,
+                     executor.submit(self, xslfo, out_format, *args))
+                    for out_format in out_formats
+                ]
+            return {out_format: future.result()
+                    for (out_format, future) in futures}
+        return {out_format: self(xslfo, out_format, *args)
+                for out_format in out_formats}
+
 
 class SubprocessBuilder(Builder):
     """Subprocess based document builder.
@@ -36,7 +205,15 @@ class SubprocessBuilder(Builder):
     This is the easiest way to locally generate a document,
     with the side-effect of having the jvm up-and-down each time
     a document gets generated.
+
+    The fop command line only supports one output per execution,
+    `build_many` runs one fop process per format at the same time.
+
+    A stream of XSL-FO is written to the standard input of fop as it
+    is generated.
     """
+    concurrent_formats = True
+    streaming_input = True
 
     def __init__(self, fop_cmd=None, fop_cmd_extra_args=None):
         self.fop_cmd = self._find_fop_cmd(fop_cmd)
@@ -60,29 +237,333 @@ class SubprocessBuilder(Builder):
             )
         return cmd
 
-    def __call__(self, xslfo, out_format, log):
+    def _cmdargs(self, out_format, ofilepath):
+        cmdargs = [self.fop_cmd, ] + self.fop_cmd_extra_args
+        cmdargs += ['-q', '-fo', '-', '-{}'.format(out_format), ofilepath]
+        return cmdargs
+
+    def _ofilepath(self, out_format, output):
+        # Any output other than a file is read from the stdout of fop.
+        if _is_path_output(output):
+            return self._get_tempfile(out_format)
+        return '-'
+
+    def _check_result(self, returncode, stdout, stderr, ofilepath,
+                      out_format, output, log):
+        stderr = stderr.decode()
+        log.debug('STDERR of fop command: %s', stderr)
+        instrumentation.annotate(exit_status=returncode)
+        if returncode:  # != 0
+            raise BuilderError(stderr)
+        elif _is_path_output(output):
+            return ofilepath
+        else:
+            return self._deliver([stdout], out_format, output)
+
+    @instrumented
+    def __call__(self, xslfo, out_format, log, output=None):
         """
         Execute the subprocess of the fop command,
-        it returns the filepath of the generated document.
+        it returns the filepath of the generated document
+        or the document on the requested `output`.
 
         In case of an error, it will raise an Exception on which
         the body will be the standard error of the fop command.
         """
-        ofilepath = self._get_tempfile(out_format)
-        cmdargs = [self.fop_cmd, ] + self.fop_cmd_extra_args
-        cmdargs += ['-q', '-fo', '-', '-{}'.format(out_format), ofilepath]
-        log.debug('cmdline {}'.format(cmdargs))
+        ofilepath = self._ofilepath(out_format, output)
+        cmdargs = self._cmdargs(out_format, ofilepath)
+        log.debug('cmdline %s', cmdargs)
         proc = subprocess.Popen(cmdargs,
                                 stdin=subprocess.PIPE,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
-        _, stderr = proc.communicate(xslfo)
-        stderr = stderr.decode()
-        log.debug('STDERR of fop command: {}'.format(stderr))
-        if proc.returncode:  # != 0
-            raise BuilderError(stderr)
+        if is_xslfo_stream(xslfo):
+            stdout, stderr = self._communicate_stream(proc, xslfo)
         else:
-            return ofilepath
+            stdout, stderr = proc.communicate(xslfo)
+        return self._check_result(proc.returncode, stdout, stderr,
+                                  ofilepath, out_format, output, log)
+
+    def _communicate_stream(self, proc, chunks):
+        """Like `proc.communicate` but writing the `chunks` of XSL-FO
+        as they come, fop is killed if the stream fails.
+        """
+        outputs = {}
+
+        def drain(name):
+            outputs[name] = getattr(proc, name).read()
+
+        readers = [threading.Thread(target=drain, args=(name, ))
+                   for name in ('stdout', 'stderr')]
+        for reader in readers:
+            reader.start()
+        try:
+            try:
+                for chunk in chunks:
+                    proc.stdin.write(chunk)
+                proc.stdin.close()
+            except BrokenPipeError:
+                # fop exited before reading the whole document,
+                # the reason is on its stderr.
+                pass
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            getattr(chunks, 'close', lambda: None)()
+            for reader in readers:
+                reader.join()
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            proc.wait()
+        return outputs['stdout'], outputs['stderr']
+
+
+class _FopWorker:
+    """A single long lived worker process.
+
+    The worker reads from its standard input a header line
+    ``<format> <length>\\n`` followed by ``length`` bytes of XSL-FO
+    and answers on its standard output with the header line
+    ``<OK|ERR> <length>\\n`` followed by ``length`` bytes that
+    are either the generated document or the error message.
+
+    The standard error of the worker goes to a temporary file (opened
+    for appending, it is emptied at the start of each document), its
+    last `STDERR_TAIL` bytes are reported with the failures.
+    """
+    STDERR_TAIL = 4096
+
+    def __init__(self, cmdargs):
+        self.jobs = 0
+        self.timed_out = False
+        fd, self.stderr_path = tempfile.mkstemp(
+            prefix='pypfop-worker-', suffix='.log'
+        )
+        os.close(fd)
+        self.stderr = open(self.stderr_path, 'ab+')
+        try:
+            self.proc = subprocess.Popen(cmdargs,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=self.stderr)
+        except OSError:
+            self._remove_stderr()
+            raise
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def errors(self):
+        """Return the end of the standard error of the current document."""
+        try:
+            size = os.fstat(self.stderr.fileno()).st_size
+            self.stderr.seek(max(0, size - self.STDERR_TAIL))
+            return self.stderr.read().decode('utf-8', 'replace').strip()
+        except (OSError, ValueError):
+            return ''
+
+    def _expire(self):
+        self.timed_out = True
+        self.proc.kill()
+
+    def build(self, xslfo, out_format, timeout=None):
+        """Return the status and payload of the worker for `xslfo`, after
+        `timeout` seconds the worker is killed.
+        """
+        self.jobs += 1
+        self.stderr.truncate(0)
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self._expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            header = '{} {}\n'.format(out_format, len(xslfo))
+            self.proc.stdin.write(header.encode('ascii'))
+            self.proc.stdin.write(xslfo)
+            self.proc.stdin.flush()
+            status, length = self.proc.stdout.readline().split()
+            length = int(length)
+            payload = self.proc.stdout.read(length)
+            if len(payload) != length:
+                raise EOFError('Truncated response from the worker')
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return status == b'OK', payload
+
+    def stop(self, timeout):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdout.close()
+        self._remove_stderr()
+
+    def _remove_stderr(self):
+        self.stderr.close()
+        try:
+            os.remove(self.stderr_path)
+        except OSError:
+            pass
+
+
+class WorkerPoolBuilder(Builder):
+    """Document builder backed by a pool of long lived FOP workers.
+
+    Instead of starting a JVM for each document (like the
+    `SubprocessBuilder`), up to `workers` processes are kept alive and
+    each document is dispatched to an idle one. A worker is restarted
+    when it crashes or after `max_jobs` documents, to contain any
+    memory leak of the JVM. A worker that takes more than `job_timeout`
+    seconds on a document is killed, and replaced on the next document.
+    The errors include the end of the standard error of the worker.
+
+    The worker command is `worker_cmd` or the value of the environment
+    variable "FOP_WORKER_CMD", pypfop includes the source of a worker
+    implementation based on the FOP API in `FOP_WORKER_SOURCE`, for
+    example::
+
+        export FOP_CP="$FOP_HOME/build/*:$FOP_HOME/lib/*"
+        javac -cp "$FOP_CP" FopWorker.java
+        export FOP_WORKER_CMD="java -cp '.:$FOP_CP' FopWorker"
+
+    Call `close` (or use the builder as a context manager) to shut
+    down the workers.
+    """
+    concurrent_formats = True
+
+    def __init__(self, worker_cmd=None, workers=2, max_jobs=None,
+                 prestart=False, shutdown_timeout=5, job_timeout=None):
+        self.worker_cmd = self._find_worker_cmd(worker_cmd)
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.job_timeout = job_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self._slots = threading.BoundedSemaphore(workers)
+        self._idle = queue.LifoQueue()
+        self._closed = False
+        if prestart:
+            self.start()
+
+    def _find_worker_cmd(self, worker_cmd):
+        if worker_cmd is None:
+            worker_cmd = os.environ.get(FOP_WORKER_ENV_VAR)
+        if not worker_cmd:
+            raise BuilderError(
+                'Unable to find the command to start the FOP workers. '
+                'Set the environment variable "{}"'
+                .format(FOP_WORKER_ENV_VAR)
+            )
+        if isinstance(worker_cmd, str):
+            return shlex.split(worker_cmd)
+        return list(worker_cmd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        """Start the missing workers to have `workers` idle processes."""
+        for _ in range(self.workers - self._idle.qsize()):
+            self._idle.put(self._spawn())
+
+    def close(self):
+        """Stop the idle workers, the busy ones are stopped as
+        soon as they finish the current document.
+        """
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().stop(self.shutdown_timeout)
+            except queue.Empty:
+                break
+
+    def _spawn(self):
+        try:
+            return _FopWorker(self.worker_cmd)
+        except OSError as os_error:
+            raise BuilderError(
+                'Unable to start the FOP worker {}\n{}'
+                .format(self.worker_cmd, os_error)
+            )
+
+    def _acquire(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                return self._spawn()
+            if worker.alive:
+                return worker
+            worker.stop(self.shutdown_timeout)
+
+    def _release(self, worker, healthy):
+        exhausted = self.max_jobs is not None and \
+            worker.jobs >= self.max_jobs
+        if healthy and not exhausted and not self._closed:
+            self._idle.put(worker)
+        else:
+            worker.stop(self.shutdown_timeout)
+
+    @instrumented
+    def __call__(self, xslfo, out_format, log, output=None):
+        """
+        Build the document on one of the workers,
+        it returns the filepath of the generated document
+        or the document on the requested `output`.
+
+        In case of an error, it will raise an Exception on which
+        the body will be the error message reported by the worker.
+        """
+        if self._closed:
+            raise BuilderError('The worker pool has been closed')
+        xslfo = join_xslfo(xslfo)
+        if isinstance(xslfo, str):
+            xslfo = xslfo.encode('utf-8')
+        with self._slots:
+            worker = self._acquire()
+            log.debug('Using FOP worker %s', worker.proc.pid)
+            try:
+                success, payload = worker.build(
+                    xslfo, out_format, self.job_timeout
+                )
+            except (OSError, ValueError, EOFError) as worker_error:
+                errors = worker.errors()
+                self._release(worker, False)
+                if worker.timed_out:
+                    message = (
+                        'The FOP worker {} was killed after {} seconds '
+                        'building the document'.format(
+                            worker.proc.pid, self.job_timeout
+                        )
+                    )
+                else:
+                    message = (
+                        'The FOP worker {} died while building the '
+                        'document\n{}'.format(worker.proc.pid, worker_error)
+                    )
+                if errors:
+                    message = '{}\n{}'.format(message, errors)
+                raise BuilderError(message)
+            errors = '' if success else worker.errors()
+            self._release(worker, True)
+        instrumentation.annotate(exit_status=0 if success else 1)
+        if not success:
+            error = payload.decode('utf-8', 'replace')
+            if errors:
+                error = '{}\n{}'.format(error, errors)
+            log.debug('Error of the FOP worker: %s', error)
+            raise BuilderError(error)
+        return self._deliver([payload], out_format, output)
 
 
 class FopsBuilder(Builder):
@@ -97,7 +578,12 @@ class FopsBuilder(Builder):
 
     This approach dramatically increase the document generation speed with
     the cost of having another server running that implies using more ram.
+
+    With `raw_body` a stream of XSL-FO is sent as a chunked request body
+    as it is generated.
     """
+    concurrent_formats = True
+    streaming_input = True
 
     def __init__(
         self, host, port, protocol='http',
@@ -108,6 +594,10 @@ class FopsBuilder(Builder):
         self.protocol = protocol
         self.url_opener = url_opener
         self.encoding = kwargs.get('encoding', 'utf-8')
+        # Send the document as the raw (optionally gzipped) body of the
+        # request instead of a form, it requires the support of the server.
+        self.raw_body = kwargs.get('raw_body', False)
+        self.compress = kwargs.get('compress', False)
 
     @staticmethod
     def server_url(host, port, protocol, part=''):
@@ -129,36 +619,513 @@ class FopsBuilder(Builder):
     def _server_url(self, ext):
         return self.server_url(self.host, self.port, self.protocol, ext)
 
-    def __call__(self, xslfo, out_format, log):
+    @instrumented
+    def __call__(self, xslfo, out_format, log, output=None):
         try:
-            ofilepath = self._make_document(out_format, xslfo)
+            return self._make_document(out_format, xslfo, output)
         except URLError as url_error:
             raise BuilderError(
                 'Unable to build the document on the fops server\n{}'
                 .format(url_error)
             )
+
+    def _encode_document(self, xslfo):
+        if self.raw_body:
+            headers = {
+                'Content-Type': 'application/xml; charset={}'
+                .format(self.encoding)}
+            if isinstance(xslfo, str):
+                xslfo = xslfo.encode(self.encoding)
+            data = xslfo
         else:
-            return ofilepath
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded; charset={}'
+                .format(self.encoding)}
+            data = urlencode(
+                {'document': join_xslfo(xslfo)}
+            ).encode(self.encoding)
+        if self.compress:
+            headers['Content-Encoding'] = 'gzip'
+            if is_xslfo_stream(data):
+                data = _gzip_stream(data)
+            else:
+                data = gzip.compress(data)
+        return headers, data
 
     def _build_request(self, out_format, xslfo):
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded; charset={}'
-            .format(self.encoding)}
-        data = urlencode({'document': xslfo}).encode(self.encoding)
+        headers, data = self._encode_document(xslfo)
         return request.Request(
             self._server_url(out_format), data=data, headers=headers
         )
 
-    def _make_document(self, out_format, xslfo):
+    def _make_document(self, out_format, xslfo, output=None):
         response = self.url_opener(self._build_request(out_format, xslfo))
-        if response.code is HTTPStatus.OK:
-            ofilepath = self._get_tempfile(out_format)
-            with open(ofilepath, 'wb') as outfile:
-                for fragment in response:
-                    outfile.write(fragment)
-            return ofilepath
+        instrumentation.annotate(exit_status=response.code)
+        if response.code == HTTPStatus.OK:
+            # Stream the body straight into the output.
+            return self._deliver(
+                _iter_response(response), out_format, output
+            )
         else:
             raise Exception(
                 '{}\r\n{} - code {}'
                 .format(response.read(), response.msg, response.code)
             )
+
+
+def _iter_response(response):
+    with response:
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _basic_auth_headers(kwargs):
+    if 'user' not in kwargs or 'passwd' not in kwargs:
+        return {}
+    credentials = '{}:{}'.format(kwargs['user'], kwargs['passwd'])
+    return {'Authorization': 'Basic {}'.format(
+        base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+    )}
+
+
+class _HostConnections:
+    """Keep-alive connections to one of the fops servers and its health."""
+
+    def __init__(self, host, port, protocol, size, timeout):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        if protocol == 'https':
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.down_until = 0
+        self._idle = queue.LifoQueue()
+
+    def __repr__(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    @property
+    def healthy(self):
+        return self.down_until <= time.monotonic()
+
+    def request(self, method, url, body, headers):
+        """Send the request on a kept alive connection (or a new one)
+        and return the connection with its response.
+        """
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            try:
+                connection.request(method, url, body, headers)
+                return connection, connection.getresponse()
+            except BaseException as error:
+                connection.close()
+                # only a kept alive connection closed by the server is
+                # tried again, on a new connection.
+                if not isinstance(error, ConnectionError) or \
+                        getattr(body, 'started', False):
+                    raise
+        connection = self.connection_class(
+            self.host, self.port, timeout=self.timeout
+        )
+        try:
+            connection.request(method, url, body, headers)
+            return connection, connection.getresponse()
+        except BaseException:
+            connection.close()
+            raise
+
+    def release(self, connection):
+        if self._idle.qsize() < self.size:
+            self._idle.put(connection)
+        else:
+            connection.close()
+
+    def failed(self, cooldown):
+        self.down_until = time.monotonic() + cooldown
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class PooledFopsBuilder(FopsBuilder):
+    """`FopsBuilder` that keeps a pool of persistent HTTP/1.1 connections
+    to one or more fops servers.
+
+    `hosts` is a list of ``(host, port)`` tuples (or ``host:port``
+    strings) that are used in rotation. A server that fails to answer is
+    skipped during `cooldown` seconds and the request is retried on the
+    next one, up to `retries` times (by default once per server), the
+    same happens with the server errors other than the 500 of the failed
+    documents (like a 503 of an overloaded server). Each request fails
+    after `timeout` seconds, if set.
+
+    Pass the `user` and `passwd` parameters to use HTTP basic auth, and
+    `raw_body`/`compress` (like with the `FopsBuilder`) to send the
+    document as a raw `application/xml` body, optionally gzipped.
+    """
+
+    def __init__(self, hosts, protocol='http', pool_size=10, timeout=None,
+                 retries=None, cooldown=30, **kwargs):
+        hosts = [self._parse_host(host) for host in hosts]
+        if not hosts:
+            raise BuilderError('At least one fops server is required')
+        FopsBuilder.__init__(self, hosts[0][0], hosts[0][1], protocol,
+                             None, **kwargs)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = len(hosts) if retries is None else retries
+        self.cooldown = cooldown
+        self.headers = _basic_auth_headers(kwargs)
+        self.hosts = [
+            _HostConnections(host, port, protocol, pool_size, timeout)
+            for (host, port) in hosts
+        ]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse_host(host):
+        if isinstance(host, str):
+            host, _, port = host.rpartition(':')
+            return host, int(port)
+        return tuple(host)
+
+    @classmethod
+    def with_basic_auth(cls, hosts, protocol='http', **kwargs):
+        if 'user' not in kwargs or 'passwd' not in kwargs:
+            raise TypeError('Missing required parameters "user" and "passwd".')
+        return cls(hosts, protocol, **kwargs)
+
+    def close(self):
+        for host in self.hosts:
+            host.close()
+
+    def _next_host(self):
+        """Return the next healthy server, or the one that is going to
+        recover first if all of them are down.
+        """
+        with self._lock:
+            count = len(self.hosts)
+            for offset in range(count):
+                host = self.hosts[(self._next + offset) % count]
+                if host.healthy:
+                    self._next = (self._next + offset + 1) % count
+                    return host
+            return min(self.hosts, key=lambda host: host.down_until)
+
+    @instrumented
+    def __call__(self, xslfo, out_format, log, output=None):
+        headers, data = self._encode_document(xslfo)
+        headers.update(self.headers)
+        if is_xslfo_stream(data):
+            data = _StreamBody(data)
+        errors = []
+        for _ in range(self.retries + 1):
+            host = self._next_host()
+            try:
+                connection, response = host.request(
+                    'POST', '/' + out_format, data, headers
+                )
+            except (OSError, http.client.HTTPException) as http_error:
+                log.debug('The fops server %s failed: %r', host, http_error)
+                errors.append('{}: {!r}'.format(host, http_error))
+                host.failed(self.cooldown)
+                if getattr(data, 'started', False):
+                    # the stream can't be sent again to another server.
+                    break
+                continue
+            instrumentation.annotate(exit_status=response.status)
+            # the server errors are tried on the next server, except the
+            # 500 of fops with the errors of the document.
+            if HTTPStatus.INTERNAL_SERVER_ERROR < response.status < 600:
+                response.read()
+                host.release(connection)
+                log.debug('The fops server %s is unavailable: %s',
+                          host, response.status)
+                errors.append('{}: {} - code {}'.format(
+                    host, response.reason, response.status
+                ))
+                host.failed(self.cooldown)
+                if getattr(data, 'started', False):
+                    break
+                continue
+            if response.status != HTTPStatus.OK:
+                body = response.read()
+                host.release(connection)
+                raise BuilderError(
+                    '{}\r\n{} - code {}'
+                    .format(body, response.reason, response.status)
+                )
+            return self._deliver(
+                self._iter_pooled_response(host, connection, response),
+                out_format, output
+            )
+        raise BuilderError(
+            'Unable to build the document on the fops servers\n{}'
+            .format('\n'.join(errors))
+        )
+
+    def _iter_pooled_response(self, host, connection, response):
+        try:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        except (OSError, http.client.HTTPException) as http_error:
+            connection.close()
+            host.failed(self.cooldown)
+            raise BuilderError(
+                'Unable to read the document from the fops server {}\n{!r}'
+                .format(host, http_error)
+            )
+        except BaseException:
+            connection.close()
+            raise
+        host.release(connection)
+
+
+class AsyncBuilder(Builder):
+    """Base class of the builders that generate the document without
+    blocking the event loop, `__call__` is a coroutine.
+
+    No more than `max_concurrency` documents are built at the same time
+    by the builder instance, if set.
+    """
+    streaming_input = False
+    max_concurrency = None
+    _semaphore = None
+    _loop = None
+
+    def _limit(self):
+        if self.max_concurrency is None:
+            return _NoLimit()
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # asyncio primitives are bound to a single event loop.
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @instrumented
+    async def __call__(self, xslfo, out_format, log, output=None):
+        async with self._limit():
+            return await self._build(xslfo, out_format, log, output)
+
+    async def _build(self, xslfo, out_format, log, output):
+        raise NotImplementedError()
+
+    async def build_many(self, xslfo, out_formats, log, output=None):
+        documents = await asyncio.gather(*[
+            self(xslfo, out_format, log, output) for out_format in out_formats
+        ])
+        return dict(zip(out_formats, documents))
+
+
+class _NoLimit:
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class AsyncSubprocessBuilder(AsyncBuilder, SubprocessBuilder):
+    """Asyncio version of the `SubprocessBuilder`."""
+
+    def __init__(self, fop_cmd=None, fop_cmd_extra_args=None,
+                 max_concurrency=None):
+        SubprocessBuilder.__init__(self, fop_cmd, fop_cmd_extra_args)
+        self.max_concurrency = max_concurrency
+
+    async def _build(self, xslfo, out_format, log, output):
+        ofilepath = self._ofilepath(out_format, output)
+        cmdargs = self._cmdargs(out_format, ofilepath)
+        log.debug('cmdline %s', cmdargs)
+        proc = None
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmdargs,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await proc.communicate(join_xslfo(xslfo))
+        except (asyncio.CancelledError, Exception):
+            # the task was cancelled (or timed out): don't leave fop
+            # running nor its document behind.
+            if proc is not None and proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            if ofilepath != '-' and os.path.exists(ofilepath):
+                os.remove(ofilepath)
+            raise
+        return self._check_result(proc.returncode, stdout, stderr,
+                                  ofilepath, out_format, output, log)
+
+
+class _AsyncConnectionPool:
+    """Minimal HTTP/1.1 client over asyncio streams that keeps up to
+    `size` keep-alive connections to a single server.
+    """
+
+    def __init__(self, host, port, ssl=False, size=10):
+        self.host = host
+        self.port = port
+        self.ssl = ssl or None
+        self.size = size
+        self._idle = []
+        self._semaphore = None
+        self._loop = None
+
+    async def request(self, method, path, headers, body):
+        """Return the tuple ``(status, reason, body)`` of the response."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # the connections of another event loop can't be reused.
+            self._loop = loop
+            self._idle = []
+            self._semaphore = asyncio.Semaphore(self.size)
+        async with self._semaphore:
+            while self._idle:
+                reader, writer = self._idle.pop()
+                if reader.at_eof():
+                    writer.close()
+                    continue
+                try:
+                    return await self._request(
+                        reader, writer, method, path, headers, body
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # the server closed the kept alive connection.
+                    writer.close()
+            reader, writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl
+            )
+            return await self._request(
+                reader, writer, method, path, headers, body
+            )
+
+    async def _request(self, reader, writer, method, path, headers, body):
+        lines = ['{} {} HTTP/1.1'.format(method, path),
+                 'Host: {}:{}'.format(self.host, self.port),
+                 'Content-Length: {}'.format(len(body))]
+        lines.extend('{}: {}'.format(*header) for header in headers.items())
+        try:
+            writer.write(
+                ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+            )
+            writer.write(body)
+            await writer.drain()
+            status, reason, rheaders, rbody = await self._read_response(
+                reader
+            )
+        except BaseException:
+            writer.close()
+            raise
+        if rheaders.get('connection', '').lower() == 'close':
+            writer.close()
+        else:
+            self._idle.append((reader, writer))
+        return status, reason, rbody
+
+    async def _read_response(self, reader):
+        status_line = await reader.readuntil(b'\r\n')
+        parts = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        status, reason = int(parts[1]), ''.join(parts[2:])
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size_line = await reader.readuntil(b'\r\n')
+                size = int(size_line.split(b';')[0], 16)
+                if not size:
+                    await self._skip_trailers(reader)
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            headers['connection'] = 'close'
+            body = await reader.read()
+        return status, reason, headers, body
+
+    async def _skip_trailers(self, reader):
+        while await reader.readuntil(b'\r\n') != b'\r\n':
+            pass
+
+    def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+class AsyncFopsBuilder(AsyncBuilder, FopsBuilder):
+    """Asyncio version of the `FopsBuilder`.
+
+    The requests share a pool of up to `pool_size` keep-alive
+    connections to the fops server and each one of them fails
+    after `timeout` seconds, if set. Pass the `user` and `passwd`
+    parameters to use HTTP basic auth.
+    """
+
+    def __init__(self, host, port, protocol='http', pool_size=10,
+                 timeout=None, max_concurrency=None, **kwargs):
+        FopsBuilder.__init__(self, host, port, protocol, None, **kwargs)
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.headers = _basic_auth_headers(kwargs)
+        self.pool = _AsyncConnectionPool(
+            host, port, protocol == 'https', pool_size
+        )
+
+    @classmethod
+    def with_basic_auth(cls, host, port, protocol='http', **kwargs):
+        if 'user' not in kwargs or 'passwd' not in kwargs:
+            raise TypeError('Missing required parameters "user" and "passwd".')
+        return cls(host, port, protocol, **kwargs)
+
+    def close(self):
+        self.pool.close()
+
+    async def _build(self, xslfo, out_format, log, output):
+        headers, data = self._encode_document(join_xslfo(xslfo))
+        headers.update(self.headers)
+        path = '/' + out_format
+        try:
+            status, reason, body = await asyncio.wait_for(
+                self.pool.request('POST', path, headers, data), self.timeout
+            )
+        except (OSError, asyncio.TimeoutError,
+                asyncio.IncompleteReadError) as http_error:
+            raise BuilderError(
+                'Unable to build the document on the fops server\n{!r}'
+                .format(http_error)
+            )
+        instrumentation.annotate(exit_status=status)
+        if status != HTTPStatus.OK:
+            raise BuilderError(
+                '{}\r\n{} - code {}'.format(body, reason, status)
+            )
+        return self._deliver([body], out_format, output)
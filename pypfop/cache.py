@@ -0,0 +1,489 @@
+import os
+import re
+import json
+import time
+import uuid
+import base64
+import decimal
+import hashlib
+import datetime
+import logging
+import pathlib
+import tempfile
+import threading
+import collections
+import urllib.request
+from urllib.parse import urlparse
+
+from pypfop.conversion import stylesheet_cache
+from pypfop.exceptions import DocumentGeneratorError
+
+
+logger = logging.getLogger('pypfop')
+
+
+def _json_default(value):
+    # The values that json can't handle are part of the key only if they
+    # are known to be identified by their text (dates, decimals, etc) or
+    # they say how with a ``cache_key`` method, the representation of
+    # any other object could change without its content (or the other
+    # way around) and give the wrong document.
+    cache_key = getattr(value, 'cache_key', None)
+    if callable(cache_key):
+        key = cache_key()
+    elif isinstance(value, (datetime.date, datetime.time)):
+        key = value.isoformat()
+    elif isinstance(value, (decimal.Decimal, uuid.UUID)):
+        key = str(value)
+    elif isinstance(value, bytes):
+        key = base64.b64encode(value).decode('ascii')
+    elif isinstance(value, (set, frozenset)):
+        key = sorted(json.dumps(item, sort_keys=True, default=_json_default)
+                     for item in value)
+    else:
+        raise TypeError(
+            'The param {!r} can not be part of the key of the result '
+            'cache, give it a cache_key method'.format(value)
+        )
+    return [type(value).__qualname__, key]
+
+
+def document_key(template, params, ssheets, out_format):
+    """Return the key of the document generated with `template`,
+    the (already merged) `params`, the style sheets and `out_format`.
+
+    The template is identified by its `fingerprint` method, if it
+    has one, and the style sheets by their resolved rules. The params
+    must be json values, dates, times, decimals, uuids, bytes, sets or
+    objects with a ``cache_key`` method that returns a json value that
+    identifies them, a `DocumentGeneratorError` is raised otherwise.
+    """
+    fingerprint = getattr(template, 'fingerprint', None)
+    if callable(fingerprint):
+        template_id = fingerprint()
+    else:
+        template_id = '{}:{!r}'.format(type(template).__qualname__, template)
+    try:
+        params_id = json.dumps(params, sort_keys=True, default=_json_default)
+    except (TypeError, ValueError) as error:
+        raise DocumentGeneratorError(
+            'Unable to cache the document: {}'.format(error)
+        )
+    key = hashlib.sha256()
+    for part in (template_id, params_id,
+                 *[stylesheet_cache.digest(sheet) for sheet in ssheets],
+                 out_format):
+        key.update(part.encode('utf-8'))
+        key.update(b'\0')
+    return key.hexdigest()
+
+
+class ResultCache:
+    """Base class of the caches of generated documents.
+
+    An instance can be passed as the `result_cache` of a
+    `DocumentGenerator`, to reuse the documents generated with the same
+    template, parameters, style sheets and format. The documents are
+    stored as bytes, `hits` and `misses` count the lookups of the cache.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached document of `key` or None."""
+        document = self._get(key)
+        with self._lock:
+            if document is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return document
+
+    def set(self, key, document):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def _get(self, key):
+        raise NotImplementedError()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class MemoryResultCache(ResultCache):
+    """In-process LRU cache that holds up to `maxbytes` of documents."""
+
+    def __init__(self, maxbytes=64 * 1024 * 1024):
+        super().__init__()
+        self.maxbytes = maxbytes
+        self.currbytes = 0
+        self._documents = collections.OrderedDict()
+
+    def _get(self, key):
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+            return document
+
+    def set(self, key, document):
+        if len(document) > self.maxbytes:
+            return
+        with self._lock:
+            previous = self._documents.pop(key, None)
+            if previous is not None:
+                self.currbytes -= len(previous)
+            self._documents[key] = document
+            self.currbytes += len(document)
+            while self.currbytes > self.maxbytes:
+                _, evicted = self._documents.popitem(last=False)
+                self.currbytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+            self.currbytes = 0
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(entries=len(self._documents), bytes=self.currbytes)
+        return stats
+
+
+class DiskResultCache(ResultCache):
+    """Content-addressed cache on the local `directory`.
+
+    The documents are stored once by the hash of their content on
+    ``objects/`` and each key on ``keys/`` references one of them.
+    The keys expire after `ttl` seconds (if set), `evict` removes the
+    expired keys and the documents that are no longer referenced.
+    """
+
+    def __init__(self, directory, ttl=None):
+        super().__init__()
+        self.directory = directory
+        self.ttl = ttl
+        self._keys_dir = os.path.join(directory, 'keys')
+        self._objects_dir = os.path.join(directory, 'objects')
+        os.makedirs(self._keys_dir, exist_ok=True)
+        os.makedirs(self._objects_dir, exist_ok=True)
+
+    def _key_path(self, key):
+        return os.path.join(self._keys_dir, key)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects_dir, digest)
+
+    def _expired(self, path, now):
+        return self.ttl is not None and \
+            os.stat(path).st_mtime + self.ttl < now
+
+    def _write(self, path, content):
+        # write and rename to never expose a partial file.
+        fdesc, tmppath = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fdesc, 'wb') as tmpfile:
+            tmpfile.write(content)
+        os.replace(tmppath, path)
+
+    def _get(self, key):
+        key_path = self._key_path(key)
+        try:
+            if self._expired(key_path, time.time()):
+                os.remove(key_path)
+                return None
+            with open(key_path) as keyfile:
+                digest = keyfile.read()
+            with open(self._object_path(digest), 'rb') as document:
+                return document.read()
+        except OSError:
+            return None
+
+    def set(self, key, document):
+        digest = hashlib.sha256(document).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            self._write(object_path, document)
+        self._write(self._key_path(key), digest.encode('ascii'))
+
+    def evict(self):
+        """Remove the expired keys and the unreferenced documents."""
+        now = time.time()
+        referenced = set()
+        for key in os.listdir(self._keys_dir):
+            key_path = self._key_path(key)
+            try:
+                if self._expired(key_path, now):
+                    os.remove(key_path)
+                    continue
+                with open(key_path) as keyfile:
+                    referenced.add(keyfile.read())
+            except OSError:
+                continue
+        for digest in os.listdir(self._objects_dir):
+            if digest not in referenced:
+                try:
+                    os.remove(self._object_path(digest))
+                except OSError:
+                    pass
+
+    def clear(self):
+        for directory in (self._keys_dir, self._objects_dir):
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+
+    def stats(self):
+        stats = super().stats()
+        objects = os.listdir(self._objects_dir)
+        stats.update(
+            entries=len(os.listdir(self._keys_dir)),
+            bytes=sum(os.path.getsize(self._object_path(digest))
+                      for digest in objects)
+        )
+        return stats
+
+
+class ResourceCache:
+    """Base class of the caches of the external resources (images) of
+    the documents.
+
+    An instance can be passed as the `resource_cache` of a
+    `DocumentGenerator`: the ``src`` of the ``external-graphic`` elements
+    with one of the `schemes` is fetched once (the concurrent requests
+    of a resource wait for the first one) and replaced by its local copy,
+    fop does no remote I/O. A resource that can not be fetched keeps its
+    reference and it's not requested again for `retry_after` seconds.
+    """
+    schemes = ('http', 'https')
+
+    def __init__(self, timeout=30, retry_after=60, schemes=None):
+        self.timeout = timeout
+        self.retry_after = retry_after
+        if schemes is not None:
+            self.schemes = tuple(schemes)
+        self.hits = self.misses = self.errors = 0
+        self._lock = threading.Lock()
+        self._fetching = {}  # uri -> lock of the thread that fetches it
+        # uri -> time of the last failure, from the oldest one.
+        self._failed = collections.OrderedDict()
+
+    def _settings(self):
+        # the state of the pickled caches.
+        return {'timeout': self.timeout, 'retry_after': self.retry_after,
+                'schemes': self.schemes}
+
+    def resolve(self, uri):
+        """Return the local reference of the resource `uri` (a file URI
+        or a ``data:`` URI), or None to keep `uri`.
+        """
+        if urlparse(uri).scheme.lower() not in self.schemes:
+            return None
+        local = self._lookup(uri)
+        if local is None:
+            with self._lock:
+                fetching = self._fetching.setdefault(uri, threading.Lock())
+            with fetching:
+                try:
+                    local = self._lookup(uri)
+                    if local is None:
+                        return self._fetch(uri)
+                finally:
+                    with self._lock:
+                        self._fetching.pop(uri, None)
+        with self._lock:
+            self.hits += 1
+        return local
+
+    def _expire_failures(self, now):
+        # the failures are in order, the expired ones are dropped to not
+        # keep every bad uri on the long running processes.
+        while self._failed:
+            uri, failed = next(iter(self._failed.items()))
+            if failed + self.retry_after > now:
+                break
+            del self._failed[uri]
+
+    def _fetch(self, uri):
+        with self._lock:
+            self._expire_failures(time.monotonic())
+            if uri in self._failed:
+                return None
+        try:
+            with urllib.request.urlopen(uri, timeout=self.timeout) as response:
+                content = response.read()
+                content_type = response.headers.get_content_type()
+        except (OSError, ValueError) as error:
+            logger.warning('Unable to fetch the resource %s: %s', uri, error)
+            with self._lock:
+                self.errors += 1
+                self._failed.pop(uri, None)
+                self._failed[uri] = time.monotonic()
+            return None
+        with self._lock:
+            self.misses += 1
+            self._failed.pop(uri, None)
+        return self._store(uri, content, content_type)
+
+    def _lookup(self, uri):
+        raise NotImplementedError()
+
+    def _store(self, uri, content, content_type):
+        """Store the fetched resource, return its local reference or None
+        if it can't be cached.
+        """
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'errors': self.errors}
+
+
+class MemoryResourceCache(ResourceCache):
+    """In-process LRU cache of the resources as ``data:`` URIs, up to
+    `maxbytes` of them. The resources are embedded on the XSL-FO.
+    """
+
+    def __init__(self, maxbytes=16 * 1024 * 1024, **kwargs):
+        super().__init__(**kwargs)
+        self.maxbytes = maxbytes
+        self.currbytes = 0
+        self._resources = collections.OrderedDict()
+
+    def __reduce__(self):
+        # the other processes get their own (empty) cache.
+        return (type(self), (self.maxbytes, ), self._settings())
+
+    def _lookup(self, uri):
+        with self._lock:
+            data_uri = self._resources.get(uri)
+            if data_uri is not None:
+                self._resources.move_to_end(uri)
+            return data_uri
+
+    def _store(self, uri, content, content_type):
+        data_uri = 'data:{};base64,{}'.format(
+            content_type, base64.b64encode(content).decode('ascii')
+        )
+        if len(data_uri) > self.maxbytes:
+            return None
+        with self._lock:
+            previous = self._resources.pop(uri, None)
+            if previous is not None:
+                self.currbytes -= len(previous)
+            self._resources[uri] = data_uri
+            self.currbytes += len(data_uri)
+            while self.currbytes > self.maxbytes:
+                _, evicted = self._resources.popitem(last=False)
+                self.currbytes -= len(evicted)
+        return data_uri
+
+    def clear(self):
+        with self._lock:
+            self._resources.clear()
+            self.currbytes = 0
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(entries=len(self._resources), bytes=self.currbytes)
+        return stats
+
+
+_EXTENSION_RE = re.compile(r'\.\w{1,8}$')
+
+
+class DiskResourceCache(ResourceCache):
+    """Cache of the resources as files of the local `directory`, which
+    can be shared by several processes.
+
+    Each resource is stored on a file named by the hash of its URI and
+    referenced by its file URI. Once the files take more than
+    `maxbytes`, the least recently used are removed. The cached
+    fragments (check `pypfop.fragments`) keep the references they were
+    built with, `maxbytes` should hold the resources they use.
+    """
+
+    def __init__(self, directory, maxbytes=512 * 1024 * 1024, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = os.path.abspath(directory)
+        self.maxbytes = maxbytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __reduce__(self):
+        return (type(self), (self.directory, self.maxbytes),
+                self._settings())
+
+    def _path(self, uri):
+        extension = _EXTENSION_RE.search(urlparse(uri).path)
+        return os.path.join(self.directory, '{}{}'.format(
+            hashlib.sha256(uri.encode('utf-8')).hexdigest(),
+            extension.group() if extension else ''
+        ))
+
+    def _lookup(self, uri):
+        path = self._path(uri)
+        try:
+            # the modification time orders the files for the eviction.
+            os.utime(path)
+        except OSError:
+            return None
+        return pathlib.Path(path).as_uri()
+
+    def _store(self, uri, content, content_type):
+        if len(content) > self.maxbytes:
+            return None
+        path = self._path(uri)
+        # write and rename to never expose a partial file.
+        fdesc, tmppath = tempfile.mkstemp(dir=self.directory,
+                                          prefix='.tmp')
+        with os.fdopen(fdesc, 'wb') as tmpfile:
+            tmpfile.write(content)
+        os.replace(tmppath, path)
+        self.evict()
+        return pathlib.Path(path).as_uri()
+
+    def _files(self):
+        """Return the ``(mtime, size, path)`` of the cached files."""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime_ns, stat.st_size, path))
+        return files
+
+    def evict(self):
+        """Remove the least recently used files until they take no more
+        than `maxbytes`.
+        """
+        files = sorted(self._files())
+        currbytes = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if currbytes <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            currbytes -= size
+
+    def clear(self):
+        for _, _, path in self._files():
+            os.remove(path)
+
+    def stats(self):
+        stats = super().stats()
+        files = self._files()
+        stats.update(entries=len(files),
+                     bytes=sum(size for _, size, _ in files))
+        return stats
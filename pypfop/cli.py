@@ -0,0 +1,348 @@
+import os
+import re
+import sys
+import json
+import shlex
+import shutil
+import tarfile
+import argparse
+import tempfile
+import itertools
+
+import pypfop
+import pypfop.templates.mako
+from pypfop import cache, helpers, validation
+from pypfop.builder import SubprocessBuilder
+from pypfop.document_generator import DocumentGenerator, OUTPUT_FORMATS
+from pypfop.exceptions import PypfopError, DocumentGeneratorError
+
+
+_NAME_RE = re.compile(r'[\w.-]+')
+
+
+class DirectoryOutput:
+    """The documents of `render` as files of `directory`, they are moved
+    there once complete so an interrupted run leaves no partial files.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.tempdir = tempfile.mkdtemp(prefix='.pypfop-', dir=directory)
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.directory, name))
+
+    def add(self, name, path):
+        os.replace(path, os.path.join(self.directory, name))
+
+    def close(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+
+class TarOutput:
+    """The documents of `render` as members of the tar file `path`, or
+    a tar stream on the standard output with ``-``. An existing file is
+    appended to, skipping the documents it already has.
+    """
+
+    def __init__(self, path):
+        self.names = set()
+        self.tempdir = tempfile.mkdtemp(prefix='pypfop-')
+        if path == '-':
+            self.tar = tarfile.open(fileobj=sys.stdout.buffer, mode='w|')
+            return
+        try:
+            if os.path.exists(path):
+                with tarfile.open(path) as tar:
+                    self.names.update(tar.getnames())
+            self.tar = tarfile.open(path, mode='a')
+        except tarfile.TarError as error:
+            raise DocumentGeneratorError(
+                'Unable to resume the tar file {}: {}'.format(path, error)
+            )
+
+    def exists(self, name):
+        return name in self.names
+
+    def add(self, name, path):
+        info = self.tar.gettarinfo(path, arcname=name)
+        info.mode = 0o644
+        with open(path, 'rb') as document:
+            self.tar.addfile(info, document)
+        os.remove(path)
+        self.names.add(name)
+
+    def close(self):
+        self.tar.close()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+
+def _read_params(lines):
+    """Yield the number (from one) of each of the JSON `lines` with its
+    params or the error found reading them, blank lines are skipped.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            params = json.loads(line)
+        except ValueError as error:
+            yield number, None, 'Invalid JSON: {}'.format(error)
+            continue
+        if isinstance(params, dict):
+            yield number, params, None
+        else:
+            yield number, None, 'The params must be a JSON object'
+
+
+def _document_name(number, params, name_field, out_format):
+    if name_field is None:
+        name = '{:06d}'.format(number)
+    else:
+        name = str(params.get(name_field, ''))
+        if not _NAME_RE.fullmatch(name) or name.startswith('.'):
+            raise ValueError(
+                'Invalid document name {!r} on {}'.format(name, name_field)
+            )
+    return '{}.{}'.format(name, out_format)
+
+
+def _render_generator(args, tempdir):
+    factory = helpers.get_mako_template_factory(
+        args.lookup_dirs or None, not args.no_skels, args.module_dir,
+        skel_dirs=args.skel_dirs
+    )
+    doc_builder = None
+    if args.fop_cmd:
+        fop_cmd, *fop_args = shlex.split(args.fop_cmd)
+        doc_builder = SubprocessBuilder(fop_cmd, fop_args)
+    resource_cache = None
+    if args.resource_dir:
+        resource_cache = cache.DiskResourceCache(args.resource_dir)
+    return DocumentGenerator(
+        factory(args.template), args.stylesheets or (), args.format,
+        style_dir=args.style_dir, builder=doc_builder, tempdir=tempdir,
+        fo_schema=validation.fo_schema if args.validate else None,
+        resource_cache=resource_cache
+    )
+
+
+def render(args):
+    """Render a document per line of params, return 1 if any failed."""
+    if args.output_dir is not None:
+        output = DirectoryOutput(args.output_dir)
+    else:
+        output = TarOutput(args.tar)
+    if args.report != '-':
+        report_file = open(args.report, 'a')
+    elif args.tar == '-':
+        report_file = sys.stderr
+    else:
+        report_file = sys.stdout
+    if args.input == '-':
+        input_file = sys.stdin
+    else:
+        input_file = open(args.input)
+    failures = 0
+
+    def report(**record):
+        nonlocal failures
+        if record['status'] == 'error':
+            failures += 1
+        report_file.write(json.dumps(record, sort_keys=True) + '\n')
+        report_file.flush()
+
+    pending = {}  # index of the batch -> (line, name)
+    indexes = itertools.count()
+    seen = set()
+
+    def params_to_render():
+        for line, params, error in _read_params(input_file):
+            name = None
+            if error is None:
+                try:
+                    name = _document_name(line, params, args.name_field,
+                                          args.format)
+                except ValueError as name_error:
+                    error = str(name_error)
+            if error is None and name in seen:
+                error = 'Duplicated document name {}'.format(name)
+            if error is not None:
+                report(line=line, name=name, status='error', error=error)
+                continue
+            seen.add(name)
+            if output.exists(name):
+                report(line=line, name=name, status='skipped')
+                continue
+            pending[next(indexes)] = (line, name)
+            yield params
+
+    try:
+        generator = _render_generator(args, output.tempdir)
+        results = generator.generate_many(
+            params_to_render(), workers=args.workers, ordered=False
+        )
+        for result in results:
+            line, name = pending.pop(result.index)
+            record = {'line': line, 'name': name}
+            record.update(
+                ('{}_seconds'.format(stage), round(seconds, 6))
+                for stage, seconds in result.timings.items()
+            )
+            if result.error is None:
+                record['bytes'] = os.path.getsize(result.document)
+                output.add(name, result.document)
+                report(status='ok', **record)
+            else:
+                report(status='error', error='{}: {}'.format(
+                    type(result.error).__name__, result.error
+                ), **record)
+    finally:
+        output.close()
+        if input_file is not sys.stdin:
+            input_file.close()
+        if report_file not in (sys.stdout, sys.stderr):
+            report_file.close()
+    return 1 if failures else 0
+
+
+def precompile(args):
+    factory = pypfop.templates.mako.Factory(
+        args.lookup_dirs or None, not args.no_skels, args.module_dir,
+        skel_dirs=args.skel_dirs
+    )
+    for uri in factory.precompile():
+        print(uri)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='pypfop', description='Document preprocessor for Apache FOP'
+    )
+    parser.add_argument(
+        '--version', action='version', version=pypfop.__version__
+    )
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    precompile_parser = commands.add_parser(
+        'precompile',
+        help='compile the mako templates ahead of time',
+        description='Compile all the mako templates of the lookup '
+                    'directories (and the skeletons) into the module '
+                    'directory, to be reused by the mako Factory created '
+                    'with the same `module_directory`.'
+    )
+    precompile_parser.add_argument(
+        '-l', '--lookup-dir', action='append', dest='lookup_dirs',
+        help='directory with templates, can be used multiple times '
+             '(default: the current directory)'
+    )
+    precompile_parser.add_argument(
+        '-m', '--module-dir', required=True,
+        help='directory to store the compiled templates'
+    )
+    precompile_parser.add_argument(
+        '--no-skels', action='store_true',
+        help='do not include the skeletons'
+    )
+    precompile_parser.add_argument(
+        '-s', '--skel-dir', action='append', dest='skel_dirs',
+        help='directory with custom skeletons, can be used multiple times'
+    )
+    precompile_parser.set_defaults(func=precompile)
+
+    render_parser = commands.add_parser(
+        'render',
+        help='render a batch of documents',
+        description='Render a document with TEMPLATE for each line of '
+                    'JSON params, on parallel worker processes, into a '
+                    'directory or a tar file. A JSON line is reported per '
+                    'document with its timings or error. The documents '
+                    'that already exist on the output are skipped, to '
+                    'resume an interrupted run.'
+    )
+    render_parser.add_argument(
+        'template', help='template, relative to the lookup directories'
+    )
+    render_parser.add_argument(
+        '-i', '--input', default='-',
+        help='file with a JSON object of params per line '
+             '(default: the standard input)'
+    )
+    output_group = render_parser.add_mutually_exclusive_group(required=True)
+    output_group.add_argument(
+        '-o', '--output-dir', help='directory of the documents'
+    )
+    output_group.add_argument(
+        '-t', '--tar',
+        help='tar file of the documents, "-" for the standard output'
+    )
+    render_parser.add_argument(
+        '-r', '--report', default='-',
+        help='file to append the JSON report to (default: the standard '
+             'output, or error with a tar on the standard output)'
+    )
+    render_parser.add_argument(
+        '-f', '--format', default='pdf', choices=OUTPUT_FORMATS,
+        help='format of the documents (default: pdf)'
+    )
+    render_parser.add_argument(
+        '-w', '--workers', type=int,
+        help='worker processes (default: the number of cpus)'
+    )
+    render_parser.add_argument(
+        '-n', '--name-field',
+        help='param with the name of each document (default: the number '
+             'of its line)'
+    )
+    render_parser.add_argument(
+        '-c', '--stylesheet', action='append', dest='stylesheets',
+        help='css style sheet, can be used multiple times'
+    )
+    render_parser.add_argument(
+        '--style-dir', default='.',
+        help='directory of the style sheets (default: the current one)'
+    )
+    render_parser.add_argument(
+        '-l', '--lookup-dir', action='append', dest='lookup_dirs',
+        help='directory with templates, can be used multiple times '
+             '(default: the current directory)'
+    )
+    render_parser.add_argument(
+        '-s', '--skel-dir', action='append', dest='skel_dirs',
+        help='directory with custom skeletons, can be used multiple times'
+    )
+    render_parser.add_argument(
+        '--no-skels', action='store_true',
+        help='do not include the skeletons'
+    )
+    render_parser.add_argument(
+        '-m', '--module-dir', help='directory of the compiled templates'
+    )
+    render_parser.add_argument(
+        '--fop-cmd',
+        help='fop command, with any extra arguments (default: the '
+             '$FOP_CMD or fop)'
+    )
+    render_parser.add_argument(
+        '--validate', action='store_true',
+        help='validate the XSL-FO of each document before calling fop'
+    )
+    render_parser.add_argument(
+        '--resource-dir',
+        help='directory to cache the remote images of the documents, '
+             'shared by the workers'
+    )
+    render_parser.set_defaults(func=render)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    try:
+        return args.func(args) or 0
+    except PypfopError as error:
+        sys.stderr.write('{}\n'.format(error))
+        return 1
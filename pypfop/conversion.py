@@ -1,39 +1,854 @@
+import os
+import re
 import sys
+import copy
+import queue
+import hashlib
+import functools
+import itertools
+import threading
+import collections
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 from xml.etree import ElementTree
 
 import lxml.etree
 import cssutils
 import cssselect
+import cssselect.parser
 
+from pypfop.instrumentation import instrumentation
 
-def _translate_stylesheet(stylesheet, translator):
+
+def _translate_stylesheet_rules(stylesheet, translator):
     for rule in stylesheet.cssRules:
         # If is an import rule, the generator is going to be recursive!
         if isinstance(rule, cssutils.css.CSSImportRule):
-            for trans_rule in \
-              _translate_stylesheet(rule.styleSheet, translator):
+            if rule.styleSheet is None:
+                continue
+            for trans_rule in _translate_stylesheet_rules(
+                    rule.styleSheet, translator):
                 yield trans_rule
         elif isinstance(rule, cssutils.css.CSSStyleRule):
-            selector = rule.selectorText
-            xsel = translator.css_to_xpath(selector)
-            yield (xsel, {prop.name: prop.value
-                          for prop in rule.style.getProperties()})
+            properties = rule.style.getProperties()
+            style = {prop.name: prop.value for prop in properties}
+            important = frozenset(prop.name for prop in properties
+                                  if prop.priority == 'important')
+            # each selector of the group has its own specificity.
+            for selector in rule.selectorList:
+                selector = selector.selectorText
+                xsel = translator.css_to_xpath(selector)
+                yield (selector, xsel, style, important)
 
 
-def _apply_css_sheets(xmlstring, *sheets):
-    tree = lxml.etree.fromstring(xmlstring)
-    final_rules = translate_css_to_xpath(*sheets)
-    for (xsel, attribs) in final_rules:
-        for elem in tree.xpath(xsel):
-            for name, value in attribs.items():
-                elem.attrib[name] = value
+def _translate_stylesheet(stylesheet, translator):
+    for (_, xsel, style, _) in \
+      _translate_stylesheet_rules(stylesheet, translator):
+        yield (xsel, style)
+
+
+CompiledRule = collections.namedtuple(
+    'CompiledRule', ('selector', 'xpath', 'compiled', 'style',
+                     'matcher', 'keys', 'exact', 'ancestor_keys',
+                     'held_tags', 'positional_tags', 'specificity',
+                     'important')
+)
+CompiledRule.__doc__ = """Rule of a style sheet with its precompiled XPath.
+
+`compiled` selects the matching elements of a whole tree and `matcher`
+tests a single element, it is only true if the element matches (it is
+a python function for the common selectors or else an XPath).
+`keys` are the rightmost simple selectors of the rule, the keys of the
+rule on a `RuleIndex` (``#id``, ``.class``, the tag or ``*``), if the
+rule is `exact` an element found by one of them always matches.
+`ancestor_keys` has, for each selector of the rule, the keys that the
+ancestors of an element must have to match it.
+`held_tags` are the tags of the elements whose match depends on their
+content or their following siblings and `positional_tags` the ones
+that depend on their preceding siblings.
+`specificity` is the ``(ids, classes, tags)`` of the selector and
+`important` the names of the properties of `style` marked as
+``!important``. The rules of a group of selectors are compiled
+separately, one per selector.
+"""
+
+_SheetEntry = collections.namedtuple(
+    '_SheetEntry', ('dependencies', 'rules', 'digest')
+)
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _imported_paths(stylesheet):
+    """Yield the local file paths of all the style sheets imported
+    (directly or not) by `stylesheet`.
+    """
+    for rule in stylesheet.cssRules:
+        if isinstance(rule, cssutils.css.CSSImportRule) \
+          and rule.styleSheet is not None:
+            url = urlparse(rule.styleSheet.href or '')
+            if url.scheme in ('', 'file'):
+                yield url2pathname(url.path)
+            for path in _imported_paths(rule.styleSheet):
+                yield path
+
+
+# Pseudo-classes that depend on the content of the element.
+_CONTENT_PSEUDOS = frozenset(('empty', 'contains', 'has'))
+# Test of the left side of each combinator, relative to the element
+# matched by the right side.
+_COMBINATOR_AXES = {
+    ' ': 'ancestor::*[{}]',
+    '>': 'parent::*[{}]',
+    '+': 'preceding-sibling::*[1][{}]',
+    '~': 'preceding-sibling::*[{}]',
+}
+
+
+def _pseudo_names(node):
+    """Return the names of the pseudo-classes used on the compound
+    selector `node`, including the nested ones (like in ``:not()``).
+    """
+    names = set()
+    if isinstance(node, cssselect.parser.Selector):
+        node = node.parsed_tree
+    if isinstance(node, cssselect.parser.Pseudo):
+        names.add(node.ident.lower())
+    elif isinstance(node, cssselect.parser.Function):
+        names.add(node.name.lower())
+    elif isinstance(node, cssselect.parser.Relation):
+        names.add('has')
+        for _, argument in node.arguments:
+            names |= _pseudo_names(argument)
+    for name in ('selector', 'subselector'):
+        child = getattr(node, name, None)
+        if child is not None and not isinstance(child, str):
+            names |= _pseudo_names(child)
+    for child in getattr(node, 'selector_list', ()):
+        names |= _pseudo_names(child)
+    return names
+
+
+def _analyze_compound(compound, translator, held_tags, positional_tags):
+    xpath = translator.xpath(compound)
+    tag = xpath.element
+    tests = [] if tag == '*' else ['self::{}'.format(tag)]
+    if xpath.condition:
+        tests.append('({})'.format(xpath.condition))
+    if 'following-sibling' in xpath.condition or \
+       _pseudo_names(compound) & _CONTENT_PSEUDOS:
+        held_tags.add(tag)
+    if 'preceding-sibling' in xpath.condition:
+        positional_tags.add(tag)
+    return ' and '.join(tests) or 'true()', tag
+
+
+def _analyze_selector(tree, translator, held_tags, positional_tags):
+    """Return the XPath test of the parsed selector `tree` relative to
+    the element to match and the tag of its rightmost compound.
+    """
+    if not isinstance(tree, cssselect.parser.CombinedSelector):
+        return _analyze_compound(
+            tree, translator, held_tags, positional_tags
+        )
+    test, tag = _analyze_compound(
+        tree.subselector, translator, held_tags, positional_tags
+    )
+    left_test, _ = _analyze_selector(
+        tree.selector, translator, held_tags, positional_tags
+    )
+    if tree.combinator in '+~':
+        positional_tags.add(tag)
+    return '({}) and {}'.format(
+        test, _COMBINATOR_AXES[tree.combinator].format(left_test)
+    ), tag
+
+
+def _compound_keys(compound, attributes=False):
+    """Return the keys (``#id``, ``.class``, the tag and, with
+    `attributes`, ``[name`` for the attributes that must be present) of
+    the simple selectors of `compound` and the number of the rest of them.
+    """
+    keys, others = [], 0
+    node = compound
+    while not isinstance(node, cssselect.parser.Element):
+        if isinstance(node, cssselect.parser.Hash):
+            keys.append('#' + node.id)
+        elif isinstance(node, cssselect.parser.Class):
+            keys.append('.' + node.class_name)
+        elif attributes and isinstance(node, cssselect.parser.Attrib) \
+                and node.namespace is None and node.operator != '!=':
+            keys.append('[' + node.attrib)
+        else:
+            others += 1
+        node = node.selector
+    if node.namespace is not None:
+        others += 1
+    elif node.element is not None:
+        keys.append(node.element)
+    return keys, others
+
+
+def _element_keys(elem):
+    """Return the keys of `elem` that can match `_compound_keys`."""
+    keys = [elem.tag]
+    keys.extend('[' + name for name in elem.attrib.keys())
+    elem_id = elem.get('id')
+    if elem_id is not None:
+        keys.append('#' + elem_id)
+    classes = elem.get('class')
+    if classes:
+        keys.extend('.' + class_name for class_name in classes.split())
+    return keys
+
+
+def _index_key(tree):
+    """Return the key on a `RuleIndex` of the rightmost compound of the
+    parsed selector `tree`, and whether the key is all the compound.
+    """
+    if isinstance(tree, cssselect.parser.CombinedSelector):
+        return _index_key(tree.subselector)[0], False
+    keys, others = _compound_keys(tree)
+    exact = len(keys) <= 1 and not others
+    for prefix in ('#', '.'):
+        for key in keys:
+            if key.startswith(prefix):
+                return key, exact
+    return (keys or ['*'])[0], exact
+
+
+def _ancestor_keys(tree):
+    """Return the keys that the ancestors of an element must have for
+    the element to match the parsed selector `tree`.
+    """
+    required = set()
+    while isinstance(tree, cssselect.parser.CombinedSelector):
+        left = tree.selector
+        if tree.combinator in ' >':
+            if isinstance(left, cssselect.parser.CombinedSelector):
+                compound = left.subselector
+            else:
+                compound = left
+            required.update(_compound_keys(compound, attributes=True)[0])
+        # with "+" and "~" the left side is a sibling, the ancestors
+        # of its left side are still ancestors of the element.
+        tree = left
+    return frozenset(required)
+
+
+class _Unsupported(Exception):
+    """The selector can't be compiled to a predicate, use its XPath."""
+
+
+def _preceding_count(elem, tag=None):
+    """Count the preceding sibling elements of `elem` (with `tag`)."""
+    count = 0
+    sibling = elem.getprevious()
+    while sibling is not None:
+        if sibling.tag == tag or \
+           (tag is None and isinstance(sibling.tag, str)):
+            count += 1
+        sibling = sibling.getprevious()
+    return count
+
+
+def _following_count(elem, tag=None):
+    """Count the following sibling elements of `elem` (with `tag`)."""
+    count = 0
+    sibling = elem.getnext()
+    while sibling is not None:
+        if sibling.tag == tag or \
+           (tag is None and isinstance(sibling.tag, str)):
+            count += 1
+        sibling = sibling.getnext()
+    return count
+
+
+def _is_first(elem, tag=None):
+    sibling = elem.getprevious()
+    while sibling is not None:
+        if sibling.tag == tag or \
+           (tag is None and isinstance(sibling.tag, str)):
+            return False
+        sibling = sibling.getprevious()
+    return True
+
+
+def _is_last(elem, tag=None):
+    sibling = elem.getnext()
+    while sibling is not None:
+        if sibling.tag == tag or \
+           (tag is None and isinstance(sibling.tag, str)):
+            return False
+        sibling = sibling.getnext()
+    return True
+
+
+def _series_test(arguments):
+    """Return a test of the count of siblings for the `an+b` series."""
+    try:
+        a, b = cssselect.parser.parse_series(arguments)
+    except ValueError:
+        raise _Unsupported()
+    if a == 0:
+        return lambda count: count == b - 1
+    return lambda count: (count - b + 1) % a == 0 and \
+        (count - b + 1) * a >= 0
+
+
+def _attrib_predicate(node):
+    if node.namespace or getattr(node, 'flag', None):
+        raise _Unsupported()
+    name, operator = node.attrib, node.operator
+    value = None if node.value is None else node.value.value
+    if operator == 'exists':
+        return lambda elem: elem.get(name) is not None
+    if operator == '=':
+        return lambda elem: elem.get(name) == value
+    if operator == '!=':
+        return lambda elem: elem.get(name) != value
+    if operator == '~=':
+        if not value or any(char.isspace() for char in value):
+            return lambda elem: False
+        return lambda elem: value in (elem.get(name) or '').split()
+    if operator == '|=':
+        return lambda elem: elem.get(name) is not None and (
+            elem.get(name) == value or
+            elem.get(name).startswith(value + '-'))
+    if not value:
+        return lambda elem: False
+    method = {'^=': 'startswith', '$=': 'endswith', '*=': '__contains__'}
+    if operator not in method:
+        raise _Unsupported()
+    method = method[operator]
+    return lambda elem: getattr(elem.get(name) or '', method)(value) \
+        if elem.get(name) is not None else False
+
+
+def _simple_predicate(node, tag):
+    """Return the predicate of the simple selector `node` of a compound
+    selector whose element is `tag` (None for any).
+    """
+    if isinstance(node, cssselect.parser.Class):
+        class_name = node.class_name
+        return lambda elem: class_name in (elem.get('class') or '').split()
+    if isinstance(node, cssselect.parser.Hash):
+        elem_id = node.id
+        return lambda elem: elem.get('id') == elem_id
+    if isinstance(node, cssselect.parser.Attrib):
+        return _attrib_predicate(node)
+    if isinstance(node, cssselect.parser.Negation):
+        negated = _selector_predicate(node.subselector)
+        return lambda elem: not negated(elem, None)
+    if isinstance(node, cssselect.parser.Pseudo):
+        ident = node.ident.lower()
+        of_type = tag
+        if ident == 'root':
+            return lambda elem: elem.getparent() is None
+        if ident == 'first-child':
+            return _is_first
+        if ident == 'last-child':
+            return _is_last
+        if ident == 'only-child':
+            return lambda elem: _is_first(elem) and _is_last(elem)
+        if ident == 'first-of-type':
+            return lambda elem: _is_first(elem, of_type)
+        if ident == 'last-of-type':
+            return lambda elem: _is_last(elem, of_type)
+        if ident == 'only-of-type':
+            return lambda elem: _is_first(elem, of_type) and \
+                _is_last(elem, of_type)
+    if isinstance(node, cssselect.parser.Function):
+        name = node.name.lower()
+        of_type = tag
+        if name in ('nth-child', 'nth-last-child',
+                    'nth-of-type', 'nth-last-of-type'):
+            test = _series_test(node.arguments)
+            count = _following_count if 'last' in name else _preceding_count
+            if name.endswith('child'):
+                return lambda elem: test(count(elem))
+            return lambda elem: test(count(elem, of_type))
+    raise _Unsupported()
+
+
+def _compound_predicate(compound):
+    tests = []
+    node = compound
+    while not isinstance(node, cssselect.parser.Element):
+        tests.append(node)
+        node = node.selector
+    if node.namespace is not None:
+        raise _Unsupported()
+    tag = node.element
+    tests = [_simple_predicate(test, tag) for test in reversed(tests)]
+    if tag is not None:
+        tests.insert(0, lambda elem: elem.tag == tag)
+    if not tests:
+        return lambda elem: True
+    return functools.reduce(_both, tests)
+
+
+def _both(first, second):
+    return lambda elem: first(elem) and second(elem)
+
+
+def _previous_element(elem):
+    sibling = elem.getprevious()
+    while sibling is not None and not isinstance(sibling.tag, str):
+        sibling = sibling.getprevious()
+    return sibling
+
+
+def _memoized(memo, key, compute):
+    """Return the result of `compute()` memoized on `memo` by `key`,
+    it is only computed if `memo` is None.
+    """
+    if memo is None:
+        return compute()
+    result = memo.get(key)
+    if result is None:
+        result = memo[key] = compute()
+    return result
+
+
+def _selector_predicate(tree):
+    """Compile the parsed selector `tree` to a function that tells if
+    an element matches it, like the XPath of cssselect does.
+
+    The function is called with the element and a `memo` dictionary (or
+    None) where the matches of the ancestors are kept, the elements that
+    share them (like the cells of a row) test them only once.
+    """
+    if not isinstance(tree, cssselect.parser.CombinedSelector):
+        compound = _compound_predicate(tree)
+        return lambda elem, memo: compound(elem)
+    right = _compound_predicate(tree.subselector)
+    left = _selector_predicate(tree.selector)
+    combinator = tree.combinator
+    if combinator == ' ':
+        def has_ancestor(elem, memo):
+            parent = elem.getparent()
+            return parent is not None and _memoized(
+                memo, (has_ancestor, parent),
+                lambda: left(parent, memo) or has_ancestor(parent, memo)
+            )
+        return lambda elem, memo: right(elem) and has_ancestor(elem, memo)
+    if combinator == '>':
+        def match(elem, memo):
+            if not right(elem):
+                return False
+            parent = elem.getparent()
+            return parent is not None and _memoized(
+                memo, (left, parent), lambda: left(parent, memo)
+            )
+    elif combinator == '+':
+        def match(elem, memo):
+            if not right(elem):
+                return False
+            previous = _previous_element(elem)
+            return previous is not None and left(previous, memo)
+    elif combinator == '~':
+        return lambda elem, memo: right(elem) and any(
+            left(sibling, memo) for sibling
+            in elem.itersiblings(lxml.etree.Element, preceding=True)
+        )
+    else:
+        raise _Unsupported()
+    return match
+
+
+def _group_matcher(parsed_selectors, tests):
+    """Return the matcher of the group of `parsed_selectors`, a python
+    predicate if possible or else the XPath of the `tests`. It is called
+    with the element and, optionally, the `memo` of `_selector_predicate`.
+    """
+    try:
+        predicates = [_selector_predicate(parsed.parsed_tree)
+                      for parsed in parsed_selectors]
+    except _Unsupported:
+        xpath = lxml.etree.XPath('self::*[{}]'.format(' or '.join(tests)))
+        return lambda elem, memo=None: bool(xpath(elem))
+    if len(predicates) == 1:
+        predicate = predicates[0]
+        return lambda elem, memo=None: predicate(elem, memo)
+    return lambda elem, memo=None: any(
+        predicate(elem, memo) for predicate in predicates
+    )
+
+
+def _analyze_selector_group(selector, translator):
+    """Return the `matcher`, `keys`, `exact`, `ancestor_keys`, `held_tags`,
+    `positional_tags` and `specificity` of a `CompiledRule` with the css
+    `selector` (the highest specificity, if it is a group).
+    """
+    tests, keys, exact, ancestor_keys = [], set(), True, []
+    held_tags, positional_tags = set(), set()
+    parsed_selectors = cssselect.parse(selector)
+    for parsed in parsed_selectors:
+        test, _ = _analyze_selector(
+            parsed.parsed_tree, translator, held_tags, positional_tags
+        )
+        tests.append('({})'.format(test))
+        key, exact_key = _index_key(parsed.parsed_tree)
+        keys.add(key)
+        exact = exact and exact_key
+        ancestor_keys.append(_ancestor_keys(parsed.parsed_tree))
+    matcher = _group_matcher(parsed_selectors, tests)
+    specificity = max(parsed.specificity() for parsed in parsed_selectors)
+    return (matcher, frozenset(keys), exact, tuple(ancestor_keys),
+            frozenset(held_tags), frozenset(positional_tags), specificity)
+
+
+def _compile_stylesheet(sheet_path, translator):
+    dependencies = [(sheet_path, _file_signature(sheet_path))]
+    stylesheet = cssutils.parseFile(sheet_path)
+    for path in _imported_paths(stylesheet):
+        try:
+            dependencies.append((path, _file_signature(path)))
+        except OSError:
+            # a missing import, cssutils already complained about it,
+            # check it again on the next lookup.
+            dependencies.append((path, None))
+    rules = [
+        CompiledRule(selector, xsel, lxml.etree.XPath(xsel), style,
+                     *_analyze_selector_group(selector, translator),
+                     important=important)
+        for (selector, xsel, style, important)
+        in _translate_stylesheet_rules(stylesheet, translator)
+    ]
+    digest = hashlib.sha256()
+    for rule in rules:
+        digest.update(repr(
+            (rule.selector, rule.style, sorted(rule.important))
+        ).encode('utf-8'))
+    return _SheetEntry(tuple(dependencies), tuple(rules), digest.hexdigest())
+
+
+def _is_fresh(dependencies):
+    for path, signature in dependencies:
+        try:
+            if _file_signature(path) != signature:
+                return False
+        except OSError:
+            if signature is not None:
+                return False
+    return True
+
+
+class StylesheetCache:
+    """Process-wide LRU cache of compiled style sheets.
+
+    Each entry is keyed by the absolute path of the sheet and holds
+    the translated rules with their precompiled XPath expressions,
+    including the rules of the `@import` chain. The entry is dropped
+    and compiled again as soon as the modification time or size of the
+    sheet, or of any of its imports, changes on disk.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._translator = cssselect.GenericTranslator()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, sheet_path):
+        """Return the tuple of `CompiledRule` defined on `sheet_path`."""
+        return self._get_entry(sheet_path).rules
+
+    def digest(self, sheet_path):
+        """Return a hash of the rules defined on `sheet_path`,
+        it changes only if the resolved rules change.
+        """
+        return self._get_entry(sheet_path).digest
+
+    def _get_entry(self, sheet_path):
+        key = os.path.abspath(sheet_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if _is_fresh(entry.dependencies):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                del self._entries[key]
+            self.misses += 1
+        entry = _compile_stylesheet(key, self._translator)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+stylesheet_cache = StylesheetCache()
+
+
+_Candidates = collections.namedtuple(
+    '_Candidates', ('rules', 'static', 'dynamic', 'style')
+)
+
+
+class RuleIndex:
+    """The `CompiledRule` of the style sheets indexed by their `keys`
+    (the rightmost id, class or tag of their selectors).
+
+    `apply` styles an element testing only the rules that can match it,
+    instead of querying the whole tree once per rule. When the keys of
+    the ancestors of the element are given (check `ancestors_of`) the
+    rules that require other ancestors are skipped without testing them.
+
+    The declarations of the matched rules are resolved as a cascade:
+    ``!important`` first, then the highest specificity and then the last
+    one on the sheets. The computed styles are memoized by the matched
+    rules and, when the candidates of an element don't need any test,
+    by its tag, class, id and ancestor keys, so the thousands of equal
+    cells of a table are resolved with a single lookup. The inherited
+    properties are left to the FO processor, they are not copied to
+    the descendants.
+    """
+    # Bound of the memos of the candidates by (tag, class, id), of the
+    # computed styles and of the matches of the ancestors.
+    max_memo = 4096
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._buckets = collections.defaultdict(list)
+        self.ancestor_vocabulary = set()
+        for order, rule in enumerate(self.rules):
+            for key in rule.keys:
+                self._buckets[key].append(order)
+            for keys in rule.ancestor_keys:
+                self.ancestor_vocabulary |= keys
+        self._universal = self._buckets.pop('*', [])
+        self._memo = {}
+        self._styles = {}
+        self._matches = {}
+        self.hits = self.misses = 0
+
+    def ancestors_of(self, parent_ancestors, parent):
+        """Return the ancestor keys of the children of `parent`, given the
+        ones of `parent` (an empty frozenset for the root).
+        """
+        keys = self.ancestor_vocabulary.intersection(_element_keys(parent))
+        if keys <= parent_ancestors:
+            return parent_ancestors
+        return parent_ancestors | keys
+
+    def _candidates(self, elem, held, ancestors):
+        classes = elem.get('class')
+        elem_id = elem.get('id')
+        memo_key = (elem.tag, classes, elem_id, held, ancestors)
+        candidates = self._memo.get(memo_key)
+        if candidates is not None:
+            return candidates, True
+        orders = set(self._universal)
+        orders.update(self._buckets.get(elem.tag, ()))
+        if elem_id is not None:
+            orders.update(self._buckets.get('#' + elem_id, ()))
+        if classes:
+            for class_name in classes.split():
+                orders.update(self._buckets.get('.' + class_name, ()))
+        rules, static, dynamic = [], [], []
+        for order in sorted(orders):
+            rule = self.rules[order]
+            if not held and rule.held_tags:
+                continue
+            if ancestors is not None and not any(
+                    keys <= ancestors for keys in rule.ancestor_keys):
+                continue
+            rules.append(rule)
+            if rule.exact:
+                static.append(order)
+            else:
+                dynamic.append((order, rule))
+        static = tuple(static)
+        style = None if dynamic else self.computed_style(static)
+        candidates = _Candidates(rules, static, dynamic, style)
+        if len(self._memo) >= self.max_memo:
+            self._memo.clear()
+        self._memo[memo_key] = candidates
+        return candidates, False
+
+    def candidates(self, elem, held=True, ancestors=None):
+        """Return the rules, in source order, that can match `elem`.
+        Unless `held`, the rules with `held_tags` are left out.
+        """
+        return self._candidates(elem, held, ancestors)[0].rules
+
+    def computed_style(self, orders):
+        """Return the style resolved from the rules of the `orders`
+        (their positions on `rules`, ascending).
+        """
+        style = self._styles.get(orders)
+        if style is not None:
+            self.hits += 1
+            return style
+        self.misses += 1
+        winners = {}
+        for order in orders:
+            rule = self.rules[order]
+            for name, value in rule.style.items():
+                rank = (name in rule.important, rule.specificity, order)
+                if name not in winners or winners[name][0] < rank:
+                    winners[name] = (rank, value)
+        # in the order of the first declaration of each property.
+        style = {name: value for name, (_, value) in winners.items()}
+        if len(self._styles) >= self.max_memo:
+            self._styles.clear()
+        self._styles[orders] = style
+        return style
+
+    def apply(self, elem, held=True, ancestors=None):
+        """Set on `elem` its computed style."""
+        candidates, cached = self._candidates(elem, held, ancestors)
+        style = candidates.style
+        if style is None:
+            if len(self._matches) >= self.max_memo:
+                self._matches.clear()
+            matched = [order for order, rule in candidates.dynamic
+                       if rule.matcher(elem, self._matches)]
+            if matched:
+                orders = tuple(sorted(candidates.static + tuple(matched)))
+            else:
+                orders = candidates.static
+            style = self.computed_style(orders)
+        elif cached:
+            self.hits += 1
+        if style:
+            elem.attrib.update(style)
+
+
+# Below this number of rules the XPath query of each rule on the whole
+# tree (`_inline_css_by_rule`) is faster than the walk of the tree with
+# the `RuleIndex` (`_inline_css_indexed`), check ``pypfop.bench``.
+INDEX_MIN_RULES = 24
+
+
+def _inline_css(tree, sheets, skip=None):
+    """Apply the styles of `sheets` to the elements of `tree`, except
+    the ones on `skip` (the spliced fragments, which are already styled),
+    with the faster engine for the number of rules of the sheets.
+    """
+    rules = compile_css_sheets(*sheets)
+    instrumentation.annotate(rules=len(rules))
+    if len(rules) < INDEX_MIN_RULES:
+        return _inline_css_by_rule(tree, sheets, skip, rules)
+    return _inline_css_indexed(tree, sheets, skip, rules)
+
+
+def _inline_css_indexed(tree, sheets, skip=None, rules=None):
+    """Apply the styles walking `tree` once, each element is tested only
+    against the rules of the `RuleIndex` that can match it.
+    """
+    if rules is None:
+        rules = compile_css_sheets(*sheets)
+    index = RuleIndex(rules)
+    with_class = []
+    ancestors = [frozenset()]
+    for event, elem in lxml.etree.iterwalk(tree, events=('start', 'end')):
+        if event == 'end':
+            ancestors.pop()
+            continue
+        if skip and elem in skip:
+            ancestors.append(ancestors[-1])
+            continue
+        index.apply(elem, ancestors=ancestors[-1])
+        if len(elem):
+            ancestors.append(index.ancestors_of(ancestors[-1], elem))
+        else:
+            ancestors.append(ancestors[-1])
+        if 'class' in elem.attrib:
+            with_class.append(elem)
     # After the styles related to the class has been inlined,
     # remove the class attribute to be a valid FO.
+    for elem in with_class:
+        del elem.attrib['class']
+    return tree
+
+
+def _inline_css_by_rule(tree, sheets, skip=None, rules=None):
+    """Apply the styles running the XPath query of each rule on the whole
+    tree, the matches of each element are resolved with the same cascade
+    of `RuleIndex.computed_style`. It is the faster engine for the small
+    style sheets.
+    """
+    if rules is None:
+        rules = compile_css_sheets(*sheets)
+    index = RuleIndex(rules)
+    matches = collections.OrderedDict()
+    for order, rule in enumerate(rules):
+        for elem in rule.compiled(tree):
+            matches.setdefault(elem, []).append(order)
+    for elem, orders in matches.items():
+        if skip and elem in skip:
+            continue
+        style = index.computed_style(tuple(orders))
+        if style:
+            elem.attrib.update(style)
     for elem_with_class in tree.xpath('descendant-or-self::*[@class]'):
-        del elem_with_class.attrib['class']
+        if not (skip and elem_with_class in skip):
+            del elem_with_class.attrib['class']
+    return tree
+
+
+def _apply_css_sheets(xmlstring, *sheets):
+    tree = _inline_css_by_rule(lxml.etree.fromstring(xmlstring), sheets)
     return lxml.etree.tostring(tree)
 
 
+def _fo_element(elem, prebuilt=None, serialized=None):
+    """Build the `fo:` tagged ElementTree copy of the lxml `elem`.
+
+    Comments and processing instructions are dropped and their tails
+    merged into the surrounding text, just like the `XMLParser` used
+    by `translate_to_fo` does.
+
+    The elements on `prebuilt` (the cached fragments) are replaced by
+    their already built ``(foelem, xml)``: with a `serialized` list,
+    by a `_FRAGMENT_TAG` element and their `xml` is appended to the
+    list, to be spliced by `_serialize_fo`, otherwise by a copy of
+    `foelem`, which shares its children.
+    """
+    foelem = _fofactory(elem.tag, dict(elem.attrib))
+    foelem.text = elem.text
+    previous = None
+    for child in elem:
+        if prebuilt and child in prebuilt:
+            cached, xml = prebuilt[child]
+            if serialized is not None and xml is not None:
+                previous = ElementTree.Element(_FRAGMENT_TAG)
+                serialized.append(xml)
+            else:
+                # only the tail of the copy is modified.
+                previous = copy.copy(cached)
+            previous.tail = child.tail
+            foelem.append(previous)
+        elif isinstance(child.tag, str):
+            previous = _fo_element(child, prebuilt, serialized)
+            previous.tail = child.tail
+            foelem.append(previous)
+        elif child.tail:
+            if previous is None:
+                foelem.text = (foelem.text or '') + child.tail
+            else:
+                previous.tail = (previous.tail or '') + child.tail
+    return foelem
+
+
 def _fofactory(tag, attribs):
     """
     Factory to create each element with the fo: namespace.
@@ -51,13 +866,50 @@ def _foname(tag):
     return 'fo:{}'.format(tag)
 
 
-def translate_css_to_xpath(*sheets):
-    gtrans = cssselect.GenericTranslator()
-    xpath_n_styles = []  # using a list, to be hable to "cascade".
+def compile_css_sheets(*sheets):
+    """Return the list of `CompiledRule` of all the `sheets` in
+    cascade order, the sheets are looked up on the `stylesheet_cache`.
+    """
+    rules = []  # using a list, to be hable to "cascade".
     for sheet_path in sheets:
-        stylesheet = cssutils.parseFile(sheet_path)
-        xpath_n_styles.extend(_translate_stylesheet(stylesheet, gtrans))
-    return xpath_n_styles
+        rules.extend(stylesheet_cache.get(sheet_path))
+    return rules
+
+
+def translate_css_to_xpath(*sheets):
+    return [(rule.xpath, dict(rule.style))
+            for rule in compile_css_sheets(*sheets)]
+
+
+# Tag of the place of the serialized fragments, it is never a valid
+# xml name, so it can't be on the output of any document.
+_FRAGMENT_TAG = '\0'
+_FRAGMENT_MARK = b'<\0 />'
+
+
+def _serialize_fragment(foelem):
+    """Return the serialization of the cached fragment `foelem`, or None
+    if it uses any namespace, which is declared on the root element.
+    """
+    for elem in foelem.iter():
+        if elem.tag.startswith('{') or \
+                any(name.startswith('{') for name in elem.attrib):
+            return None
+    return ElementTree.tostring(foelem)
+
+
+def _serialize_fo(foroot, encoding, serialized=None):
+    foroot.attrib['xmlns:fo'] = 'http://www.w3.org/1999/XSL/Format'
+    if encoding is None:
+        encoding = sys.getdefaultencoding()
+    doctype = '<?xml version="1.1" encoding="%s"?>\n' % encoding
+    body = ElementTree.tostring(foroot)
+    if serialized:
+        parts = body.split(_FRAGMENT_MARK)
+        body = b''.join(itertools.chain.from_iterable(
+            zip(parts, serialized + [b''])
+        ))
+    return b''.join((doctype.encode(encoding), body))
 
 
 def translate_to_fo(xmlstring, encoding):
@@ -65,24 +917,434 @@ def translate_to_fo(xmlstring, encoding):
     builder = FOBuilder(_fofactory)
     fop_parser_creator = ElementTree.XMLParser(target=builder)
     fop_parser_creator.feed(xmlstring)
-    foroot = fop_parser_creator.close()
-    foroot.attrib['xmlns:fo'] = 'http://www.w3.org/1999/XSL/Format'
-    if encoding is None:
-        encoding = sys.getdefaultencoding()
-    doctype = '<?xml version="1.1" encoding="%s"?>\n' % encoding
-    return b''.join((doctype.encode(encoding), ElementTree.tostring(foroot)))
+    return _serialize_fo(fop_parser_creator.close(), encoding)
 
 
-def xml_to_fo_with_style(xmlstring, csssheets, encoding=None):
-    if csssheets is not None:
-        if isinstance(csssheets, str):
-            xmlstring = _apply_css_sheets(xmlstring, csssheets)
-        else:  # asume it is an iterator with sheets.
-            xmlstring = _apply_css_sheets(xmlstring, *csssheets)
-    return translate_to_fo(xmlstring, encoding)
+# The elements that reference external resources, by their `src`.
+_GRAPHIC_TAGS = ('external-graphic',
+                 '{http://www.w3.org/1999/XSL/Format}external-graphic')
+_URI_SPECIFICATION_RE = re.compile(r'\s*url\(\s*([\'"]?)(.*?)\1\s*\)\s*$',
+                                   re.DOTALL)
+
+
+def _resolve_source(elem, resources):
+    """Replace the `src` of `elem` by its local reference on the
+    `resources` cache, if it has one.
+    """
+    src = elem.get('src')
+    if not src:
+        return
+    match = _URI_SPECIFICATION_RE.match(src)
+    local = resources.resolve(match.group(2) if match else src.strip())
+    if local is not None:
+        elem.set('src', "url('{}')".format(local))
+
+
+def resolve_resources(tree, resources):
+    """Point the `external-graphic` elements of the lxml `tree` to the
+    local copies (files or ``data:`` URIs) of their resources, fetched
+    through the `resources` cache (check `pypfop.cache.ResourceCache`),
+    so fop does not fetch them on each document.
+    """
+    with instrumentation.span('resources') as span:
+        count = 0
+        for elem in tree.iter(*_GRAPHIC_TAGS):
+            _resolve_source(elem, resources)
+            count += 1
+        span.set(resources=count)
+
+
+def xml_to_fo_with_style(xmlstring, csssheets, encoding=None,
+                         single_pass=True, fragments=None, resources=None):
+    """Apply the `csssheets` to `xmlstring` and translate it to XSL-FO.
+
+    By default the xml is parsed once and the styles, the removal of
+    the `class` attributes and the `fo:` tagging all work on that same
+    tree, which is serialized only once. With `single_pass=False` the
+    former pipeline, which applies the XPath query of each rule to the
+    whole tree (`_inline_css_by_rule`, whatever the number of rules) and
+    goes through an intermediate serialization and a second parse, is
+    used instead, as a reference; both produce the same output.
+
+    `fragments` is the `pypfop.fragments.FragmentScope` the xml was
+    rendered with, if any, its cached fragments are spliced on the
+    output and the new ones stored on its cache (it always uses the
+    single pass).
+
+    With a `resources` cache the external graphics are fetched through
+    it and referenced by their local copy, check `resolve_resources`
+    (it always uses the single pass).
+
+    `xmlstring` can also be an lxml element, like the ones returned by
+    the tree templates (check `pypfop.templates.TREE_OUTPUT`), which is
+    styled in place instead of parsed (it always uses the single pass).
+    """
+    if isinstance(csssheets, str):
+        csssheets = (csssheets, )
+    parsed = lxml.etree.iselement(xmlstring)
+    if not (single_pass or parsed) and fragments is None and \
+            resources is None:
+        if csssheets is not None:
+            # asume it is an iterator with sheets.
+            with instrumentation.span('css', bytes_in=len(xmlstring)):
+                xmlstring = _apply_css_sheets(xmlstring, *csssheets)
+        with instrumentation.span('fo', bytes_in=len(xmlstring)) as span:
+            xslfo = translate_to_fo(xmlstring, encoding)
+            span.set(bytes_out=len(xslfo))
+        return xslfo
+    prebuilt = None
+    with instrumentation.span('css') as span:
+        if parsed:
+            tree = xmlstring
+        else:
+            span.set(bytes_in=len(xmlstring))
+            tree = lxml.etree.fromstring(xmlstring)
+        if fragments is not None:
+            prebuilt = fragments.splice(tree)
+        if csssheets is not None:
+            _inline_css(tree, csssheets, prebuilt)
+    if resources is not None:
+        resolve_resources(tree, resources)
+    with instrumentation.span('fo') as span:
+        serialized = None
+        if fragments is not None:
+            fragments.capture(prebuilt)
+            serialized = []
+        xslfo = _serialize_fo(_fo_element(tree, prebuilt, serialized),
+                              encoding, serialized)
+        span.set(bytes_out=len(xslfo))
+    return xslfo
 
 
 class FOBuilder(ElementTree.TreeBuilder):
 
     def end(self, tag):
         ElementTree.TreeBuilder.end(self, _foname(tag))
+
+
+FO_NAMESPACE = 'http://www.w3.org/1999/XSL/Format'
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _escape_text(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def _escape_attrib(value):
+    value = _escape_text(value)
+    for char, entity in (('"', '&quot;'), ('\r', '&#13;'),
+                         ('\n', '&#10;'), ('\t', '&#09;')):
+        if char in value:
+            value = value.replace(char, entity)
+    return value
+
+
+class _OpenElement:
+    """State of an element of `StreamingFOConverter` that has started
+    but not yet ended.
+    """
+    __slots__ = ('elem', 'streamed', 'ancestors', 'text_written',
+                 'last_child', 'first_held', 'keep_children')
+
+    def __init__(self, elem, streamed, ancestors):
+        self.elem = elem
+        self.streamed = streamed
+        # ancestor keys of the children, check `RuleIndex.ancestors_of`.
+        self.ancestors = ancestors
+        self.text_written = False
+        # last child that has been written, without its tail.
+        self.last_child = None
+        # first child that has to wait for the end of this element.
+        self.first_held = None
+        self.keep_children = False
+
+
+class StreamingFOConverter:
+    """Incremental version of `xml_to_fo_with_style`.
+
+    The xml is given in chunks with `feed` (and ended with `close`) and
+    the XSL-FO, styled with `csssheets`, is written in chunks of about
+    `chunk_size` bytes with the `write` callable, as soon as possible.
+
+    Each element gets its styles when it starts and is written right
+    away, then it's dropped from memory. Only the elements that can match
+    a selector that depends on what comes after them (``:last-child``,
+    ``:empty`` and the like) are held, with their following siblings,
+    until their parent ends. The elements whose siblings can match a
+    selector that depends on the preceding siblings (``:nth-child()``,
+    ``+``, ``~``) are kept as empty placeholders until their parent ends,
+    from the sibling that precedes the first one of those elements on.
+
+    The result is equivalent to the one of `xml_to_fo_with_style`,
+    except that the rules are applied element by element instead of
+    rule by rule, a rule can't match an attribute set by another one.
+    The external graphics are resolved with the `resources` cache, if
+    any, as they are written.
+    """
+
+    def __init__(self, write, csssheets=None, encoding=None,
+                 chunk_size=STREAM_CHUNK_SIZE, resources=None):
+        if isinstance(csssheets, str):
+            csssheets = (csssheets, )
+        self.rules = compile_css_sheets(*(csssheets or ()))
+        # like `xml_to_fo_with_style`, the classes are kept without sheets.
+        self._strip_class = csssheets is not None
+        self.encoding = encoding or sys.getdefaultencoding()
+        self.chunk_size = chunk_size
+        self.resources = resources
+        self._write = write
+        self._index = RuleIndex(self.rules)
+        self._held_tags = set()
+        self._positional_tags = set()
+        for rule in self.rules:
+            self._held_tags |= rule.held_tags
+            self._positional_tags |= rule.positional_tags
+        self._parser = lxml.etree.XMLPullParser(
+            events=('start', 'end'), remove_comments=True, remove_pis=True
+        )
+        self._stack = []
+        self._root = None
+        self._buffer = []
+        self._buffered = 0
+        # the templates write tiny pieces, parse them in bigger chunks.
+        self._input = []
+        self._input_size = 0
+
+    def feed(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._input.append(data)
+        self._input_size += len(data)
+        if self._input_size >= self.chunk_size:
+            self._feed_input()
+
+    def _feed_input(self):
+        self._parser.feed(b''.join(self._input))
+        self._input = []
+        self._input_size = 0
+        self._handle_events()
+
+    def close(self):
+        self._feed_input()
+        self._parser.close()
+        self._handle_events()
+        if self._root is not None and not self._root.streamed:
+            # the root itself had to be held.
+            self._write_header()
+            self._write_held(self._root.elem, None, frozenset())
+        self._flush()
+
+    def _handle_events(self):
+        for event, elem in self._parser.read_events():
+            if event == 'start':
+                self._start(elem)
+            else:
+                self._end(elem)
+            if self._buffered >= self.chunk_size:
+                self._flush()
+
+    def _out(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+
+    def _flush(self):
+        if self._buffer:
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            self._write(data.encode(self.encoding, 'xmlcharrefreplace'))
+
+    def _matches(self, tags, tag):
+        return tag in tags or '*' in tags
+
+    def _start(self, elem):
+        parent = self._stack[-1] if self._stack else None
+        ancestors = frozenset() if parent is None else parent.ancestors
+        if parent is None:
+            streamed = not self._matches(self._held_tags, elem.tag)
+            frame = self._root = _OpenElement(elem, streamed, ancestors)
+        elif parent.streamed and parent.first_held is None:
+            if self._matches(self._positional_tags, elem.tag):
+                parent.keep_children = True
+            self._write_pending(parent)
+            streamed = not self._matches(self._held_tags, elem.tag)
+            frame = _OpenElement(elem, streamed, ancestors)
+            if not streamed:
+                parent.first_held = elem
+        else:
+            frame = _OpenElement(elem, False, ancestors)
+        if frame.streamed:
+            if parent is None:
+                self._write_header()
+            # the held elements are the only ones that can match
+            # the rules with held tags.
+            self._index.apply(elem, held=False, ancestors=ancestors)
+            self._write_start(elem, parent and parent.elem)
+        frame.ancestors = self._index.ancestors_of(ancestors, elem)
+        self._stack.append(frame)
+
+    def _end(self, elem):
+        frame = self._stack.pop()
+        if not frame.streamed:
+            return
+        self._write_pending(frame)
+        held = frame.first_held
+        if held is not None:
+            for child in [held] + list(held.itersiblings()):
+                self._write_held(child, elem, frame.ancestors)
+        self._out('</{}>'.format(self._qname(elem, elem.tag)))
+        if self._stack:
+            self._stack[-1].last_child = elem
+
+    def _write_pending(self, frame):
+        """Write the text of the element of `frame` and the tail of its
+        last written child, which are complete once a new child starts.
+        """
+        if not frame.text_written:
+            frame.text_written = True
+            if frame.elem.text:
+                self._out(_escape_text(frame.elem.text))
+        child = frame.last_child
+        if child is not None:
+            frame.last_child = None
+            if child.tail:
+                self._out(_escape_text(child.tail))
+            if frame.keep_children:
+                del child[:]
+                child.text = child.tail = None
+            else:
+                frame.elem.remove(child)
+
+    def _write_held(self, elem, parent, ancestors):
+        stack = [ancestors]
+        for event, subelem in lxml.etree.iterwalk(
+                elem, events=('start', 'end')):
+            if event == 'start':
+                self._index.apply(subelem, ancestors=stack[-1])
+                if len(subelem):
+                    stack.append(
+                        self._index.ancestors_of(stack[-1], subelem)
+                    )
+                else:
+                    stack.append(stack[-1])
+            else:
+                stack.pop()
+        self._write_tree(elem, parent)
+
+    def _write_tree(self, elem, parent):
+        self._write_start(elem, parent)
+        if elem.text:
+            self._out(_escape_text(elem.text))
+        for child in elem:
+            self._write_tree(child, elem)
+        self._out('</{}>'.format(self._qname(elem, elem.tag)))
+        if elem.tail and parent is not None:
+            self._out(_escape_text(elem.tail))
+
+    def _write_header(self):
+        self._out('<?xml version="1.1" encoding="{}"?>\n'
+                  .format(self.encoding))
+
+    def _qname(self, elem, name, attribute=False):
+        if name[0] != '{':
+            return name if attribute else 'fo:' + name
+        uri, local = name[1:].split('}', 1)
+        if uri == XML_NAMESPACE:
+            prefix = 'xml'
+        elif uri == FO_NAMESPACE:
+            prefix = 'fo'
+        elif not attribute:
+            prefix = elem.prefix
+        else:
+            prefix = next(prefix for (prefix, nsuri) in elem.nsmap.items()
+                          if nsuri == uri and prefix is not None)
+        return local if prefix is None else '{}:{}'.format(prefix, local)
+
+    def _write_start(self, elem, parent):
+        if self.resources is not None and elem.tag in _GRAPHIC_TAGS:
+            _resolve_source(elem, self.resources)
+        parts = ['<', self._qname(elem, elem.tag)]
+        if parent is None:
+            parts.append(' xmlns:fo="{}"'.format(FO_NAMESPACE))
+            parent_nsmap = {}
+        else:
+            parent_nsmap = parent.nsmap
+        for prefix, uri in elem.nsmap.items():
+            if prefix != 'fo' and parent_nsmap.get(prefix) != uri:
+                parts.append(' xmlns{}="{}"'.format(
+                    '' if prefix is None else ':' + prefix,
+                    _escape_attrib(uri)
+                ))
+        for name, value in elem.attrib.items():
+            if name != 'class' or not self._strip_class:
+                parts.append(' {}="{}"'.format(
+                    self._qname(elem, name, attribute=True),
+                    _escape_attrib(value)
+                ))
+        parts.append('>')
+        self._out(''.join(parts))
+
+
+class _StreamCancelled(Exception):
+    pass
+
+
+def iter_xml_to_fo_with_style(render, csssheets, encoding=None,
+                              max_pending=8, resources=None):
+    """Yield the XSL-FO, in chunks, of the xml written by `render`.
+
+    `render` is called with a `write` callable on which it writes the
+    xml in chunks (as str or bytes), it runs on a separate thread while
+    the XSL-FO is translated with a `StreamingFOConverter` and yielded.
+    No more than `max_pending` chunks wait to be consumed, the rendering
+    pauses until then. The errors of `render` or of the translation are
+    raised by the iterator, and closing the iterator stops the rendering.
+    The external graphics are resolved with the `resources` cache.
+    """
+    chunks = queue.Queue(max_pending)
+    cancelled = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise _StreamCancelled()
+
+    def produce():
+        try:
+            try:
+                converter = StreamingFOConverter(put, csssheets, encoding,
+                                                 resources=resources)
+                render(converter.feed)
+                converter.close()
+            except BaseException as error:
+                put(error)
+            else:
+                put(finished)
+        except _StreamCancelled:
+            pass
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is finished:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+        thread.join()
@@ -1,18 +1,86 @@
 import os
+import asyncio
 import logging
-import inspect
+import functools
 import itertools
-from sys import version_info
+import collections
 
-from pypfop.conversion import xml_to_fo_with_style
-from pypfop.builder import SubprocessBuilder, FopsBuilder
-from pypfop.exceptions import DocumentGeneratorError
+import lxml.etree
+
+from pypfop import batch, shards
+from pypfop.cache import document_key
+from pypfop.conversion import (
+    xml_to_fo_with_style, iter_xml_to_fo_with_style
+)
+from pypfop.builder import (
+    Builder, SubprocessBuilder, FopsBuilder, AsyncBuilder, AsyncFopsBuilder,
+    check_output, deliver, join_xslfo, OUTPUT_PATH, OUTPUT_BYTES,
+    OUTPUT_CHUNKS
+)
+from pypfop.exceptions import DocumentGeneratorError, TemplateError
+from pypfop.instrumentation import instrumentation
+from pypfop.templates import check_template, TREE_OUTPUT
 
 
 logger = logging.getLogger('pypfop')
+_dump_ids = itertools.count()
 
 OUTPUT_FORMATS = ('pdf', 'rtf', 'tiff', 'png', 'pcl', 'ps', 'txt')
 
+PreparedDocument = collections.namedtuple('PreparedDocument', ('xslfo', ))
+PreparedDocument.__doc__ = """XSL-FO of a document returned by
+`DocumentGenerator.prepare`, ready to be built in any format.
+"""
+
+
+def _debug_payload(payload, size):
+    """Return the first `size` characters of the xml or XSL-FO `payload`
+    to be logged.
+    """
+    if isinstance(payload, bytes):
+        text = payload[:size].decode('utf-8', 'replace')
+    else:
+        text = payload[:size]
+    if len(payload) > size:
+        text += '... ({} more)'.format(len(payload) - size)
+    return text
+
+
+class GeneratorLogAdapter(logging.LoggerAdapter):
+    """Log of a `DocumentGenerator`, it has its own `level` and adds the
+    generator to the `extra` of the records.
+
+    It replaces the former child logger per generator, which was kept
+    forever by the logging module.
+    """
+
+    def __init__(self, logger, extra, level=logging.NOTSET):
+        super().__init__(logger, extra)
+        self.level = level
+
+    def setLevel(self, level):
+        self.level = level
+
+    def getEffectiveLevel(self):
+        return self.level or self.logger.getEffectiveLevel()
+
+    def isEnabledFor(self, level):
+        if self.logger.manager.disable >= level:
+            return False
+        return level >= self.getEffectiveLevel()
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = dict(self.extra, **kwargs.get('extra') or {})
+        return msg, kwargs
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.isEnabledFor(level):
+            msg, kwargs = self.process(msg, kwargs)
+            # report the caller and not this method.
+            kwargs['stacklevel'] = kwargs.get('stacklevel', 1) + 1
+            # the level of the adapter was already checked.
+            self.logger._log(level, msg, args, **kwargs)
+
 
 class DocumentGenerator:
     """The primary way to generate a new document.
@@ -37,24 +105,41 @@ class DocumentGenerator:
     You can  define the `__template__` attribute
     on each subclass or pass it as a parameter on the __init__,
     the requirement for the template is that it needs to have a callable
-    property which accept two arguments (properties, format) that
-    will be translated by the renderer to a single string.
+    `render` property which accept the params and returns the xml as a
+    string or, with the ``'tree'`` output, as an lxml element (check
+    `pypfop.templates.Template`); it is checked once per type.
+
+    A generator can be shared by any number of threads: the params of
+    each call are merged with the `defparams` on a new dictionary (the
+    params of the caller are never modified, `copy_params` is only kept
+    for compatibility) and the rest of the state of the generator is
+    not modified after its creation.
     """
     __style_sheets__ = ()
     __style_dir__ = '.'
     __defparams__ = {}
     __template__ = None
+    # Characters of the xml and XSL-FO logged on debug.
+    debug_payload_size = 4096
 
     def __init__(self, template=None, stylesheets=(), out_format='pdf',
                  instparams=None, style_dir=None, fop_cmd=None,
-                 tempdir=None, builder=None, log_level=logging.INFO):
+                 tempdir=None, builder=None, log_level=logging.INFO,
+                 result_cache=None, debug_dir=None,
+                 fragment_cache=None, fo_schema=None,
+                 resource_cache=None):
         self._setup_log(log_level)
+        self.debug_dir = debug_dir
         self.style_dir = style_dir or self.__style_dir__
         self.template = self._check_template(template)
         self.out_format = self._check_out_format(out_format)
         self.defparams = self._get_instparams(instparams)
         self.ssheets = self._ssheets_with_abspath(stylesheets)
         self._setup_builder(fop_cmd, builder, tempdir)
+        self.result_cache = result_cache
+        self.fragment_cache = fragment_cache
+        self.fo_schema = fo_schema
+        self.resource_cache = resource_cache
 
     @classmethod
     def from_fops(cls, host='localhost', port=3000, *args, **kwargs):
@@ -64,6 +149,14 @@ class DocumentGenerator:
         kwargs['builder'] = FopsBuilder(host, port)
         return cls(*args, **kwargs)
 
+    @classmethod
+    def from_async_fops(cls, host='localhost', port=3000, *args, **kwargs):
+        """Like `from_fops` but using the `AsyncFopsBuilder`, to
+        generate the documents with `agenerate`.
+        """
+        kwargs['builder'] = AsyncFopsBuilder(host, port)
+        return cls(*args, **kwargs)
+
     def _setup_builder(self, fop_cmd, builder, tempdir):
         if builder:
             self.builder = builder
@@ -73,48 +166,44 @@ class DocumentGenerator:
             self.builder.tempdir = tempdir
 
     def _setup_log(self, log_level):
-        self.log = logger.getChild(
-            '{}.{}'.format(self.__class__.__name__, id(self))
+        self.log = GeneratorLogAdapter(
+            logger.getChild(self.__class__.__name__),
+            {'generator': '{}@{:x}'.format(self.__class__.__name__,
+                                           id(self))},
+            log_level
         )
-        self.log.propagate = True
-        self.log.setLevel(log_level)
+
+    def _debug(self, label, payload, dump_path=None):
+        """Log the xml or XSL-FO `payload` (truncated), or with a
+        `debug_dir` write it on `dump_path` and log the path instead.
+        The xml trees of the tree templates are serialized only then.
+        """
+        if lxml.etree.iselement(payload) and (
+                dump_path is not None or self.log.isEnabledFor(logging.DEBUG)):
+            payload = lxml.etree.tostring(payload)
+        if dump_path is not None:
+            with open(dump_path, 'wb') as dump:
+                if isinstance(payload, str):
+                    payload = payload.encode('utf-8')
+                dump.write(payload)
+            self.log.debug('%s dumped on %s', label, dump_path)
+        elif self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('%s: %s', label, _debug_payload(
+                payload, self.debug_payload_size
+            ))
 
     def _check_template(self, template):
-        # I wonder if this method really needs to be that pedantic...
-        if template is None and self.__template__ is None:
+        if template is None:
+            template = self.__template__
+        if template is None:
             raise DocumentGeneratorError(
                 "Cannot build {}, neither __template__ or template is set"
                 .format(self.__class__.__name__)
             )
-        if not (hasattr(template, 'render') and callable(template.render)):
-            raise DocumentGeneratorError(
-                'The template object {} does not implement '
-                'a callable "render" property (method)'.format(template)
-            )
-        expected_args = 1
-        if inspect.ismethod(template.render):
-            expected_args = 2
-        if version_info[0] >= 3 and version_info[1] >= 11: #Python Version >= 3.11
-            if len(inspect.getfullargspec(template.render).args) != expected_args:
-                raise DocumentGeneratorError(
-                    'The template object {} does not implement '
-                    'a 1 argument "render" property (method)'
-                    .format(template)
-                )
-        else:
-            if len(inspect.getargspec(template.render).args) != expected_args:
-                raise DocumentGeneratorError(
-                    'The template object {} does not implement '
-                    'a 1 argument "render" property (method)'
-                    .format(template)
-                )
-            return template    
-        if len(inspect.getfullargspec(template.render).args) != expected_args:
-            raise DocumentGeneratorError(
-                'The template object {} does not implement '
-                'a 1 argument "render" property (method)'
-                .format(template)
-            )
+        try:
+            self.template_output = check_template(template)
+        except TemplateError as error:
+            raise DocumentGeneratorError(str(error)) from error
         return template
 
     def _check_out_format(self, out_format):
@@ -133,33 +222,271 @@ class DocumentGenerator:
                 for sheet in itertools.chain(self.__style_sheets__, ssheets)]
 
     def _get_instparams(self, params):
-        if isinstance(params, dict) and params:
-            defparams = self.__defparams__.copy()
+        # a copy, the class attribute is shared by all the instances.
+        defparams = dict(self.__defparams__)
+        if isinstance(params, dict):
             defparams.update(params)
-            return defparams
-        else:
-            return self.__defparams__
-
-    def _generate_xslfo(self, params, copy_params):
-        if copy_params:
-            params = params.copy()
-        params.update(self.defparams)
-        xml = self.template.render(params)
-        self.log.debug('Generated XML: {}'.format(xml))
-        xslfo = xml_to_fo_with_style(xml, self.ssheets)
-        self.log.debug(
-            'Generated XSL-FO from xml_to_fo: {}'
-            .format(xslfo)
-        )
+        return defparams
+
+    def _merge_params(self, params):
+        """Return a new dictionary with the `params` of a document and
+        the `defparams`, which take precedence.
+        """
+        merged = dict(params)
+        merged.update(self.defparams)
+        return merged
+
+    def _generate_xslfo(self, params):
+        params = self._merge_params(params)
+        fragments = None
+        if self.fragment_cache is not None:
+            fragments = self.fragment_cache.scope(self.template, self.ssheets)
+        with instrumentation.span('render') as span:
+            if fragments is None:
+                xml = self.template.render(params)
+            else:
+                with fragments:
+                    xml = self.template.render(params)
+            if self.template_output != TREE_OUTPUT:
+                span.set(bytes_out=len(xml))
+        dump_path = None
+        if self.debug_dir is not None:
+            dump_path = os.path.join(self.debug_dir, 'pypfop-{}-{}'.format(
+                os.getpid(), next(_dump_ids)
+            ))
+        self._debug('Generated XML', xml, dump_path and dump_path + '.xml')
+        xslfo = xml_to_fo_with_style(xml, self.ssheets, fragments=fragments,
+                                     resources=self.resource_cache)
+        self._debug('Generated XSL-FO from xml_to_fo', xslfo,
+                    dump_path and dump_path + '.fo')
+        if self.fo_schema is not None:
+            with instrumentation.span('validate', bytes_in=len(xslfo)):
+                self.fo_schema.validate(xslfo)
         return xslfo
 
-    def generate(self, params, out_format=None, copy_params=False):
+    def _stream_xslfo(self, params):
+        params = self._merge_params(params)
+        if self.template_output == TREE_OUTPUT:
+            # the tree is already whole, translate it at once.
+            with instrumentation.span('render'):
+                tree = self.template.render(params)
+            return iter((xml_to_fo_with_style(
+                tree, self.ssheets, resources=self.resource_cache
+            ), ))
+        render_stream = getattr(self.template, 'render_stream', None)
+        if render_stream is None:
+            def render(write):
+                write(self.template.render(params))
+        else:
+            def render(write):
+                render_stream(params, write)
+        return iter_xml_to_fo_with_style(render, self.ssheets,
+                                         resources=self.resource_cache)
+
+    def _build(self, xslfo, out_format, output):
+        if output is None:
+            # keep the support of the builders without outputs.
+            return self.builder(xslfo, out_format, self.log)
+        return self.builder(xslfo, out_format, self.log, output)
+
+    def generate(self, params, out_format=None, copy_params=False,
+                 output=None, streaming=False):
         """Generate the document and return the name of the generated
         document (file).
+
+        Use `output` to get the document in any other way, it can be
+        ``'bytes'`` to get the content of the document, ``'chunks'`` to
+        get an iterator of its chunks or a writable file object (or
+        socket) on which the document is written. No temporary file
+        is used with those outputs.
+
+        If the generator has a `result_cache` (check `pypfop.cache`) the
+        document is looked up there before rendering the template. The
+        cacheable blocks of the template (check `pypfop.fragments`), like
+        the page layout of the skeletons, are reused from the
+        `fragment_cache`, if any (like the process-wide
+        `pypfop.fragments.fragment_cache`).
+
+        The external graphics are fetched through the `resource_cache`,
+        if any (check `pypfop.cache.ResourceCache`), and fop gets their
+        local copies.
+
+        With a `fo_schema` (check `pypfop.validation`) the XSL-FO is
+        validated before calling the builder, an invalid document raises
+        a `DocumentGeneratorError` with the path of its invalid elements.
+
+        With `streaming` the template output is translated to XSL-FO
+        while it is rendered (check `StreamingFOConverter`) and the
+        builders with `streaming_input` get the XSL-FO as it is produced,
+        without holding the whole xml nor XSL-FO in memory, nor validating
+        it. It has no effect with a `result_cache`.
+        """
+        if isinstance(self.builder, AsyncBuilder):
+            raise DocumentGeneratorError(
+                'The builder {} is asynchronous, use `agenerate` instead'
+                .format(self.builder)
+            )
+        if out_format is None:
+            out_format = self.out_format
+        else:
+            out_format = self._check_out_format(out_format)
+        check_output(output)
+        with instrumentation.span('generate', format=out_format,
+                                  streaming=streaming):
+            if self.result_cache is not None:
+                return self._generate_cached(params, out_format, output)
+            if streaming:
+                xslfo = self._stream_xslfo(params)
+                if not getattr(self.builder, 'streaming_input', False):
+                    xslfo = join_xslfo(xslfo)
+                return self._build(xslfo, out_format, output)
+            xslfo = self._generate_xslfo(params)
+            return self._build(xslfo, out_format, output)
+
+    def _deliver(self, document, out_format, output):
+        """Send the (cached or concatenated) `document` to `output`, like
+        the builder does with the ones it builds.
+        """
+        return deliver([document], out_format, output,
+                       getattr(self.builder, 'tempdir', None))
+
+    def _cache_lookup(self, params, out_format):
+        """Return the key of the document of `params` on the
+        `result_cache` and the cached document, or None.
+        """
+        key = document_key(self.template, params, self.ssheets, out_format)
+        with instrumentation.span('result_cache') as span:
+            document = self.result_cache.get(key)
+            span.set(cache_hit=document is not None)
+        if document is None:
+            self.log.debug('Result cache miss %s', key)
+        else:
+            self.log.debug('Result cache hit %s', key)
+        return key, document
+
+    def _generate_cached(self, params, out_format, output):
+        params = self._merge_params(params)
+        key, document = self._cache_lookup(params, out_format)
+        if document is None:
+            xslfo = self._generate_xslfo(params)
+            document = self._build(xslfo, out_format, OUTPUT_BYTES)
+            self.result_cache.set(key, document)
+        return self._deliver(document, out_format, output)
+
+    async def agenerate(self, params, out_format=None, copy_params=False,
+                        output=None, streaming=False):
+        """Coroutine version of `generate`.
+
+        Unless the builder is an `AsyncBuilder`, the whole `generate`
+        runs on the default executor of the event loop. Otherwise the
+        template rendering, the XSL-FO translation and the lookups of the
+        `result_cache` run on the executor and the document is built
+        with the builder coroutine; the asynchronous builders get the
+        whole XSL-FO, `streaming` is not supported with them.
         """
         if out_format is None:
             out_format = self.out_format
         else:
             out_format = self._check_out_format(out_format)
-        xslfo = self._generate_xslfo(params, copy_params)
-        return self.builder(xslfo, out_format, self.log)
+        check_output(output)
+        loop = asyncio.get_running_loop()
+        if not isinstance(self.builder, AsyncBuilder):
+            return await loop.run_in_executor(None, functools.partial(
+                self.generate, params, out_format, copy_params, output,
+                streaming
+            ))
+        if streaming:
+            raise DocumentGeneratorError(
+                'The builder {} is asynchronous, it can not build the '
+                'documents while they are generated'.format(self.builder)
+            )
+        if self.result_cache is None:
+            xslfo = await loop.run_in_executor(
+                None, self._generate_xslfo, params
+            )
+            return await self._build(xslfo, out_format, output)
+        params = self._merge_params(params)
+        key, document = await loop.run_in_executor(
+            None, self._cache_lookup, params, out_format
+        )
+        if document is None:
+            xslfo = await loop.run_in_executor(
+                None, self._generate_xslfo, params
+            )
+            document = await self._build(xslfo, out_format, OUTPUT_BYTES)
+            await loop.run_in_executor(
+                None, self.result_cache.set, key, document
+            )
+        return await loop.run_in_executor(
+            None, self._deliver, document, out_format, output
+        )
+
+    def generate_many(self, iterable_of_params, workers=None, executor=None,
+                      **kwargs):
+        """Generate a document for each params of `iterable_of_params`,
+        rendering the templates in parallel on a process pool (or
+        `executor`) and building the documents on a thread pool.
+
+        Yield a `pypfop.batch.BatchResult` per document, a failure on
+        one of them is reported on its result instead of aborting the
+        whole batch. Check `pypfop.batch.generate_many` for the rest of
+        the supported arguments.
+        """
+        return batch.generate_many(
+            self, iterable_of_params, workers, executor, **kwargs
+        )
+
+    def generate_sharded(self, params, splitter, out_format=None,
+                         output=None, workers=None, **kwargs):
+        """Generate a single (pdf) document from the shards of `params`
+        returned by `splitter`, rendered and built in parallel and then
+        concatenated with continuous page numbers.
+
+        Use it for the very large reports, splitting their rows with
+        `pypfop.shards.split_list`. Check `pypfop.shards.generate_sharded`
+        for the rest of the arguments.
+        """
+        check_output(output)
+        return shards.generate_sharded(
+            self, params, splitter, out_format, output, workers, **kwargs
+        )
+
+    def prepare(self, params, copy_params=False):
+        """Render the template and apply the styles, returning a
+        `PreparedDocument` that can be built any number of times and
+        in any format with `build`.
+        """
+        return PreparedDocument(self._generate_xslfo(params))
+
+    def build(self, prepared, formats=None, output=None):
+        """Build the `prepared` document (from `prepare`) in each one of
+        the `formats` (by default the `out_format` of the generator).
+
+        Return a dictionary with the result of the builder by format,
+        check `generate` for the supported values of `output`.
+        """
+        if isinstance(self.builder, AsyncBuilder):
+            raise DocumentGeneratorError(
+                'The builder {} is asynchronous, use `build_many` of '
+                'the builder instead'.format(self.builder)
+            )
+        if formats is None:
+            formats = [self.out_format]
+        elif isinstance(formats, str):
+            formats = [formats]
+        formats = list(collections.OrderedDict.fromkeys(
+            self._check_out_format(out_format) for out_format in formats
+        ))
+        check_output(output)
+        if len(formats) > 1 and output not in (
+                None, OUTPUT_PATH, OUTPUT_BYTES, OUTPUT_CHUNKS):
+            raise DocumentGeneratorError(
+                'A single file object can not hold the documents '
+                'of several formats'
+            )
+        if not isinstance(self.builder, Builder):
+            return {out_format: self._build(prepared.xslfo, out_format, output)
+                    for out_format in formats}
+        return self.builder.build_many(
+            prepared.xslfo, formats, self.log, output
+        )
@@ -0,0 +1,326 @@
+"""Cache of the reusable blocks of the documents (letterheads, footers,
+terms and conditions, etc) already converted to XSL-FO.
+
+A block of a mako template is marked as cacheable with a key::
+
+    <%namespace name="fragment" module="pypfop.fragments"/>
+    <%fragment:cached key="letterhead">
+        <block class="letterhead">...</block>
+    </%fragment:cached>
+
+and the generator is given a `FragmentCache`, like the process-wide
+`fragment_cache`::
+
+    DocumentGenerator(template, stylesheets, fragment_cache=fragment_cache)
+
+The first document renders the block, which is styled and translated
+to XSL-FO with the rest of the document and stored on the cache. The
+next documents (with the same template and style sheets) don't render
+it, its cached XSL-FO is spliced on the output instead.
+
+The block is styled in the context of the first document, so its
+content must not depend on the params of the template nor on the
+elements around it; the css rules of the elements around it still see
+its elements, with the attributes they had before being styled.
+"""
+import re
+import threading
+import contextvars
+import collections
+
+import lxml.etree
+from mako.runtime import supports_caller
+
+from pypfop.conversion import (
+    stylesheet_cache, _fo_element, _serialize_fragment
+)
+from pypfop.exceptions import TemplateError, DocumentGeneratorError
+
+
+START = 'pypfop-fragment-start'
+END = 'pypfop-fragment-end'
+PLACEHOLDER = 'pypfop-fragment'
+
+_KEY_RE = re.compile(r'[\w.:/-]+')
+
+_current_scope = contextvars.ContextVar('pypfop_fragments', default=None)
+
+Fragment = collections.namedtuple('Fragment', ('text', 'elements'))
+Fragment.__doc__ = """A block of a document already translated to XSL-FO.
+
+`text` is the text before its first element and `elements` a tuple of
+``(tag, attrib, foelem, xml, tail)`` with the tag and the unstyled
+attributes of each one of its top level elements, their `fo:` tagged
+ElementTree copy, its serialization (if it can be spliced as is) and
+the text after them.
+"""
+
+
+class FragmentCache:
+    """Thread-safe LRU cache of up to `maxsize` fragments.
+
+    The fragments are keyed by the key given on the template, the
+    values of its params, the template and the style sheets, check
+    `scope`.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        self._fragments = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        # the process-wide cache is shared by the whole process, any
+        # other one is sent empty to the other processes.
+        if self is fragment_cache:
+            return 'fragment_cache'
+        return (type(self), (self.maxsize, ))
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def get(self, key):
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._fragments.move_to_end(key)
+            return fragment
+
+    def set(self, key, fragment):
+        with self._lock:
+            self._fragments[key] = fragment
+            self._fragments.move_to_end(key)
+            while len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop the fragments with the template `key`, of any template,
+        style sheets and params, return the number of dropped fragments.
+        """
+        with self._lock:
+            keys = [cached for cached in self._fragments
+                    if cached[-2] == key]
+            for cached in keys:
+                del self._fragments[cached]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._fragments),
+                    'maxsize': self.maxsize}
+
+    def scope(self, template, ssheets):
+        """Return the `FragmentScope` of a document of `template` with
+        the style sheets `ssheets`.
+        """
+        fingerprint = getattr(template, 'fingerprint', None)
+        variant = (fingerprint() if callable(fingerprint) else repr(template),
+                   tuple(stylesheet_cache.digest(sheet) for sheet in ssheets))
+        return FragmentScope(self, variant)
+
+
+fragment_cache = FragmentCache()
+
+
+class FragmentScope:
+    """The fragments of a single document.
+
+    It is the active scope of the templates while it is used as a
+    context manager, then `xml_to_fo_with_style` gets it to splice the
+    fragments that were found on the cache and store the new ones.
+    """
+
+    def __init__(self, cache, variant):
+        self.cache = cache
+        self.variant = variant
+        self.used = {}  # marker -> Fragment spliced on this document.
+        self._keys = {}  # marker -> key on the cache
+        self._pending = {}  # start marker -> key on the cache
+        self.open = []  # markers of the blocks being rendered
+        self._attribs = {}  # element -> attributes before being styled
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_scope.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current_scope.reset(self._token)
+        return False
+
+    def lookup(self, key, values=()):
+        """Return the text of the markers of the fragment `key` with
+        the param `values` and the cached fragment, if any, which is
+        kept until the document is converted.
+        """
+        marker = '{} {}'.format(key, len(self._keys))
+        self._keys[marker] = self.variant + (key, values)
+        fragment = self.cache.get(self._keys[marker])
+        if fragment is not None:
+            self.used[marker] = fragment
+        return marker, fragment
+
+    def splice(self, tree):
+        """Put the cached fragments of `tree` in place of their
+        placeholders and return a dictionary with the elements that
+        stand for their top level elements and their ``(foelem, xml)``.
+        """
+        prebuilt = {}
+        if not self._keys:
+            return prebuilt
+        for marker in list(tree.iter(lxml.etree.ProcessingInstruction)):
+            if marker.target == START:
+                self._pending[marker] = self._keys[marker.text]
+                continue
+            if marker.target != PLACEHOLDER:
+                continue
+            parent = marker.getparent()
+            fragment = self.used.get(marker.text)
+            if parent is None or fragment is None:
+                raise DocumentGeneratorError(
+                    'Unexpected fragment placeholder {}'.format(marker.text)
+                )
+            tail, last = marker.tail, marker
+            marker.tail = fragment.text
+            stand_ins = []
+            for tag, attrib, foelem, xml, elem_tail in fragment.elements:
+                last = parent.makeelement(tag, attrib)
+                last.tail = elem_tail
+                stand_ins.append(last)
+                prebuilt[last] = (foelem, xml)
+            if tail:
+                last.tail = (last.tail or '') + tail
+            position = parent.index(marker) + 1
+            parent[position:position] = stand_ins
+        for marker in self._pending:
+            for elem in self._fragment_nodes(marker):
+                if isinstance(elem.tag, str):
+                    self._attribs[elem] = dict(elem.attrib)
+        return prebuilt
+
+    def _fragment_nodes(self, marker):
+        for node in marker.itersiblings():
+            if node.tag is lxml.etree.ProcessingInstruction and \
+                    node.target == END:
+                return
+            yield node
+
+    def capture(self, prebuilt):
+        """Store the new (styled) fragments of the document on the cache
+        and add their elements to `prebuilt`.
+        """
+        # the inner fragments first, to reuse them on the outer ones.
+        for marker, key in reversed(list(self._pending.items())):
+            text = marker.tail
+            elements = []
+            for node in self._fragment_nodes(marker):
+                if not isinstance(node.tag, str):
+                    # comments and processing instructions are dropped.
+                    if not node.tail:
+                        pass
+                    elif elements:
+                        elements[-1] = elements[-1][:-1] + (
+                            (elements[-1][-1] or '') + node.tail,
+                        )
+                    else:
+                        text = (text or '') + node.tail
+                    continue
+                built = prebuilt.get(node)
+                if built is None:
+                    foelem = _fo_element(node, prebuilt)
+                    built = prebuilt[node] = (
+                        foelem, _serialize_fragment(foelem)
+                    )
+                elements.append((node.tag, self._attribs[node]) + built +
+                                (node.tail, ))
+            self.cache.set(key, Fragment(text, tuple(elements)))
+        self._pending.clear()
+        self._attribs.clear()
+
+
+def begin(context, key, params=()):
+    """Start the cacheable block `key` of a mako template, return True
+    if it has to be rendered and False if its cached XSL-FO is used.
+    The block is cached once per value of the template `params` (their
+    names) it depends on, which must be hashable. `end` has to be
+    called after the block, even if it is not rendered::
+
+        % if fragment.begin('layout', ('MARGIN', )):
+            <%block name="layout"/>
+        % endif
+        ${fragment.end()}
+
+    Without an active `FragmentScope` (the generator has no
+    `fragment_cache` or the document is streamed) or with None `params`
+    the block is always rendered.
+    """
+    if not isinstance(key, str) or not _KEY_RE.fullmatch(key):
+        raise TemplateError('Invalid fragment key {!r}'.format(key))
+    scope = _current_scope.get()
+    if scope is None:
+        return True
+    if params is None:
+        scope.open.append(None)
+        return True
+    values = tuple(context.get(name) for name in params)
+    try:
+        hash(values)
+    except TypeError:
+        raise TemplateError(
+            'Unhashable params of the fragment {}'.format(key)
+        )
+    marker, fragment = scope.lookup(key, values)
+    if fragment is not None:
+        context.write('<?{} {}?>'.format(PLACEHOLDER, marker))
+        scope.open.append(None)
+        return False
+    context.write('<?{} {}?>'.format(START, marker))
+    scope.open.append(marker)
+    return True
+
+
+def declared_params(context, namespace, block, name):
+    """Return the names of the params `name` (like ``LAYOUT_PARAMS``) of
+    the template of the inheritance chain of `namespace` (``self``) that
+    defines the `block` (the one that is rendered), or None if that same
+    template doesn't declare them, then the block depends on params
+    unknown to `begin` and can't be cached.
+    """
+    while namespace is not None:
+        module = namespace.module
+        if hasattr(module, 'render_' + block):
+            return getattr(module, name, None)
+        namespace = namespace.inherits
+    return None
+
+
+def end(context):
+    """End the last block started with `begin`."""
+    scope = _current_scope.get()
+    if scope is not None:
+        marker = scope.open.pop()
+        if marker is not None:
+            context.write('<?{} {}?>'.format(END, marker))
+    return ''
+
+
+@supports_caller
+def cached(context, key, params=()):
+    """Mako tag of the cacheable blocks, check the module docstring
+    and `begin`.
+    """
+    if begin(context, key, params):
+        context['caller'].body()
+    return end(context)
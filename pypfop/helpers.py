@@ -1,52 +1,262 @@
+import os
+import time
+import logging
 import functools
+import threading
+import collections
 
 import pypfop.templates.mako
 from .document_generator import DocumentGenerator
 
 
+# Environment variable with the number of factories, generators and
+# decorators kept by each cache of this module (128 by default), check
+# `FactoryCache.configure` to change it later.
+CACHE_SIZE_ENV_VAR = 'PYPFOP_CACHE_SIZE'
+DEFAULT_CACHE_SIZE = 128
+
+logger = logging.getLogger('pypfop')
+
+
+def _cache_size_from_env():
+    value = os.environ.get(CACHE_SIZE_ENV_VAR)
+    if value is None:
+        return DEFAULT_CACHE_SIZE
+    try:
+        size = int(value)
+    except ValueError:
+        size = -1
+    if size < 0:
+        logger.warning('Invalid %s %r, using %d', CACHE_SIZE_ENV_VAR,
+                       value, DEFAULT_CACHE_SIZE)
+        return DEFAULT_CACHE_SIZE
+    return size
+
+
+CACHE_SIZE = _cache_size_from_env()
+
+# default of the params of `FactoryCache.configure` that are not set.
+_UNSET = object()
+
+
+def freeze(value):
+    """Return a hashable version of `value`, the lists, tuples, sets and
+    dictionaries (recursively) are turned into tuples and frozensets.
+    Raise `TypeError` if there is any other unhashable value.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, dict):
+        return (dict, ) + tuple(sorted(
+            ((freeze(key), freeze(item)) for key, item in value.items()),
+            key=repr
+        ))
+    if isinstance(value, (set, frozenset)):
+        return frozenset(freeze(item) for item in value)
+    hash(value)
+    return value
+
+
+class _Pending:
+    """Result of a call that is being made by another thread."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class FactoryCache:
+    """Thread-safe cache of the objects returned by `func`, check
+    `bounded_cache`.
+
+    The arguments are normalized with `freeze`, so lists (like the
+    `lookup_dirs` or the `stylesheets`) and dictionaries can be used.
+    Up to `maxsize` objects are kept (the least recently used is the
+    first to go) and each one expires after `ttl` seconds, if set. The
+    concurrent calls with the same arguments wait for the first one
+    instead of building the object again. The calls with any other
+    unhashable argument are not cached.
+    """
+
+    def __init__(self, func, maxsize=CACHE_SIZE, ttl=None):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = self.uncached = 0
+        self._entries = collections.OrderedDict()  # key -> (value, expire)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        try:
+            key = freeze((args, kwargs))
+        except TypeError:
+            with self._lock:
+                self.uncached += 1
+            return self.func(*args, **kwargs)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expire = entry
+                if expire is None or expire > time.monotonic():
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.hits += 1
+                building = False
+            else:
+                self.misses += 1
+                pending = self._pending[key] = _Pending()
+                building = True
+        if not building:
+            return pending.wait()
+        try:
+            pending.value = self.func(*args, **kwargs)
+        except BaseException as error:
+            pending.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+                if pending.error is None:
+                    self._store(key, pending.value)
+            pending.done.set()
+        return pending.value
+
+    def _store(self, key, value):
+        expire = None if self.ttl is None else time.monotonic() + self.ttl
+        self._entries[key] = (value, expire)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while self.maxsize is not None and \
+                len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def configure(self, maxsize=_UNSET, ttl=_UNSET):
+        """Set the `maxsize` (dropping the least recently used objects
+        above it) and the `ttl` of the objects cached from now on, the
+        ones that are not given are kept. None removes the limit.
+        """
+        with self._lock:
+            if maxsize is not _UNSET:
+                self.maxsize = maxsize
+            if ttl is not _UNSET:
+                self.ttl = ttl
+            self._evict()
+
+    def invalidate(self, *args, **kwargs):
+        """Drop the cached object of the call with `args` and `kwargs`,
+        return True if there was one.
+        """
+        with self._lock:
+            return self._entries.pop(freeze((args, kwargs)), None) \
+                is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.uncached = 0
+
+    # the same api of functools.lru_cache.
+    cache_clear = clear
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'uncached': self.uncached,
+                    'entries': len(self._entries), 'maxsize': self.maxsize,
+                    'ttl': self.ttl}
+
+
+def bounded_cache(maxsize=CACHE_SIZE, ttl=None):
+    """Decorator to cache the results of a function on a `FactoryCache`
+    with `maxsize` entries that expire after `ttl` seconds.
+    """
+    def decorator(func):
+        return FactoryCache(func, maxsize, ttl)
+    return decorator
+
+
 class DocumentDecorator:
+    """Factory of the decorators of the functions that return the params
+    of a document, check `prepare`.
+
+    The same instance (they are cached by `make_document_decorator`) can
+    prepare any number of decorators, from any thread, each one of them
+    has its own generator.
+    """
 
     def __init__(self, template_factory, *doc_gen_args, **doc_gen_kwargs):
         self.template_factory = template_factory
         self.default_doc_gen_args = doc_gen_args
         self.default_doc_gen_kwargs = doc_gen_kwargs
 
-    def __call__(self, func):
-        self.func = func
-        return self.wrapper
-
     def prepare(self, template, *args, **kwargs):
+        """Return a decorator that generates a document with `template`
+        and the params returned by the decorated function.
+        """
         template_inst = self.template_factory(template)
         args = self.default_doc_gen_args + args
         # we might need deepcopy here
         merged_kwargs = dict(**self.default_doc_gen_kwargs)
         merged_kwargs.update(kwargs)
-        self.generator = DocumentGenerator(
+        return PreparedDocumentDecorator(DocumentGenerator(
             template_inst, *args, **merged_kwargs
-        )
-        return self
+        ))
 
-    def wrapper(self, *args, **kwargs):
-        params = self.func(*args, **kwargs)
-        return self.generator.generate(params)
 
+class PreparedDocumentDecorator:
+    """Decorator returned by `DocumentDecorator.prepare`."""
 
-@functools.lru_cache
-def get_mako_template_factory(lookup_dirs=None, use_skels=True):
-    return pypfop.templates.mako.Factory(lookup_dirs, use_skels)
+    def __init__(self, generator):
+        self.generator = generator
+
+    def __call__(self, func):
+        generator = self.generator
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return generator.generate(func(*args, **kwargs))
+        wrapper.generator = generator
+        return wrapper
+
+
+@bounded_cache()
+def get_mako_template_factory(lookup_dirs=None, use_skels=True,
+                              module_directory=None, preload=False,
+                              skel_dirs=None):
+    return pypfop.templates.mako.Factory(
+        lookup_dirs, use_skels, module_directory, preload, skel_dirs
+    )
 
 
-@functools.lru_cache
+@bounded_cache()
 def get_document_generator(template_path, *args, **kwargs):
     template_factory = get_mako_template_factory(
         kwargs.pop('lookup_dirs', None),
-        kwargs.pop('use_skels', True)
+        kwargs.pop('use_skels', True),
+        kwargs.pop('module_directory', None),
+        skel_dirs=kwargs.pop('skel_dirs', None)
     )
     template = template_factory(template_path)
     return DocumentGenerator(template, *args, **kwargs)
 
 
-@functools.lru_cache
+@bounded_cache()
 def make_document_decorator(
     lookup_dirs=None,
     use_skels=True,
@@ -0,0 +1,247 @@
+"""Instrumentation of the stages of the generation of the documents.
+
+Each stage (``render``, ``css``, ``fo``, ``result_cache``, ``build``,
+etc) runs inside a `Span` of the process-wide `instrumentation` and,
+once it ends, the span is passed to each one of the registered hooks::
+
+    from pypfop.instrumentation import instrumentation, PrometheusExporter
+
+    exporter = PrometheusExporter()
+    instrumentation.add_hook(exporter)
+    ...
+    print(exporter.render())
+
+The spans have the `duration` of the stage in seconds and `attributes`
+like ``bytes_in``, ``bytes_out``, ``rules``, ``cache_hit``,
+``builder`` or ``exit_status``. Without hooks no span is ever created.
+"""
+import time
+import logging
+import threading
+import contextvars
+import collections
+
+
+logger = logging.getLogger('pypfop')
+
+_current_span = contextvars.ContextVar('pypfop_span', default=None)
+
+
+class Span:
+    """A timed stage, use it as a context manager.
+
+    `parent` is the span that was running when this one started, if
+    any, and `error` the exception that ended the stage, if any.
+    """
+    __slots__ = ('name', 'attributes', 'parent', 'start', 'duration',
+                 'error', '_instrumentation', '_token')
+
+    def __init__(self, instrumentation, name, attributes):
+        self._instrumentation = instrumentation
+        self.name = name
+        self.attributes = attributes
+        self.parent = None
+        self.start = None
+        self.duration = None
+        self.error = None
+
+    def __repr__(self):
+        return '<Span {} {}>'.format(self.name, self.attributes)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        self._token = _current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self.start
+        _current_span.reset(self._token)
+        self.error = exc_value
+        self._instrumentation.emit(self)
+        return False
+
+
+class _NoSpan:
+    """Span used when there are no hooks, it does nothing."""
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Instrumentation:
+    """Registry of the hooks that get the finished spans."""
+
+    def __init__(self):
+        self._hooks = ()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self._hooks)
+
+    def add_hook(self, hook):
+        """Call `hook` with each finished `Span`."""
+        with self._lock:
+            self._hooks += (hook, )
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks = tuple(registered for registered in self._hooks
+                                if registered != hook)
+
+    def span(self, name, **attributes):
+        """Return the span of the stage `name`, a no-op one unless
+        there is any hook.
+        """
+        if not self._hooks:
+            return _NO_SPAN
+        return Span(self, name, attributes)
+
+    def annotate(self, **attributes):
+        """Set the `attributes` on the running span, if any."""
+        span = _current_span.get()
+        if span is not None:
+            span.set(**attributes)
+
+    def emit(self, span):
+        for hook in self._hooks:
+            try:
+                hook(span)
+            except Exception:
+                # a broken hook must not break the documents.
+                logger.exception('Error on the instrumentation hook {!r}'
+                                 .format(hook))
+
+
+instrumentation = Instrumentation()
+
+
+def _escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+                     .replace('\n', r'\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape_label(value))
+        for name, value in sorted(labels.items())
+    ) + '}'
+
+
+class PrometheusExporter:
+    """Hook that aggregates the spans as Prometheus metrics, `render`
+    returns them in the Prometheus text exposition format.
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix='pypfop', buckets=None):
+        self.prefix = prefix
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._durations = {}  # stage -> [bucket counts, sum, count]
+        self._errors = collections.Counter()
+        self._bytes = collections.Counter()
+        self._rules = {}
+        self._cache = collections.Counter()
+        self._exits = collections.Counter()
+
+    def __call__(self, span):
+        attributes = span.attributes
+        with self._lock:
+            histogram = self._durations.get(span.name)
+            if histogram is None:
+                histogram = self._durations[span.name] = [
+                    [0] * len(self.buckets), 0.0, 0
+                ]
+            for pos, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    histogram[0][pos] += 1
+            histogram[1] += span.duration
+            histogram[2] += 1
+            if span.error is not None:
+                self._errors[span.name] += 1
+            for direction in ('in', 'out'):
+                size = attributes.get('bytes_' + direction)
+                if size is not None:
+                    self._bytes[span.name, direction] += size
+            if 'rules' in attributes:
+                self._rules[span.name] = attributes['rules']
+            if 'cache_hit' in attributes:
+                self._cache[span.name, attributes['cache_hit']] += 1
+            if 'exit_status' in attributes:
+                self._exits[attributes.get('builder', ''),
+                            attributes['exit_status']] += 1
+
+    def _metric(self, lines, name, kind, helptext):
+        name = '{}_{}'.format(self.prefix, name)
+        lines.append('# HELP {} {}'.format(name, helptext))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        return name
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            name = self._metric(lines, 'stage_duration_seconds', 'histogram',
+                                'Duration of the stages of the generation.')
+            for stage, (counts, total, count) in \
+                    sorted(self._durations.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(stage=stage, le=bound), bucket_count
+                    ))
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(stage=stage, le='+Inf'), count
+                ))
+                lines.append('{}_sum{} {}'.format(
+                    name, _labels(stage=stage), total
+                ))
+                lines.append('{}_count{} {}'.format(
+                    name, _labels(stage=stage), count
+                ))
+            name = self._metric(lines, 'stage_errors_total', 'counter',
+                                'Stages that ended with an error.')
+            for stage, count in sorted(self._errors.items()):
+                lines.append('{}{} {}'.format(name, _labels(stage=stage),
+                                              count))
+            name = self._metric(lines, 'stage_bytes_total', 'counter',
+                                'Bytes received and produced by the stages.')
+            for (stage, direction), size in sorted(self._bytes.items()):
+                lines.append('{}{} {}'.format(
+                    name, _labels(stage=stage, direction=direction), size
+                ))
+            name = self._metric(lines, 'stage_rules', 'gauge',
+                                'Css rules of the last styled document.')
+            for stage, rules in sorted(self._rules.items()):
+                lines.append('{}{} {}'.format(name, _labels(stage=stage),
+                                              rules))
+            name = self._metric(lines, 'cache_lookups_total', 'counter',
+                                'Lookups of the caches.')
+            for (stage, hit), count in sorted(self._cache.items()):
+                lines.append('{}{} {}'.format(
+                    name, _labels(cache=stage,
+                                  result='hit' if hit else 'miss'), count
+                ))
+            name = self._metric(lines, 'fop_exit_total', 'counter',
+                                'Exit status of the fop builds.')
+            for (builder, status), count in sorted(self._exits.items(),
+                                                   key=repr):
+                lines.append('{}{} {}'.format(
+                    name, _labels(builder=builder, status=status), count
+                ))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,273 @@
+"""Minimal reader and writer of the PDF documents built by fop, to
+concatenate the documents of the shards of a report (check
+`pypfop.shards`) without any other dependency.
+
+Only the documents with classic cross-reference tables (the ones of
+fop, also with incremental updates) are supported. The objects are
+copied as they are, only their references are renumbered (out of the
+strings and streams); the page trees of the documents become the kids
+of a new page tree and their catalogs are replaced by a new one.
+"""
+import re
+import bisect
+import collections
+
+from pypfop.exceptions import BuilderError
+
+
+_STARTXREF_RE = re.compile(rb'startxref\s+(\d+)\s*%%EOF\s*$')
+_SUBSECTION_RE = re.compile(rb'\s*(\d+)\s+(\d+)\s*?\r?\n')
+_ENTRY_RE = re.compile(rb'(\d{10}) (\d{5}) ([nf])\s{1,2}')
+_TRAILER_RE = re.compile(rb'\s*trailer\s*(<<.*?>>)\s*startxref', re.DOTALL)
+_OBJECT_RE = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj\b\s*')
+_STREAM_RE = re.compile(rb'\bstream(\r\n|\n)')
+_REFERENCE_RE = re.compile(rb'(?<![\d.])(\d+)\s+(\d+)\s+R\b')
+_VERSION_RE = re.compile(rb'%PDF-1\.(\d)')
+
+
+def _reference(name, data):
+    match = re.search(rb'/' + name + rb'\s+(\d+)\s+\d+\s+R\b', data)
+    return None if match is None else int(match.group(1))
+
+
+PDFDocument = collections.namedtuple(
+    'PDFDocument', ('version', 'objects', 'root', 'info')
+)
+PDFDocument.__doc__ = """A PDF document read by `read_pdf`.
+
+`objects` maps the number of each object to its content (between
+``obj`` and ``endobj``), `root` and `info` are the numbers of the
+catalog and document information objects of the trailer and `version`
+the minor version of its header.
+"""
+
+
+def _xref_sections(pdf, offset):
+    """Yield the ``(offset, entries, trailer)`` of the cross-reference
+    section at `offset` and its previous ones, from the newest to the
+    oldest.
+    """
+    seen = set()
+    while offset is not None:
+        if offset in seen or pdf[offset:offset + 4] != b'xref':
+            raise BuilderError(
+                'Unsupported PDF document, only the cross-reference '
+                'tables are supported'
+            )
+        seen.add(offset)
+        position = offset + 4
+        entries = {}
+        while True:
+            match = _SUBSECTION_RE.match(pdf, position)
+            if match is None:
+                break
+            first, count = int(match.group(1)), int(match.group(2))
+            position = match.end()
+            for number in range(first, first + count):
+                entry = _ENTRY_RE.match(pdf, position)
+                if entry is None:
+                    raise BuilderError('Invalid PDF cross-reference table')
+                position = entry.end()
+                if entry.group(3) == b'n':
+                    entries[number] = int(entry.group(1))
+        trailer = _TRAILER_RE.match(pdf, position)
+        if trailer is None:
+            raise BuilderError('Invalid PDF trailer')
+        yield offset, entries, trailer.group(1)
+        prev = re.search(rb'/Prev\s+(\d+)', trailer.group(1))
+        offset = None if prev is None else int(prev.group(1))
+
+
+def read_pdf(pdf):
+    """Return the `PDFDocument` of the bytes `pdf`."""
+    version = _VERSION_RE.match(pdf)
+    startxref = _STARTXREF_RE.search(pdf, max(0, len(pdf) - 1024))
+    if version is None or startxref is None:
+        raise BuilderError('Invalid PDF document')
+    offsets = {}
+    # an object ends where the next object or section starts.
+    boundaries = {len(pdf)}
+    root = info = None
+    for section, entries, trailer in _xref_sections(
+            pdf, int(startxref.group(1))):
+        boundaries.add(section)
+        boundaries.update(entries.values())
+        for number, offset in entries.items():
+            offsets.setdefault(number, offset)
+        if root is None:
+            root = _reference(b'Root', trailer)
+            info = _reference(b'Info', trailer)
+    boundaries = sorted(boundaries)
+    objects = {}
+    for number, offset in offsets.items():
+        match = _OBJECT_RE.match(pdf, offset)
+        if match is None or int(match.group(1)) != number:
+            raise BuilderError('Invalid PDF object {}'.format(number))
+        content = pdf[match.end():boundaries[
+            bisect.bisect_right(boundaries, offset)
+        ]]
+        end = content.rfind(b'endobj')
+        if end == -1:
+            raise BuilderError('Invalid PDF object {}'.format(number))
+        objects[number] = content[:end].rstrip()
+    if root not in objects:
+        raise BuilderError('The PDF document has no catalog')
+    return PDFDocument(int(version.group(1)), objects, root, info)
+
+
+def _dictionary(content):
+    """Split the `content` of an object on its dictionary (or value)
+    and its stream, if any.
+    """
+    match = _STREAM_RE.search(content)
+    if match is None:
+        return content, b''
+    return content[:match.start()], content[match.start():]
+
+
+def _pages(document):
+    catalog = _dictionary(document.objects[document.root])[0]
+    pages = _reference(b'Pages', catalog)
+    if pages not in document.objects:
+        raise BuilderError('The PDF document has no pages')
+    return pages
+
+
+def page_count(pdf):
+    """Return the number of pages of the PDF document `pdf` (bytes or a
+    `PDFDocument`).
+    """
+    if isinstance(pdf, bytes):
+        pdf = read_pdf(pdf)
+    count = re.search(rb'/Count\s+(\d+)', _dictionary(
+        pdf.objects[_pages(pdf)]
+    )[0])
+    return 0 if count is None else int(count.group(1))
+
+
+_CATALOG_KEYS = (b'Metadata', b'Lang', b'ViewerPreferences', b'MarkInfo',
+                 b'OutputIntents')
+
+
+def concatenate(pdfs, first_page_number=None):
+    """Return a PDF document (bytes) with the pages of all the `pdfs`.
+
+    The document information and the metadata of the catalog are the
+    ones of the first document, the outlines, names and the structure
+    trees of the documents are not kept. With `first_page_number` the
+    page labels are decimal numbers from it on.
+    """
+    documents = [read_pdf(pdf) if isinstance(pdf, bytes) else pdf
+                 for pdf in pdfs]
+    if not documents:
+        raise BuilderError('There are no documents to concatenate')
+    objects = []  # content of the new objects, numbered from 1.
+    kids = []
+    count = 0
+    # the catalogs of the documents are left out, the new one is the
+    # last object after the new page tree.
+    tree = sum(len(document.objects) - 1 for document in documents) + 1
+    first_numbers = None
+    for document in documents:
+        numbers = {document.root: tree + 1}
+        for number in sorted(document.objects):
+            if number != document.root:
+                numbers[number] = len(objects) + len(numbers)
+        pages = _pages(document)
+        for number in sorted(document.objects):
+            if number == document.root:
+                continue
+            head, stream = _dictionary(document.objects[number])
+            head = _renumber(head, numbers)
+            if number == pages:
+                head = re.sub(rb'/Parent\s+\d+\s+\d+\s+R', b'', head)
+                head = head.replace(b'<<', b'<< /Parent %d 0 R' % tree, 1)
+            objects.append(head + stream)
+        kids.append(numbers[pages])
+        count += page_count(document)
+        if first_numbers is None:
+            first_numbers = numbers
+    first = documents[0]
+    catalog = [b'/Type /Catalog', b'/Pages %d 0 R' % tree]
+    first_catalog = _renumber(
+        _dictionary(first.objects[first.root])[0], first_numbers
+    )
+    for key in _CATALOG_KEYS:
+        match = re.search(
+            rb'/' + key + rb'\s*(\d+\s+\d+\s+R|\([^)]*\)|/\w+|'
+            rb'\[[^\]]*\]|<<[^<>]*>>)', first_catalog
+        )
+        if match is not None:
+            catalog.append(match.group())
+    if first_page_number is not None:
+        catalog.append(b'/PageLabels << /Nums [0 << /S /D /St %d >>] >>'
+                       % first_page_number)
+    objects.append(b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % kid for kid in kids), count
+    ))
+    objects.append(b'<< ' + b' '.join(catalog) + b' >>')
+    trailer = b'/Size %d /Root %d 0 R' % (len(objects) + 1, len(objects))
+    if first.info in first_numbers and first.info != first.root:
+        trailer += b' /Info %d 0 R' % first_numbers[first.info]
+    return _write_pdf(max(document.version for document in documents),
+                      objects, trailer)
+
+
+def _string_end(data, start):
+    """Return the position after the literal string that starts at
+    `start` (on its ``(``), with its balanced parentheses and escapes.
+    """
+    depth = 0
+    position = start
+    while position < len(data):
+        char = data[position:position + 1]
+        if char == b'\\':
+            position += 1
+        elif char == b'(':
+            depth += 1
+        elif char == b')':
+            depth -= 1
+            if not depth:
+                return position + 1
+        position += 1
+    raise BuilderError('Unterminated PDF string')
+
+
+def _renumber(data, numbers):
+    """Replace the references of `data` (without streams) by the new
+    `numbers` of the objects, the references of missing objects and the
+    text of the literal strings are kept.
+    """
+    def replace(match):
+        number = numbers.get(int(match.group(1)))
+        if number is None:
+            return match.group()
+        return b'%d 0 R' % number
+    parts = []
+    position = 0
+    while True:
+        start = data.find(b'(', position)
+        if start == -1:
+            parts.append(_REFERENCE_RE.sub(replace, data[position:]))
+            return b''.join(parts)
+        end = _string_end(data, start)
+        parts.append(_REFERENCE_RE.sub(replace, data[position:start]))
+        parts.append(data[start:end])
+        position = end
+
+
+def _write_pdf(version, objects, trailer):
+    parts = [b'%%PDF-1.%d\n%%\xe2\xe3\xcf\xd3\n' % version]
+    offsets = []
+    position = len(parts[0])
+    for number, content in enumerate(objects, 1):
+        offsets.append(position)
+        part = b'%d 0 obj\n%s\nendobj\n' % (number, content)
+        parts.append(part)
+        position += len(part)
+    parts.append(b'xref\n0 %d\n0000000000 65535 f\r\n' % (len(objects) + 1))
+    parts.extend(b'%010d 00000 n\r\n' % offset for offset in offsets)
+    parts.append(b'trailer\n<< %s >>\nstartxref\n%d\n%%%%EOF\n' % (
+        trailer, position
+    ))
+    return b''.join(parts)
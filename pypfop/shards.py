@@ -0,0 +1,199 @@
+"""Generation of the very large documents in shards built in parallel.
+
+The params of the document are split in shards by a `splitter`, like
+the one of `split_list` that chunks the rows of a table::
+
+    generator.generate_sharded(params, split_list('rows', 500))
+
+The template is rendered once per shard (with the ``SHARD_INDEX`` and
+``SHARD_COUNT`` params), so each shard has the whole page layout and
+its tables start with their ``table-header``, repeated by fop on each
+page. The shards are built in parallel by the builder of the generator
+and their PDF documents concatenated in order (check `pypfop.pdf`).
+
+The pages are numbered continuously with the ``initial-page-number``
+of the first page sequence of each shard. The page count of the shards
+is only known once they are built, so the shards whose output depends
+on their page numbers (they have ``fo:page-number`` elements, or page
+masters for odd or even pages) wait for the first shard and guess that
+each shard has as many pages, they are built again with the right
+number only when that guess was wrong.
+"""
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from pypfop import pdf
+from pypfop.builder import AsyncBuilder, OUTPUT_BYTES
+from pypfop.exceptions import DocumentGeneratorError
+from pypfop.instrumentation import instrumentation
+
+
+# not the page-sequence-master nor the page-sequence-wrapper.
+_PAGE_SEQUENCE_RE = re.compile(rb'<fo:page-sequence(?=[\s/>])[^>]*>')
+_INITIAL_PAGE_NUMBER_RE = re.compile(rb'\sinitial-page-number="([^"]*)"')
+_PAGE_NUMBER_RE = re.compile(rb'<fo:page-number\b')
+_ODD_OR_EVEN_RE = re.compile(rb'\sodd-or-even="(odd|even)"')
+
+
+def split_list(name, size):
+    """Return a splitter of the list param `name` in chunks of `size`
+    items, the rest of the params are the same on each shard.
+    """
+    if size < 1:
+        raise DocumentGeneratorError('Invalid shard size {}'.format(size))
+
+    def splitter(params):
+        items = list(params[name])
+        for start in range(0, len(items) or 1, size):
+            shard = dict(params)
+            shard[name] = items[start:start + size]
+            yield shard
+    return splitter
+
+
+def initial_page_number(xslfo):
+    """Return the numeric ``initial-page-number`` of the first page
+    sequence of `xslfo`, if any.
+    """
+    sequence = _PAGE_SEQUENCE_RE.search(xslfo)
+    if sequence is None:
+        return None
+    number = _INITIAL_PAGE_NUMBER_RE.search(sequence.group())
+    if number is None or not number.group(1).isdigit():
+        return None
+    return int(number.group(1))
+
+
+def set_initial_page_number(xslfo, number):
+    """Return `xslfo` with the ``initial-page-number`` of its first page
+    sequence set to `number`.
+    """
+    sequence = _PAGE_SEQUENCE_RE.search(xslfo)
+    if sequence is None:
+        raise DocumentGeneratorError('The document has no page sequence')
+    attribute = b' initial-page-number="%d"' % number
+    tag, count = _INITIAL_PAGE_NUMBER_RE.subn(attribute, sequence.group())
+    if not count:
+        end = -2 if tag.endswith(b'/>') else -1
+        tag = tag[:end] + attribute + tag[end:]
+    return b''.join((xslfo[:sequence.start()], tag, xslfo[sequence.end():]))
+
+
+class _Shard:
+    """XSL-FO of a shard, the page number it was built with and its
+    document.
+    """
+
+    def __init__(self, xslfo):
+        self.xslfo = xslfo
+        self.numbered = _PAGE_NUMBER_RE.search(xslfo) is not None
+        self.by_parity = _ODD_OR_EVEN_RE.search(xslfo) is not None
+        self.start = None
+        self.document = None
+        self.pages = None
+
+    @property
+    def numbered_by_start(self):
+        """True if the output of the shard depends on its first page."""
+        return self.numbered or self.by_parity
+
+    def stale(self, start):
+        """Return True if the shard has to be built again to start on
+        the page `start`.
+        """
+        if self.document is None:
+            return True
+        if self.numbered:
+            return self.start != start
+        return self.by_parity and (self.start - start) % 2 != 0
+
+
+def generate_sharded(generator, params, splitter, out_format=None,
+                     output=None, workers=None, max_passes=4):
+    """Generate a single document with the shards of `params` returned
+    by `splitter`, check the module docstring.
+
+    The shards are rendered and built on `workers` threads (by default
+    one per shard, up to the number of cpus), the builds can be tried
+    `max_passes` times until the page count of the shards is stable.
+    Only PDF documents can be sharded, `output` is the same of
+    `DocumentGenerator.generate`.
+    """
+    if isinstance(generator.builder, AsyncBuilder):
+        raise DocumentGeneratorError(
+            'The builder {} is asynchronous'.format(generator.builder)
+        )
+    if out_format is None:
+        out_format = generator.out_format
+    else:
+        out_format = generator._check_out_format(out_format)
+    if out_format != 'pdf':
+        raise DocumentGeneratorError(
+            'Only the pdf documents can be sharded, not {}'.format(out_format)
+        )
+    shard_params = list(splitter(params))
+    if not shard_params:
+        raise DocumentGeneratorError('The splitter returned no shards')
+    count = len(shard_params)
+    for index, shard in enumerate(shard_params):
+        shard_params[index] = dict(shard, SHARD_INDEX=index,
+                                   SHARD_COUNT=count)
+    workers = workers or min(count, os.cpu_count() or 1)
+    with instrumentation.span('shards', shards=count) as span, \
+            ThreadPoolExecutor(workers) as executor:
+
+        def build(shard, start):
+            xslfo = shard.xslfo
+            if start is None:
+                start = initial_page_number(xslfo) or 1
+            else:
+                xslfo = set_initial_page_number(xslfo, start)
+            document = generator._build(xslfo, out_format, OUTPUT_BYTES)
+            return start, document, pdf.page_count(document)
+
+        def render_and_build(index):
+            start = None
+            if index == 0:
+                # the first shard keeps its own numbering.
+                shard = first
+            else:
+                shard = _Shard(generator._generate_xslfo(shard_params[index]))
+            if index and shard.numbered_by_start:
+                # guess that the shards have the pages of the first one,
+                # which is the first task and never waits for the others.
+                futures[0].result()
+                start = first_page + first.pages * index
+            shard.start, shard.document, shard.pages = build(shard, start)
+            return shard
+
+        first = _Shard(generator._generate_xslfo(shard_params[0]))
+        first_page = initial_page_number(first.xslfo) or 1
+        futures = []
+        for index in range(count):
+            futures.append(executor.submit(render_and_build, index))
+        shards = [future.result() for future in futures]
+        for passes in range(1, max_passes + 1):
+            starts = [first_page]
+            for shard in shards[:-1]:
+                starts.append(starts[-1] + shard.pages)
+            stale = [index for index, shard in enumerate(shards)
+                     if shard.stale(starts[index])]
+            if not stale:
+                break
+            if passes == max_passes:
+                raise DocumentGeneratorError(
+                    'The page count of the shards is not stable after '
+                    '{} passes'.format(max_passes)
+                )
+            generator.log.debug('Building again the shards %s', stale)
+            for index, built in zip(stale, executor.map(
+                    lambda index: build(shards[index], starts[index]),
+                    stale)):
+                shard = shards[index]
+                shard.start, shard.document, shard.pages = built
+        span.set(passes=passes, pages=sum(shard.pages for shard in shards))
+        document = pdf.concatenate(
+            [shard.document for shard in shards], first_page
+        )
+    return generator._deliver(document, out_format, output)
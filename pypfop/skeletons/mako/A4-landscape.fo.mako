@@ -1,4 +1,7 @@
 <%inherit file="./base.fo.mako" />
+<%!
+   LAYOUT_PARAMS = ('REGION_BODY_MARGIN', 'REGION_AFTER_EXTEND')
+%>\
 <%block name="_page_layout">
     <simple-page-master  master-name="${self.attr.MASTER_NAME}"
                          page-width="210mm"
@@ -1,11 +1,24 @@
 <%!
 MASTER_NAME = 'master-page'
+## The params used by the `_page_layout` and the declarations, they
+## are cached (once translated to XSL-FO) by the values of those params.
+## The templates that define their own `_page_layout` must declare its
+## LAYOUT_PARAMS too, otherwise their layout is not cached.
+LAYOUT_PARAMS = ('REGION_BODY_MARGIN', 'REGION_BEFORE_EXTEND',
+                 'REGION_AFTER_EXTEND', 'REGION_START_EXTEND',
+                 'REGION_END_EXTEND')
+DECLARATIONS_PARAMS = ('TITLE', 'AUTHOR', 'SUBJECT', 'GENERATOR')
 %>
+<%namespace name="fragment" module="pypfop.fragments"/>\
 <root xmlns:fo="http://www.w3.org/1999/XSL/Format" xmlns:fox="http://xmlgraphics.apache.org/fop/extensions">
   <layout-master-set>
-    <%block name="_page_layout" />
+% if fragment.begin('skeleton:layout-master-set', fragment.declared_params(self, '_page_layout', 'LAYOUT_PARAMS')):
+    <%block name="_page_layout" />${fragment.end()}
+% else:
+${fragment.end()}
+% endif
   </layout-master-set>
-  <declarations>
+  <%fragment:cached key="skeleton:declarations" params="${self.attr.DECLARATIONS_PARAMS}"><declarations>
     <x:xmpmeta xmlns:x="adobe:ns:meta/">
       <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
 	    <rdf:Description rdf:about=""  xmlns:dc="http://purl.org/dc/elements/1.1/">
@@ -20,7 +33,7 @@ MASTER_NAME = 'master-page'
 	    </rdf:Description>
       </rdf:RDF>
     </x:xmpmeta>
-  </declarations>
+  </declarations></%fragment:cached>
   <page-sequence master-reference="${self.attr.MASTER_NAME}">
     <static-content flow-name="xsl-region-after">
       <%block name="region_after"> <block /> </%block>
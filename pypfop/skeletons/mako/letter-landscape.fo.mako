@@ -1,6 +1,7 @@
 <%inherit file="./base.fo.mako" />
 <%!
    MASTER_NAME = 'letter-landscape'
+   LAYOUT_PARAMS = ('REGION_BODY_MARGIN', 'REGION_AFTER_EXTEND')
 %>
 
 <%block name="_page_layout">
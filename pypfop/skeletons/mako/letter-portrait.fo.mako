@@ -1,6 +1,9 @@
 <%inherit file="./base.fo.mako" />
 <%!
    MASTER_NAME = 'letter-portrait'
+   LAYOUT_PARAMS = ('REGION_BODY_MARGIN', 'REGION_BEFORE_EXTEND',
+                    'REGION_AFTER_EXTEND', 'REGION_START_EXTEND',
+                    'REGION_END_EXTEND')
 %>
 
 <%block name="_page_layout">
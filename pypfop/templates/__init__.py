@@ -1,4 +1,9 @@
 import os
+import inspect
+import importlib
+import weakref
+
+from pypfop.exceptions import TemplateError
 
 
 BASEDIR = os.path.abspath(
@@ -18,14 +23,41 @@ def skeleton_dir(template_type):
     return os.path.join(SKELDIR, template_type)
 
 
+# The outputs of the `Template.render` methods.
+TEXT_OUTPUT = 'text'
+TREE_OUTPUT = 'tree'
+# The engines of pypfop, imported on their first `get_engine`.
+BUILTIN_ENGINES = ('mako', 'native')
+
+_engines = {}
+# The output of each checked type of template, see `check_template`.
+_checked_types = weakref.WeakKeyDictionary()
+
+
 class Template:
+    # What `render` returns: the xml as a string (or bytes) with
+    # `TEXT_OUTPUT` or an lxml element with `TREE_OUTPUT`, which is
+    # styled and translated to XSL-FO as it is, without serializing and
+    # parsing it again. The element is modified by the translation, so
+    # each render must return a new one.
+    output = TEXT_OUTPUT
 
     def render(self, params):
         raise NotImplementedError()
 
+    def fingerprint(self):
+        """Return a string that identifies the template and its version,
+        it is part of the key of the `pypfop.cache` result caches.
+        """
+        return '{}.{}'.format(
+            type(self).__module__, type(self).__qualname__
+        )
+
 
 class Factory:
     name = ''
+    # Directories of custom skeletons, looked up before the ones of pypfop.
+    custom_skel_dirs = ()
 
     def __call__(self, template):
         raise NotImplementedError()
@@ -33,3 +65,91 @@ class Factory:
     @property
     def skel_dir(self):
         return skeleton_dir(self.name)
+
+    @property
+    def skel_dirs(self):
+        """All the skeleton directories, the custom ones first."""
+        return list(self.custom_skel_dirs) + [self.skel_dir]
+
+
+def register_engine(factory):
+    """Register the template `factory` (a `Factory` subclass) by its
+    `name`, to be returned by `get_engine`. It can be used as a class
+    decorator.
+    """
+    if not factory.name:
+        raise TemplateError(
+            'The template factory {} has no name'.format(factory)
+        )
+    _engines[factory.name] = factory
+    return factory
+
+
+def get_engine(name):
+    """Return the template factory registered as `name`, the built-in
+    engines are imported the first time they are requested.
+    """
+    if name not in _engines and name in BUILTIN_ENGINES:
+        importlib.import_module('{}.{}'.format(__name__, name))
+    try:
+        return _engines[name]
+    except KeyError:
+        raise TemplateError('Unknown template engine {}'.format(name))
+
+
+def engine_names():
+    """Return the names of the registered (and built-in) engines."""
+    return sorted(set(_engines).union(BUILTIN_ENGINES))
+
+
+def _check_render(render, args, template):
+    if not callable(render):
+        raise TemplateError(
+            'The template object {} does not implement '
+            'a callable "render" property (method)'.format(template)
+        )
+    if inspect.ismethod(render):
+        args += 1
+    try:
+        spec = inspect.getfullargspec(render)
+    except TypeError:
+        # builtins and the like, trust them.
+        return
+    if len(spec.args) != args:
+        raise TemplateError(
+            'The template object {} does not implement '
+            'a 1 argument "render" property (method)'.format(template)
+        )
+
+
+def _output(template):
+    # anything else than a tree is text, like on the templates without
+    # an `output`.
+    if getattr(template, 'output', TEXT_OUTPUT) == TREE_OUTPUT:
+        return TREE_OUTPUT
+    return TEXT_OUTPUT
+
+
+def check_template(template):
+    """Check that `template` has a `render` method with the params as
+    its only argument and return its `output`.
+
+    The check of the methods is done once per type of template, only
+    the templates with their own `render` attribute are checked each
+    time.
+    """
+    if 'render' in getattr(template, '__dict__', ()):
+        _check_render(template.render, 1, template)
+        return _output(template)
+    template_type = type(template)
+    output = _checked_types.get(template_type)
+    if output is None:
+        render = inspect.getattr_static(template_type, 'render', None)
+        if not inspect.isfunction(render):
+            # not a plain method, check the attribute of the instance.
+            _check_render(getattr(template, 'render', None), 1, template)
+            return _output(template)
+        _check_render(render, 2, template)
+        output = _output(template_type)
+        _checked_types[template_type] = output
+    return output
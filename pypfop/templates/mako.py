@@ -1,17 +1,76 @@
+import os
+import functools
+
 import mako.exceptions
+import mako.lexer
 import mako.lookup
+import mako.parsetree
+import mako.runtime
 
 import pypfop
 import pypfop.templates
 import pypfop.exceptions
 
 
-def get_lookup(lookup_dirs, input_enc='utf-8', output_enc='utf-8'):
+TEMPLATE_SUFFIX = '.mako'
+
+
+def get_lookup(lookup_dirs, input_enc='utf-8', output_enc='utf-8',
+               module_directory=None):
     if isinstance(lookup_dirs, str):
         lookup_dirs = (lookup_dirs,)
     return mako.lookup.TemplateLookup(directories=lookup_dirs,
                                       input_encoding=input_enc,
-                                      output_encoding=output_enc)
+                                      output_encoding=output_enc,
+                                      module_directory=module_directory)
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_lookup(lookup_dirs, input_enc, output_enc, module_directory):
+    return get_lookup(
+        list(lookup_dirs), input_enc, output_enc, module_directory
+    )
+
+
+def find_templates(lookup_dirs):
+    """Yield the uri of each template (file ending with `TEMPLATE_SUFFIX`)
+    inside the `lookup_dirs`, hidden directories are skipped.
+    """
+    for lookup_dir in lookup_dirs:
+        for dirpath, dirnames, filenames in os.walk(lookup_dir):
+            dirnames[:] = sorted(name for name in dirnames
+                                 if not name.startswith('.'))
+            for filename in sorted(filenames):
+                if filename.endswith(TEMPLATE_SUFFIX):
+                    relpath = os.path.relpath(
+                        os.path.join(dirpath, filename), lookup_dir
+                    )
+                    yield '/' + relpath.replace(os.sep, '/')
+
+
+def _file_dependencies(template):
+    """Return the uris of the files of the ``inherit``, ``include`` and
+    ``namespace`` tags of the mako `template`, relative to the template.
+    The files set with an expression can't be known before the render
+    and are skipped.
+    """
+    uris = []
+    nodes = [mako.lexer.Lexer(template.source).parse()]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, (mako.parsetree.InheritTag,
+                             mako.parsetree.IncludeTag,
+                             mako.parsetree.NamespaceTag)):
+            uri = node.attributes.get('file')
+            if uri and '${' not in uri:
+                uris.append(uri)
+        nodes.extend(reversed(node.get_children()))
+    return uris
+
+
+# filename -> (mtime, size, uris of the files used by the template), the
+# entry of a file is replaced when it changes.
+_dependencies = {}
 
 
 class Template(pypfop.templates.Template):
@@ -20,8 +79,78 @@ class Template(pypfop.templates.Template):
         self.template_path = template_path
         self.lookup = lookup
 
+    def __getstate__(self):
+        # The lookup holds a lock and can't be pickled, send its
+        # settings instead and share a lookup per process when unpickled.
+        state = self.__dict__.copy()
+        state['lookup'] = (
+            tuple(self.lookup.directories),
+            self.lookup.template_args['input_encoding'],
+            self.lookup.template_args['output_encoding'],
+            self.lookup.template_args['module_directory']
+        )
+        return state
+
+    def __setstate__(self, state):
+        state['lookup'] = _shared_lookup(*state['lookup'])
+        self.__dict__.update(state)
+
+    def _get_template(self):
+        # Use the same uri of the precompiled and inherited templates,
+        # to not compile the same template twice.
+        return self.lookup.get_template(
+            self.lookup.adjust_uri(self.template_path, None)
+        )
+
+    def _file_chain(self):
+        """Yield the mako template and each template it inherits,
+        includes or imports as a namespace (recursively), once, with the
+        stat of its file (None without a file).
+        """
+        pending = [self._get_template()]
+        seen = set()
+        while pending:
+            template = pending.pop(0)
+            if template.uri in seen:
+                continue
+            seen.add(template.uri)
+            if template.filename is None:
+                yield template, None
+                continue
+            stat = os.stat(template.filename)
+            yield template, stat
+            version = (stat.st_mtime_ns, stat.st_size)
+            cached = _dependencies.get(template.filename)
+            if cached is not None and cached[:2] == version:
+                uris = cached[2]
+            else:
+                uris = _file_dependencies(template)
+                _dependencies[template.filename] = version + (uris, )
+            for uri in uris:
+                pending.append(self.lookup.get_template(
+                    self.lookup.adjust_uri(uri, template.uri)
+                ))
+
+    def fingerprint(self):
+        """Identify the template by the uri, the path, the modification
+        time and the size of its file and of the files of the templates
+        that it inherits, includes or imports (the skeletons, etc).
+        The templates chosen with an expression (``file="${name}"``) are
+        not part of it.
+        """
+        parts = []
+        for template, stat in self._file_chain():
+            if stat is None:
+                parts.append(template.uri)
+                continue
+            parts.append('{}:{}:{}:{}'.format(
+                template.uri, template.filename, stat.st_mtime_ns,
+                stat.st_size
+            ))
+        return '|'.join(parts)
+
     def render(self, params):
-        template = self.lookup.get_template(self.template_path)
+        template = self._get_template()
         try:
             return template.render(**params)
         except Exception:
@@ -29,17 +158,75 @@ class Template(pypfop.templates.Template):
                 mako.exceptions.text_error_template().render()
             )
 
+    def render_stream(self, params, write):
+        """Render the template calling `write` with each piece of the
+        output as it is generated, instead of returning the whole output.
+        """
+        template = self._get_template()
+        try:
+            template.render_context(
+                mako.runtime.Context(_Writer(write), **params)
+            )
+        except Exception:
+            raise pypfop.exceptions.TemplateError(
+                mako.exceptions.text_error_template().render()
+            )
 
+
+class _Writer:
+    """Output buffer of the mako context of `Template.render_stream`."""
+
+    def __init__(self, write):
+        self.write = write
+
+
+@pypfop.templates.register_engine
 class Factory(pypfop.templates.Factory):
+    """Factory of mako templates.
+
+    With a `module_directory` the compiled templates are stored there
+    and reused by the next processes instead of compiling them again.
+    With `preload` all the templates of the lookup directories (and the
+    skeletons) are compiled on the creation of the factory instead of
+    on the first render of each one of them.
+
+    The `skel_dirs` are directories with custom skeletons, which can
+    inherit ``base.fo.mako`` (and set its ``LAYOUT_PARAMS``) to get their
+    page layout and declarations cached as XSL-FO, like the skeletons of
+    pypfop, check `pypfop.fragments`.
+    """
     name = 'mako'
 
-    def __init__(self, lookup_dirs=None, use_skels=True):
+    def __init__(self, lookup_dirs=None, use_skels=True,
+                 module_directory=None, preload=False, skel_dirs=None):
+        if isinstance(skel_dirs, str):
+            skel_dirs = (skel_dirs, )
+        if skel_dirs is not None:
+            self.custom_skel_dirs = tuple(skel_dirs)
         lookup_dirs = self._get_lookup_dirs(lookup_dirs, use_skels)
-        self.lookup = get_lookup(lookup_dirs)
+        self.lookup = get_lookup(
+            lookup_dirs, module_directory=module_directory
+        )
+        if preload:
+            self.precompile()
 
     def __call__(self, template):
         return Template(template, self.lookup)
 
+    def precompile(self):
+        """Compile all the templates of the lookup directories,
+        return the list of their uris.
+        """
+        uris = list(find_templates(self.lookup.directories))
+        for uri in uris:
+            try:
+                self.lookup.get_template(uri)
+            except Exception:
+                raise pypfop.exceptions.TemplateError(
+                    mako.exceptions.text_error_template().render()
+                )
+        return uris
+
     def _get_lookup_dirs(self, lookup_dirs, use_skels):
         if lookup_dirs is None:
             lookup_dirs = ['.', ]
@@ -49,5 +236,5 @@ class Factory(pypfop.templates.Factory):
             else:
                 lookup_dirs = list(lookup_dirs)
         if use_skels:
-            lookup_dirs.append(self.skel_dir)
+            lookup_dirs.extend(self.skel_dirs)
         return lookup_dirs
@@ -0,0 +1,103 @@
+"""Templates written in python, which build the lxml tree of the
+document instead of its markup::
+
+    from lxml.builder import E
+
+    def receipt(params):
+        return E.root(E.block('Total: {}'.format(params['total'])))
+
+    template = pypfop.templates.native.Factory()(receipt)
+
+The tree is styled and translated to XSL-FO as it is, without being
+serialized and parsed again, which makes them the fastest templates
+for the small and frequent documents. They have no skeletons.
+"""
+import os
+import importlib
+import traceback
+
+import lxml.etree
+
+import pypfop.templates
+import pypfop.exceptions
+
+
+def import_function(path):
+    """Return the function of the ``module:name`` `path`."""
+    module, sep, name = path.partition(':')
+    if not sep:
+        raise pypfop.exceptions.TemplateError(
+            'Invalid template {}, it must be module:function'.format(path)
+        )
+    try:
+        function = importlib.import_module(module)
+    except ImportError:
+        raise pypfop.exceptions.TemplateError(
+            'Unable to import the module of the template {}'.format(path)
+        )
+    try:
+        for attribute in name.split('.'):
+            function = getattr(function, attribute)
+    except AttributeError:
+        raise pypfop.exceptions.TemplateError(
+            'The module {} has no template {}'.format(module, name)
+        )
+    return function
+
+
+class Template(pypfop.templates.Template):
+    """Template of the `function` that returns a new lxml element (or
+    element tree) for the params.
+
+    The module level functions can be pickled, to render the template
+    on other processes.
+    """
+    output = pypfop.templates.TREE_OUTPUT
+
+    def __init__(self, function):
+        self.function = function
+
+    def fingerprint(self):
+        name = '{}:{}'.format(
+            getattr(self.function, '__module__', None),
+            getattr(self.function, '__qualname__',
+                    type(self.function).__qualname__)
+        )
+        code = getattr(self.function, '__code__', None)
+        if code is None or not os.path.isfile(code.co_filename):
+            return name
+        stat = os.stat(code.co_filename)
+        return '{}:{}:{}:{}'.format(
+            name, code.co_filename, stat.st_mtime_ns, stat.st_size
+        )
+
+    def render(self, params):
+        try:
+            tree = self.function(params)
+        except Exception:
+            raise pypfop.exceptions.TemplateError(traceback.format_exc())
+        if hasattr(tree, 'getroot'):
+            tree = tree.getroot()
+        if not lxml.etree.iselement(tree):
+            raise pypfop.exceptions.TemplateError(
+                'The template {} did not return an lxml element'
+                .format(self.fingerprint())
+            )
+        return tree
+
+
+@pypfop.templates.register_engine
+class Factory(pypfop.templates.Factory):
+    """Factory of python templates, from a function or the
+    ``module:function`` path of one.
+    """
+    name = 'native'
+
+    def __call__(self, template):
+        if isinstance(template, str):
+            template = import_function(template)
+        if not callable(template):
+            raise pypfop.exceptions.TemplateError(
+                'The template {} is not callable'.format(template)
+            )
+        return Template(template)
@@ -0,0 +1,80 @@
+"""Stand-ins of the FOP services, for the tests and the benchmarks of
+pypfop (and of the applications that use it) without Java::
+
+    server = start_server(FakeFopsHandler.recording())
+    doc_builder = FopsBuilder(*server.server_address)
+    ...
+    server.shutdown()
+    server.server_close()
+"""
+import gzip
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeFopsHandler(BaseHTTPRequestHandler):
+    """Stand-in of the fops server, the document is the received XSL-FO
+    (form encoded or a raw and maybe gzipped body, chunked or not). The
+    documents with ``ERROR`` get an error 500, like the invalid ones.
+
+    The handlers of `recording` count the `connections` and keep the
+    `requests` as ``(path, headers, body)``.
+    """
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    requests = None
+
+    @classmethod
+    def recording(cls):
+        """Return a new subclass that records its own connections and
+        requests.
+        """
+        return type(cls.__name__, (cls, ), {'connections': 0,
+                                            'requests': []})
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        type(self).connections += 1
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers['Content-Length']))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            chunk = self.rfile.read(size + 2)[:size]
+            if not size:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.requests is not None:
+            self.requests.append((self.path, dict(self.headers), body))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        if self.headers['Content-Type'].startswith('application/xml'):
+            document = body
+        else:
+            document = parse_qs(body)[b'document'][0]
+        if b'ERROR' in document:
+            payload, status = b'Invalid document', 500
+        else:
+            payload, status = document, 200
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(handler):
+    """Serve `handler` on a free local port from a daemon thread, return
+    the server to shut it down and close it once done.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,214 @@
+"""Structural validation of the XSL-FO documents before they are built.
+
+A malformed document is otherwise only found by fop, after paying for
+its start. The generators with a `fo_schema`, like the process-wide
+`fo_schema`::
+
+    DocumentGenerator(template, stylesheets, fo_schema=fo_schema)
+
+check the nesting of the `fo:` elements and their required attributes
+on each document, raising a `DocumentGeneratorError` with the path of
+the invalid elements without calling the builder.
+
+The schemas are compact text files (check ``schemas/xsl-fo.schema``)
+compiled once into a table of the allowed children and the required
+attributes by element.
+"""
+import os
+import re
+import functools
+
+import lxml.etree
+
+from pypfop.exceptions import DocumentGeneratorError
+
+
+FO_NAMESPACE = 'http://www.w3.org/1999/XSL/Format'
+SCHEMA_PATH = os.path.join(
+    os.path.dirname(__file__), 'schemas', 'xsl-fo.schema'
+)
+
+_DECLARATION_RE = re.compile(
+    r'(?P<name>[\w@.-]+)\s*(?:=(?P<group>.*)|'
+    r'(?:\[(?P<required>[^\]]*)\])?\s*:(?P<children>.*))$'
+)
+_FO_PREFIX = '{{{}}}'.format(FO_NAMESPACE)
+
+
+def _clark(name):
+    return _FO_PREFIX + name
+
+
+def _local(tag):
+    return 'fo:' + tag[len(_FO_PREFIX):]
+
+
+def _declarations(lines, source):
+    """Yield the ``(line number, declaration)`` of the schema `lines`,
+    joining the continuation lines (the indented ones).
+    """
+    declaration = None
+    for number, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].rstrip()
+        if not line:
+            continue
+        if line[0].isspace():
+            if declaration is None:
+                raise DocumentGeneratorError(
+                    'Unexpected continuation on {}:{}'.format(source, number)
+                )
+            declaration = (declaration[0], declaration[1] + ' ' + line)
+            continue
+        if declaration is not None:
+            yield declaration
+        declaration = (number, line)
+    if declaration is not None:
+        yield declaration
+
+
+class FOSchema:
+    """Compiled structural schema of XSL-FO.
+
+    `rules` maps the (Clark) name of each known `fo:` element to the
+    frozenset of the names of its allowed `fo:` children (None for any)
+    and the tuple of its required attributes. Use `from_text` or
+    `load` to compile a schema.
+    """
+
+    def __init__(self, rules, source=None):
+        self.rules = rules
+        self.source = source
+
+    def __reduce__(self):
+        # the default schema is compiled once per process.
+        if self is fo_schema:
+            return 'fo_schema'
+        return (type(self), (self.rules, self.source))
+
+    @classmethod
+    def from_text(cls, text, source='<string>'):
+        groups = {}
+        declared = {}
+        for number, declaration in _declarations(text.splitlines(), source):
+            match = _DECLARATION_RE.match(declaration)
+            if match is None or \
+                    (match.group('group') is None) == match.group(
+                        'name').startswith('@'):
+                raise DocumentGeneratorError(
+                    'Invalid declaration on {}:{}'.format(source, number)
+                )
+            name = match.group('name')
+            if match.group('group') is not None:
+                groups[name] = (number, match.group('group').split())
+            else:
+                declared[name] = (number, (match.group('required') or '')
+                                  .split(), match.group('children').split())
+
+        def expand(names, number, seen=()):
+            for name in names:
+                if not name.startswith('@'):
+                    yield name
+                    continue
+                if name not in groups or name in seen:
+                    raise DocumentGeneratorError(
+                        'Unknown or recursive group {} on {}:{}'
+                        .format(name, source, number)
+                    )
+                group_number, members = groups[name]
+                yield from expand(members, group_number, seen + (name, ))
+
+        rules = {}
+        for name, (number, required, children) in declared.items():
+            if children == ['*']:
+                allowed = None
+            else:
+                allowed = frozenset(expand(children, number))
+                unknown = allowed.difference(declared)
+                if unknown:
+                    raise DocumentGeneratorError(
+                        'Undeclared elements {} on {}:{}'.format(
+                            ', '.join(sorted(unknown)), source, number
+                        )
+                    )
+                allowed = frozenset(_clark(child) for child in allowed)
+            rules[_clark(name)] = (allowed, tuple(required))
+        return cls(rules, source)
+
+    @classmethod
+    def load(cls, path):
+        """Return the compiled schema of the file `path`, each file is
+        compiled only once.
+        """
+        return _load_schema(os.path.abspath(path))
+
+    def iter_errors(self, xslfo):
+        """Yield the ``(path, message)`` of each error of the XSL-FO
+        document `xslfo` (bytes or an lxml element).
+        """
+        if isinstance(xslfo, (bytes, str)):
+            try:
+                root = lxml.etree.fromstring(xslfo)
+            except lxml.etree.XMLSyntaxError as error:
+                yield ('/', 'not well-formed: {}'.format(error))
+                return
+        else:
+            root = xslfo
+        if root.tag != _clark('root'):
+            yield ('/', 'the root element must be fo:root, not {}'
+                   .format(root.tag))
+            return
+        getpath = root.getroottree().getpath
+        rules = self.rules
+        # allowed children of each open element, None for any.
+        stack = []
+        for event, elem in lxml.etree.iterwalk(root, ('start', 'end')):
+            if event == 'end':
+                stack.pop()
+                continue
+            tag = elem.tag
+            if not tag.startswith(_FO_PREFIX):
+                # the content of the other namespaces is not checked.
+                stack.append(None)
+                continue
+            rule = rules.get(tag)
+            if rule is None:
+                yield (getpath(elem), 'unknown element {}'.format(
+                    _local(tag)
+                ))
+                stack.append(None)
+                continue
+            if stack and stack[-1] is not None and tag not in stack[-1]:
+                parent = elem.getparent()
+                yield (getpath(elem), '{} is not allowed in {}'.format(
+                    _local(tag), _local(parent.tag)
+                ))
+            allowed, required = rule
+            for attribute in required:
+                if elem.get(attribute) is None:
+                    yield (getpath(elem), 'missing the {} attribute'
+                           .format(attribute))
+            stack.append(allowed)
+
+    def validate(self, xslfo, max_errors=10):
+        """Raise a `DocumentGeneratorError` with the first `max_errors`
+        errors of the XSL-FO document `xslfo`, if it is not valid.
+        """
+        errors = []
+        for path, message in self.iter_errors(xslfo):
+            errors.append('{}: {}'.format(path, message))
+            if len(errors) > max_errors:
+                errors[-1] = '...'
+                break
+        if errors:
+            raise DocumentGeneratorError(
+                'Invalid XSL-FO document:\n  {}'.format('\n  '.join(errors))
+            )
+
+
+@functools.lru_cache(maxsize=None)
+def _load_schema(path):
+    with open(path) as schema_file:
+        return FOSchema.from_text(schema_file.read(), path)
+
+
+fo_schema = FOSchema.load(SCHEMA_PATH)
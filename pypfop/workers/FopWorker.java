@@ -0,0 +1,123 @@
+/*
+ * Long lived FOP worker used by pypfop.builder.WorkerPoolBuilder.
+ *
+ * Protocol (one document at a time):
+ *
+ *   request:  "<format> <length>\n" followed by <length> bytes of XSL-FO.
+ *   response: "<OK|ERR> <length>\n" followed by <length> bytes with
+ *             either the generated document or the error message.
+ *
+ * The worker exits when its standard input is closed. An optional
+ * first argument is the path of a FOP configuration file.
+ *
+ * Build it with the FOP jars in the classpath:
+ *
+ *   javac -cp "$FOP_HOME/build/*:$FOP_HOME/lib/*" FopWorker.java
+ */
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+import java.util.HashMap;
+import java.util.Map;
+
+import javax.xml.transform.Transformer;
+import javax.xml.transform.TransformerFactory;
+import javax.xml.transform.sax.SAXResult;
+import javax.xml.transform.stream.StreamSource;
+
+import org.apache.fop.apps.Fop;
+import org.apache.fop.apps.FopFactory;
+import org.apache.fop.apps.MimeConstants;
+
+
+public final class FopWorker {
+
+    private static final Map<String, String> MIME_TYPES = new HashMap<>();
+
+    static {
+        MIME_TYPES.put("pdf", MimeConstants.MIME_PDF);
+        MIME_TYPES.put("rtf", MimeConstants.MIME_RTF);
+        MIME_TYPES.put("tiff", MimeConstants.MIME_TIFF);
+        MIME_TYPES.put("png", MimeConstants.MIME_PNG);
+        MIME_TYPES.put("pcl", MimeConstants.MIME_PCL);
+        MIME_TYPES.put("ps", MimeConstants.MIME_POSTSCRIPT);
+        MIME_TYPES.put("txt", MimeConstants.MIME_PLAIN_TEXT);
+    }
+
+    private FopWorker() {
+    }
+
+    private static String readHeader(DataInputStream in) throws IOException {
+        StringBuilder header = new StringBuilder();
+        int chr;
+        while ((chr = in.read()) != '\n') {
+            if (chr == -1) {
+                if (header.length() == 0) {
+                    return null;
+                }
+                throw new EOFException("Truncated request header");
+            }
+            header.append((char) chr);
+        }
+        return header.toString();
+    }
+
+    private static void respond(OutputStream out, String status,
+                                byte[] payload) throws IOException {
+        String header = status + " " + payload.length + "\n";
+        out.write(header.getBytes(StandardCharsets.US_ASCII));
+        out.write(payload);
+        out.flush();
+    }
+
+    public static void main(String[] args) throws Exception {
+        FopFactory fopFactory;
+        if (args.length > 0) {
+            fopFactory = FopFactory.newInstance(new File(args[0]));
+        } else {
+            fopFactory = FopFactory.newInstance(new File(".").toURI());
+        }
+        TransformerFactory transformerFactory = TransformerFactory.newInstance();
+        DataInputStream in = new DataInputStream(
+            new BufferedInputStream(System.in));
+        OutputStream out = new BufferedOutputStream(
+            new FileOutputStream(FileDescriptor.out));
+        // Keep the standard output reserved for the protocol.
+        System.setOut(new PrintStream(System.err, true));
+
+        String header;
+        while ((header = readHeader(in)) != null) {
+            String[] parts = header.trim().split(" ");
+            byte[] document = new byte[Integer.parseInt(parts[1])];
+            in.readFully(document);
+            ByteArrayOutputStream result = new ByteArrayOutputStream();
+            try {
+                String mimeType = MIME_TYPES.get(parts[0]);
+                if (mimeType == null) {
+                    throw new IllegalArgumentException(
+                        "Unsupported output format " + parts[0]);
+                }
+                Fop fop = fopFactory.newFop(mimeType, result);
+                Transformer transformer = transformerFactory.newTransformer();
+                transformer.transform(
+                    new StreamSource(new ByteArrayInputStream(document)),
+                    new SAXResult(fop.getDefaultHandler()));
+            } catch (Exception error) {
+                respond(out, "ERR",
+                        String.valueOf(error).getBytes(StandardCharsets.UTF_8));
+                continue;
+            }
+            respond(out, "OK", result.toByteArray());
+        }
+    }
+}
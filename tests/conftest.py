@@ -0,0 +1,54 @@
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from pypfop.testing import FakeFopsHandler, start_server
+
+
+@pytest.fixture
+def fops_handler():
+    """The `FakeFopsHandler` of `fops_server`, with its connections and
+    requests.
+    """
+    return FakeFopsHandler.recording()
+
+
+@pytest.fixture
+def fops_server(fops_handler):
+    server = start_server(fops_handler)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class FakeResourcesHandler(BaseHTTPRequestHandler):
+    resources = {
+        '/logo.png': (b'\x89PNG logo', 'image/png'),
+        '/photo.jpg': (b'\xff\xd8 photo' * 10, 'image/jpeg'),
+    }
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path not in self.resources:
+            self.send_error(404)
+            return
+        content, content_type = self.resources[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def resources_server():
+    """Local stand-in of a server of images, yield its base url."""
+    FakeResourcesHandler.requests = []
+    server = start_server(FakeResourcesHandler)
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
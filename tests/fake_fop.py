@@ -0,0 +1,30 @@
+"""Stand-in of the fop command line used on the tests.
+
+It only supports ``-q -fo - -<format> <output>`` (with ``-`` as the
+output to write to the standard output), the generated
+"document" is the format followed by the received XSL-FO and a
+document containing "ERROR" makes it fail and one containing "HANG"
+never ends.
+"""
+import sys
+import time
+
+
+def main(args):
+    document = sys.stdin.buffer.read()
+    if b'ERROR' in document:
+        sys.stderr.write('Invalid document')
+        sys.exit(1)
+    if b'HANG' in document:
+        time.sleep(600)
+    out_format, output = args[-2:]
+    content = out_format[1:].encode() + b':' + document
+    if output == '-':
+        sys.stdout.buffer.write(content)
+    else:
+        with open(output, 'wb') as outfile:
+            outfile.write(content)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,97 @@
+"""Stand-in of the fop command line that builds real (tiny) PDF documents,
+used on the tests of the sharded documents.
+
+Like ``fake_fop.py`` it only supports ``-q -fo - -pdf <output>``. Each
+row of the table bodies and each top level block of the flow is a page,
+which shows the text of the table header and the one of the row (or
+block) and, if the document has ``fo:page-number`` elements, its page
+number from the ``initial-page-number`` of the first page sequence.
+The objects are laid out like the ones of fop: with an information
+dictionary and indirect stream lengths.
+"""
+import sys
+from xml.etree import ElementTree
+
+FO = '{http://www.w3.org/1999/XSL/Format}'
+
+
+def _text(elem):
+    return ' '.join(''.join(elem.itertext()).split())
+
+
+def pages(root):
+    sequence = root.find(FO + 'page-sequence')
+    number = int(sequence.get('initial-page-number', '1'))
+    numbered = root.find('.//' + FO + 'page-number') is not None
+    flow = sequence.find(FO + 'flow')
+    for elem in flow:
+        if elem.tag == FO + 'table':
+            header = elem.find(FO + 'table-header')
+            header = '' if header is None else _text(header) + ' | '
+            lines = [header + _text(row)
+                     for body in elem.iter(FO + 'table-body')
+                     for row in body.iter(FO + 'table-row')]
+        else:
+            lines = [_text(elem)]
+        for line in lines:
+            if numbered:
+                line = 'page {}: {}'.format(number, line)
+            yield line
+            number += 1
+
+
+def write_pdf(lines):
+    objects = [
+        b'<< /Producer (fake fop) /Title (sharded) >>',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    kids = []
+    pages_number = 3 + 3 * len(lines)
+    for line in lines:
+        content = 'BT /F1 12 Tf 72 720 Td ({}) Tj ET'.format(
+            line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        ).encode('latin-1')
+        number = len(objects) + 1
+        objects.append(b'<< /Length %d 0 R >>\nstream\n%s\nendstream'
+                       % (number + 1, content))
+        objects.append(b'%d' % len(content))
+        objects.append(
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] '
+            b'/Resources << /Font << /F1 2 0 R >> >> /Contents %d 0 R >>'
+            % (pages_number, number)
+        )
+        kids.append(b'%d 0 R' % (number + 2))
+    objects.append(b'<< /Type /Pages /Count %d /Kids [%s] >>'
+                   % (len(kids), b' '.join(kids)))
+    objects.append(b'<< /Type /Catalog /Pages %d 0 R /PageLabels %d 0 R >>'
+                   % (pages_number, pages_number + 2))
+    objects.append(b'<< /Nums [0 << /S /D >>] >>')
+    output = [b'%PDF-1.4\n%\xaa\xab\xac\xad\n']
+    offsets = []
+    for number, content in enumerate(objects, 1):
+        offsets.append(sum(len(part) for part in output))
+        output.append(b'%d 0 obj\n%s\nendobj\n' % (number, content))
+    xref = sum(len(part) for part in output)
+    output.append(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    output.extend(b'%010d 00000 n \n' % offset for offset in offsets)
+    output.append(
+        b'trailer\n<<\n/Size %d\n/Root %d 0 R\n/Info 1 0 R\n'
+        b'/ID [<00> <00>]\n>>\nstartxref\n%d\n%%%%EOF\n'
+        % (len(objects) + 1, pages_number + 1, xref)
+    )
+    return b''.join(output)
+
+
+def main(args):
+    root = ElementTree.fromstring(sys.stdin.buffer.read())
+    content = write_pdf(list(pages(root)))
+    output = args[-1]
+    if output == '-':
+        sys.stdout.buffer.write(content)
+    else:
+        with open(output, 'wb') as outfile:
+            outfile.write(content)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,41 @@
+"""Stand-in of pypfop/workers/FopWorker.java used on the tests.
+
+The generated "document" is the pid of the worker followed by the
+received XSL-FO, a document containing "CRASH" kills the worker, one
+containing "HANG" never gets an answer and one containing "ERROR" is
+reported as a failure. The failures are logged on the standard error.
+"""
+import os
+import sys
+import time
+
+
+def main():
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    while True:
+        header = stdin.readline()
+        if not header:
+            break
+        out_format, length = header.split()
+        document = stdin.read(int(length))
+        if b'CRASH' in document:
+            sys.stderr.write('java.lang.OutOfMemoryError\n')
+            sys.exit(1)
+        if b'HANG' in document:
+            sys.stderr.write('hanging on {}\n'.format(os.getpid()))
+            sys.stderr.flush()
+            time.sleep(60)
+        if b'ERROR' in document:
+            sys.stderr.write('SEVERE: invalid property\n')
+            sys.stderr.flush()
+            status, payload = b'ERR', b'Invalid document'
+        else:
+            status = b'OK'
+            payload = b'%d:%s:%s' % (os.getpid(), out_format, document)
+        stdout.write(b'%s %d\n' % (status, len(payload)))
+        stdout.write(payload)
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import os
+import sys
+import asyncio
+import logging
+from unittest.mock import Mock, patch
+
+import pytest
+
+from pypfop import builder, cache
+from pypfop.document_generator import DocumentGenerator
+from pypfop.exceptions import DocumentGeneratorError
+
+
+FAKE_FOP_CMD = os.path.join(os.path.dirname(__file__), 'fake_fop.py')
+
+
+def _read(path):
+    with open(path, 'rb') as document:
+        return document.read()
+
+
+def test_async_subprocess_builder(tmp_path):
+    doc_builder = builder.AsyncSubprocessBuilder(
+        sys.executable, [FAKE_FOP_CMD], max_concurrency=2
+    )
+    doc_builder.tempdir = str(tmp_path)
+
+    async def build_all():
+        return await asyncio.gather(*[
+            doc_builder(b'<root>%d</root>' % num, 'pdf', Mock(logging.Logger))
+            for num in range(5)
+        ])
+
+    paths = asyncio.run(build_all())
+    assert [_read(path) for path in paths] == [
+        b'pdf:<root>%d</root>' % num for num in range(5)
+    ]
+    with pytest.raises(builder.BuilderError, match='Invalid document'):
+        asyncio.run(
+            doc_builder(b'<root>ERROR</root>', 'pdf', Mock(logging.Logger))
+        )
+
+
+def test_async_subprocess_builder_cancelled(tmp_path):
+    doc_builder = builder.AsyncSubprocessBuilder(
+        sys.executable, [FAKE_FOP_CMD]
+    )
+    doc_builder.tempdir = str(tmp_path)
+    processes = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def create(*args, **kwargs):
+        processes.append(await create_subprocess_exec(*args, **kwargs))
+        return processes[-1]
+
+    with patch.object(asyncio, 'create_subprocess_exec', create):
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(
+                doc_builder(b'<root>HANG</root>', 'pdf',
+                            Mock(logging.Logger)),
+                timeout=1
+            ))
+    assert processes[0].returncode is not None
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_async_fops_builder_reuses_connections(fops_server, fops_handler,
+                                               tmp_path):
+    host, port = fops_server.server_address
+    doc_builder = builder.AsyncFopsBuilder(
+        host, port, pool_size=2, user='user', passwd='secret'
+    )
+    doc_builder.tempdir = str(tmp_path)
+
+    async def build_all():
+        paths = await asyncio.gather(*[
+            doc_builder('<root>%d</root>' % num, 'png', Mock(logging.Logger))
+            for num in range(10)
+        ])
+        doc_builder.close()
+        return paths
+
+    paths = asyncio.run(build_all())
+    assert [_read(path) for path in paths] == [
+        b'<root>%d</root>' % num for num in range(10)
+    ]
+    assert fops_handler.connections == 2
+    path, headers, _ = fops_handler.requests[0]
+    assert path == '/png'
+    assert headers['Authorization'] == 'Basic dXNlcjpzZWNyZXQ='
+
+
+def test_async_fops_builder_errors(fops_server, tmp_path):
+    host, port = fops_server.server_address
+    doc_builder = builder.AsyncFopsBuilder(host, port, timeout=5)
+    with pytest.raises(builder.BuilderError, match='code 500'):
+        asyncio.run(doc_builder('ERROR', 'pdf', Mock(logging.Logger)))
+    fops_server.shutdown()
+    fops_server.server_close()
+    with pytest.raises(builder.BuilderError, match='Unable to build'):
+        asyncio.run(doc_builder('<root/>', 'pdf', Mock(logging.Logger)))
+
+
+def test_agenerate(fops_server, tmp_path):
+    host, port = fops_server.server_address
+    template = Mock(spec=['render'])
+    template.render = lambda params: '<root>{}</root>'.format(params['name'])
+    generator = DocumentGenerator.from_async_fops(
+        host, port, template, tempdir=str(tmp_path)
+    )
+    path = asyncio.run(generator.agenerate({'name': 'async'}))
+    assert b'<fo:root' in _read(path)
+    assert b'async' in _read(path)
+    document = asyncio.run(generator.agenerate({'name': 'x'}, output='bytes'))
+    assert document.startswith(b'<?xml')
+    with pytest.raises(DocumentGeneratorError):
+        generator.generate({'name': 'sync'})
+
+
+def test_agenerate_with_result_cache(fops_server, fops_handler, tmp_path):
+    host, port = fops_server.server_address
+    template = Mock(spec=['render'])
+    template.render = lambda params: '<root>{}</root>'.format(params['name'])
+    generator = DocumentGenerator.from_async_fops(
+        host, port, template, tempdir=str(tmp_path),
+        result_cache=cache.MemoryResultCache()
+    )
+    first = asyncio.run(generator.agenerate({'name': 'x'}, output='bytes'))
+    path = asyncio.run(generator.agenerate({'name': 'x'}))
+    assert os.path.dirname(path) == str(tmp_path)
+    assert _read(path) == first
+    assert len(fops_handler.requests) == 1
+    assert generator.result_cache.stats()['hits'] == 1
+    with pytest.raises(DocumentGeneratorError):
+        asyncio.run(generator.agenerate({'name': 'x'}, streaming=True))
+
+
+def test_agenerate_with_sync_builder(tmp_path):
+    template = Mock(spec=['render'])
+    template.render = lambda params: '<root>{}</root>'.format(params['name'])
+    generator = DocumentGenerator(
+        template, builder=builder.SubprocessBuilder(
+            sys.executable, [FAKE_FOP_CMD]
+        ), tempdir=str(tmp_path), result_cache=cache.MemoryResultCache()
+    )
+    first = asyncio.run(
+        generator.agenerate({'name': 'x'}, output='bytes', streaming=True)
+    )
+    assert first.startswith(b'pdf:')
+    assert asyncio.run(
+        generator.agenerate({'name': 'x'}, output='bytes')
+    ) == first
+    assert generator.result_cache.stats()['hits'] == 1
@@ -0,0 +1,88 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import pypfop.templates.mako
+from pypfop.builder import Builder, BuilderError
+from pypfop.document_generator import DocumentGenerator
+from pypfop.exceptions import TemplateError
+
+
+TEMPLATE = '''\
+<%
+    if fail == 'render':
+        raise ValueError('broken template')
+%>
+<root><block class="name">${name}</block><block>${fail}</block></root>
+'''
+
+
+class EchoBuilder(Builder):
+
+    def __call__(self, xslfo, out_format, log):
+        if b'build' in xslfo:
+            raise BuilderError('broken document')
+        return xslfo
+
+
+@pytest.fixture
+def generator(tmp_path):
+    (tmp_path / 'doc.fo.mako').write_text(TEMPLATE)
+    (tmp_path / 'doc.css').write_text('.name { color: red; }')
+    factory = pypfop.templates.mako.Factory(str(tmp_path), use_skels=False)
+    return DocumentGenerator(
+        factory('doc.fo.mako'), 'doc.css', style_dir=str(tmp_path),
+        builder=EchoBuilder()
+    )
+
+
+def _params(count, failures=None):
+    failures = failures or {}
+    for num in range(count):
+        yield {'name': 'doc-{}'.format(num), 'fail': failures.get(num, '')}
+
+
+def test_mako_template_is_picklable(generator):
+    template = pickle.loads(pickle.dumps(generator.template))
+    assert template.template_path == 'doc.fo.mako'
+    assert template.lookup.directories == generator.template.lookup.directories
+    assert b'<block>x</block>' in template.render({'name': 'x', 'fail': 'x'})
+
+
+def test_generate_many_ordered(generator):
+    results = list(generator.generate_many(_params(10), workers=2))
+    assert [result.index for result in results] == list(range(10))
+    for num, result in enumerate(results):
+        assert result.error is None
+        assert result.params['name'] == 'doc-{}'.format(num)
+        assert result.document == generator._generate_xslfo(result.params)
+
+
+def test_generate_many_captures_errors(generator):
+    results = list(generator.generate_many(
+        _params(6, {1: 'render', 4: 'build'}),
+        executor=ThreadPoolExecutor(2), ordered=False
+    ))
+    assert sorted(result.index for result in results) == list(range(6))
+    errors = {result.index: result.error for result in results
+              if result.error is not None}
+    assert isinstance(errors.pop(1), TemplateError)
+    assert isinstance(errors.pop(4), BuilderError)
+    assert not errors
+
+
+def test_generate_many_is_bounded(generator):
+    consumed = []
+
+    def params():
+        for num, params in enumerate(_params(100)):
+            consumed.append(num)
+            yield params
+
+    results = generator.generate_many(
+        params(), executor=ThreadPoolExecutor(2), max_pending=4
+    )
+    next(results)
+    assert len(consumed) <= 5
+    results.close()
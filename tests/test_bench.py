@@ -0,0 +1,41 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from pypfop import bench
+
+
+def test_bench_main(capsys):
+    assert bench.main(['--rows', '20', '--cols', '3', '--rules', '0',
+                       '--rules', '8', '--repeat', '1']) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert [(result['rows'], result['cols'], result['extra_rules'])
+            for result in report['results']] == [(20, 3, 0), (20, 3, 8)]
+    result = report['results'][1]
+    assert set(result['stages']) == {
+        'render', 'apply_css_sheets', 'translate_to_fo',
+        'xml_to_fo_with_style'
+    }
+    assert set(result['builders']) == set(bench.BUILDERS)
+    rules = [result['sizes']['rules'] for result in report['results']]
+    assert rules[1] == rules[0] + 8
+    assert all(timing > 0 for timing in result['builders'].values())
+
+
+def test_bench_without_builders(capsys):
+    bench.main(['--rows', '5', '--rules', '0', '--repeat', '1',
+                '--no-builders'])
+    report = json.loads(capsys.readouterr().out)
+    assert report['results'][0]['builders'] == {}
+
+
+def test_bench_example_dir(tmp_path, capsys):
+    example_dir = bench.EXAMPLE_DIR
+    with patch.object(bench, 'EXAMPLE_DIR', str(tmp_path / 'missing')):
+        with pytest.raises(SystemExit):
+            bench.main(['--rows', '5', '--no-builders'])
+        assert '--example-dir' in capsys.readouterr().err
+        assert bench.main(['--rows', '5', '--rules', '0', '--repeat', '1',
+                           '--no-builders', '--example-dir',
+                           example_dir]) == 0
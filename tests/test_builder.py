@@ -1,12 +1,17 @@
+import io
+import os
+import gzip
+import sys
+import socket
 import logging
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import Mock, patch
 
 import pytest
 
 from pypfop import builder
-
-
+from pypfop.testing import FakeFopsHandler, start_server
 
 
 def test_builder_invalid_instance():
@@ -70,3 +75,296 @@ def test_subprocess_builder_error_call(subproc_popen_mock):
             builder.SubprocessBuilder('fop')(
                 '<root></root>', 'pdf', Mock(logging.getLogger())
             )
+
+
+FAKE_WORKER_CMD = [
+    sys.executable,
+    os.path.join(os.path.dirname(__file__), 'fake_fop_worker.py')
+]
+
+
+@pytest.fixture
+def worker_pool(tmp_path):
+    pool = builder.WorkerPoolBuilder(FAKE_WORKER_CMD, workers=2, max_jobs=3)
+    pool.tempdir = str(tmp_path)
+    yield pool
+    pool.close()
+
+
+def _build(doc_builder, xslfo=b'<root></root>'):
+    with open(doc_builder(xslfo, 'pdf', Mock(logging.getLogger())),
+              'rb') as document:
+        pid, out_format, content = document.read().split(b':', 2)
+    return int(pid), out_format, content
+
+
+def test_worker_pool_builder_missing_worker_cmd():
+    with patch.dict(os.environ, clear=True):
+        with pytest.raises(builder.BuilderError):
+            builder.WorkerPoolBuilder()
+
+
+def test_worker_pool_builder_from_environment():
+    with patch.dict(os.environ, {'FOP_WORKER_CMD': "java -cp 'a b' W"}):
+        doc_builder = builder.WorkerPoolBuilder()
+    assert doc_builder.worker_cmd == ['java', '-cp', 'a b', 'W']
+
+
+def test_worker_pool_builder_reuses_workers(worker_pool):
+    first_pid, out_format, content = _build(worker_pool)
+    second_pid, _, _ = _build(worker_pool)
+    assert first_pid == second_pid
+    assert (out_format, content) == (b'pdf', b'<root></root>')
+
+
+def test_worker_pool_builder_recycles_after_max_jobs(worker_pool):
+    pids = [_build(worker_pool)[0] for _ in range(4)]
+    assert len(set(pids[:3])) == 1
+    assert pids[3] != pids[0]
+
+
+def test_worker_pool_builder_worker_error(worker_pool):
+    pid, _, _ = _build(worker_pool)
+    with pytest.raises(builder.BuilderError,
+                       match='Invalid document\nSEVERE: invalid property'):
+        _build(worker_pool, b'<root>ERROR</root>')
+    assert _build(worker_pool)[0] == pid
+
+
+def test_worker_pool_builder_restarts_crashed_worker(worker_pool):
+    pid, _, _ = _build(worker_pool)
+    with pytest.raises(builder.BuilderError,
+                       match='died(.|\n)*OutOfMemoryError'):
+        _build(worker_pool, b'<root>CRASH</root>')
+    assert _build(worker_pool)[0] != pid
+
+
+def test_worker_pool_builder_job_timeout(worker_pool):
+    worker_pool.job_timeout = 0.5
+    pid, _, _ = _build(worker_pool)
+    worker = worker_pool._idle.queue[0]
+    with pytest.raises(builder.BuilderError,
+                       match='killed after 0.5 seconds(.|\n)*hanging'):
+        _build(worker_pool, b'<root>HANG</root>')
+    assert not worker.alive
+    assert not os.path.exists(worker.stderr_path)
+    assert _build(worker_pool)[0] != pid
+
+
+def test_worker_pool_builder_concurrent_dispatch(worker_pool):
+    worker_pool.start()
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(
+            lambda num: _build(worker_pool, b'<root>%d</root>' % num),
+            range(12)
+        ))
+    assert [content for (_, _, content) in results] == [
+        b'<root>%d</root>' % num for num in range(12)
+    ]
+    assert len({pid for (pid, _, _) in results}) >= 2
+
+
+def test_worker_pool_builder_close(worker_pool):
+    worker_pool.start()
+    workers = list(worker_pool._idle.queue)
+    worker_pool.close()
+    assert not any(worker.alive for worker in workers)
+    with pytest.raises(builder.BuilderError):
+        _build(worker_pool)
+
+
+FAKE_FOP_CMD = os.path.join(os.path.dirname(__file__), 'fake_fop.py')
+
+
+@pytest.fixture
+def fop_builder(tmp_path):
+    doc_builder = builder.SubprocessBuilder(sys.executable, [FAKE_FOP_CMD])
+    doc_builder.tempdir = str(tmp_path)
+    return doc_builder
+
+
+def test_check_output():
+    for output in (None, 'path', 'bytes', 'chunks', io.BytesIO()):
+        assert builder.check_output(output) is output
+    for output in ('file.pdf', object()):
+        with pytest.raises(builder.BuilderError):
+            builder.check_output(output)
+
+
+def test_subprocess_builder_outputs(fop_builder, tmp_path):
+    log = Mock(logging.getLogger())
+    path = fop_builder(b'<root/>', 'pdf', log)
+    with open(path, 'rb') as document:
+        assert document.read() == b'pdf:<root/>'
+    assert fop_builder(b'<root/>', 'png', log, 'bytes') == b'png:<root/>'
+    chunks = fop_builder(b'<root/>', 'pdf', log, 'chunks')
+    assert b''.join(chunks) == b'pdf:<root/>'
+    outfile = io.BytesIO()
+    assert fop_builder(b'<root/>', 'pdf', log, outfile) is outfile
+    assert outfile.getvalue() == b'pdf:<root/>'
+    assert os.listdir(str(tmp_path)) == [os.path.basename(path)]
+
+
+def test_fops_builder_outputs(fops_server, tmp_path):
+    host, port = fops_server.server_address
+    doc_builder = builder.FopsBuilder(host, port)
+    doc_builder.tempdir = str(tmp_path)
+    log = Mock(logging.getLogger())
+    path = doc_builder('<root/>', 'pdf', log)
+    with open(path, 'rb') as document:
+        assert document.read() == b'<root/>'
+    assert doc_builder('<root/>', 'pdf', log, 'bytes') == b'<root/>'
+    assert list(doc_builder('<root/>', 'pdf', log, 'chunks')) == [b'<root/>']
+    server_sock, client_sock = socket.socketpair()
+    with server_sock, client_sock:
+        assert doc_builder('<root/>', 'pdf', log, server_sock) is server_sock
+        assert client_sock.recv(1024) == b'<root/>'
+    assert os.listdir(str(tmp_path)) == [os.path.basename(path)]
+
+
+def _unused_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_fops_builder_raw_compressed_body():
+    doc_builder = builder.FopsBuilder(
+        'localhost', 3000, raw_body=True, compress=True
+    )
+    headers, data = doc_builder._encode_document('<root/>')
+    assert headers == {
+        'Content-Type': 'application/xml; charset=utf-8',
+        'Content-Encoding': 'gzip'
+    }
+    assert gzip.decompress(data) == b'<root/>'
+
+
+def test_pooled_fops_builder_keep_alive(fops_server, fops_handler):
+    host, port = fops_server.server_address
+    doc_builder = builder.PooledFopsBuilder(
+        ['{}:{}'.format(host, port)], raw_body=True, compress=True,
+        user='user', passwd='secret'
+    )
+    log = Mock(logging.getLogger())
+    documents = [
+        doc_builder('<root>{}</root>'.format(num), 'pdf', log, 'bytes')
+        for num in range(5)
+    ]
+    doc_builder.close()
+    assert documents == [b'<root>%d</root>' % num for num in range(5)]
+    assert fops_handler.connections == 1
+    _, headers, _ = fops_handler.requests[0]
+    assert headers['Content-Type'] == 'application/xml; charset=utf-8'
+    assert headers['Authorization'] == 'Basic dXNlcjpzZWNyZXQ='
+
+
+def test_pooled_fops_builder_failover(fops_server, fops_handler):
+    host, port = fops_server.server_address
+    dead_host = ('127.0.0.1', _unused_port())
+    doc_builder = builder.PooledFopsBuilder(
+        [dead_host, (host, port)], timeout=5
+    )
+    log = Mock(logging.getLogger())
+    for _ in range(3):
+        assert doc_builder('<root/>', 'pdf', log, 'bytes') == b'<root/>'
+    assert not doc_builder.hosts[0].healthy
+    assert doc_builder.hosts[1].healthy
+    assert len(fops_handler.requests) == 3
+    with pytest.raises(builder.BuilderError, match='code 500'):
+        doc_builder('ERROR', 'pdf', log)
+    doc_builder.close()
+
+
+class BusyFopsHandler(FakeFopsHandler):
+
+    def do_POST(self):
+        self._read_body()
+        self.send_response(503)
+        self.send_header('Content-Length', '4')
+        self.end_headers()
+        self.wfile.write(b'busy')
+
+
+def test_pooled_fops_builder_failover_unavailable(fops_server, fops_handler):
+    busy_server = start_server(BusyFopsHandler)
+    doc_builder = builder.PooledFopsBuilder(
+        [busy_server.server_address, fops_server.server_address]
+    )
+    log = Mock(logging.getLogger())
+    try:
+        for _ in range(2):
+            assert doc_builder('<root/>', 'pdf', log, 'bytes') == b'<root/>'
+        assert not doc_builder.hosts[0].healthy
+        assert doc_builder.hosts[1].healthy
+        assert len(fops_handler.requests) == 2
+        busy_builder = builder.PooledFopsBuilder(
+            [busy_server.server_address]
+        )
+        with pytest.raises(builder.BuilderError,
+                           match='Service Unavailable - code 503'):
+            busy_builder('<root/>', 'pdf', log)
+        busy_builder.close()
+    finally:
+        doc_builder.close()
+        busy_server.shutdown()
+        busy_server.server_close()
+
+
+def test_pooled_fops_builder_closes_failed_connections():
+    host = builder._HostConnections('127.0.0.1', _unused_port(), 'http',
+                                    2, None)
+    connection = Mock()
+    connection.request.side_effect = socket.timeout('timed out')
+    host.release(connection)
+    with pytest.raises(socket.timeout):
+        host.request('POST', '/pdf', b'', {})
+    connection.close.assert_called_once_with()
+
+
+def test_pooled_fops_builder_all_down():
+    doc_builder = builder.PooledFopsBuilder(
+        [('127.0.0.1', _unused_port())], retries=2, cooldown=0
+    )
+    with pytest.raises(builder.BuilderError, match='Unable to build'):
+        doc_builder('<root/>', 'pdf', Mock(logging.getLogger()))
+
+
+def test_subprocess_builder_streaming_input(fop_builder):
+    log = Mock(logging.getLogger())
+    chunks = iter([b'<root>', b'x' * builder.CHUNK_SIZE * 4, b'</root>'])
+    document = fop_builder(chunks, 'pdf', log, 'bytes')
+    assert document == b'pdf:<root>' + b'x' * builder.CHUNK_SIZE * 4 + \
+        b'</root>'
+
+
+def test_subprocess_builder_failing_stream(fop_builder):
+    def chunks():
+        yield b'<root>'
+        raise ValueError('broken template')
+
+    procs = []
+    real_popen = subprocess.Popen
+
+    def popen(*args, **kwargs):
+        procs.append(real_popen(*args, **kwargs))
+        return procs[-1]
+
+    with patch('subprocess.Popen', side_effect=popen):
+        with pytest.raises(ValueError):
+            fop_builder(chunks(), 'pdf', Mock(logging.getLogger()), 'bytes')
+    # fop has been killed and waited.
+    assert procs[0].returncode is not None
+
+
+def test_pooled_fops_builder_streaming_body(fops_server, fops_handler):
+    host, port = fops_server.server_address
+    doc_builder = builder.PooledFopsBuilder(
+        [(host, port)], raw_body=True, compress=True
+    )
+    chunks = iter([b'<root>', b'<block/>', b'</root>'])
+    document = doc_builder(chunks, 'pdf', Mock(logging.getLogger()), 'bytes')
+    doc_builder.close()
+    assert document == b'<root><block/></root>'
+    _, headers, _ = fops_handler.requests[0]
+    assert headers['Transfer-Encoding'] == 'chunked'
@@ -0,0 +1,316 @@
+import os
+import time
+import base64
+import pickle
+import decimal
+import datetime
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+import lxml.etree
+import pytest
+
+import pypfop.templates.mako
+from pypfop import cache
+from pypfop.builder import Builder
+from pypfop.document_generator import DocumentGenerator
+from pypfop.exceptions import DocumentGeneratorError
+
+from tests.conftest import FakeResourcesHandler
+from tests.test_conversion import _canonical
+
+
+class CountingBuilder(Builder):
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, xslfo, out_format, log, output=None):
+        self.calls += 1
+        return self._deliver([xslfo], out_format, output)
+
+
+@pytest.fixture
+def generator(tmp_path):
+    (tmp_path / 'doc.fo.mako').write_text('<root><b>${name}</b></root>')
+    (tmp_path / 'doc.css').write_text('b { color: red; }')
+    factory = pypfop.templates.mako.Factory(str(tmp_path), use_skels=False)
+    return DocumentGenerator(
+        factory('doc.fo.mako'), 'doc.css', style_dir=str(tmp_path),
+        builder=CountingBuilder(), tempdir=str(tmp_path),
+        result_cache=cache.MemoryResultCache()
+    )
+
+
+def _touch(path, content):
+    stat = os.stat(path)
+    path.write_text(content)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_memory_result_cache_byte_limit():
+    result_cache = cache.MemoryResultCache(maxbytes=10)
+    result_cache.set('a', b'12345')
+    result_cache.set('b', b'12345')
+    assert result_cache.get('a') == b'12345'
+    result_cache.set('c', b'123')  # evicts "b", the least recently used.
+    result_cache.set('d', b'12345678901')  # bigger than the whole cache.
+    assert result_cache.get('b') is None
+    assert result_cache.get('d') is None
+    assert result_cache.stats() == {
+        'hits': 1, 'misses': 2, 'entries': 2, 'bytes': 8
+    }
+
+
+def test_disk_result_cache(tmp_path):
+    result_cache = cache.DiskResultCache(str(tmp_path), ttl=60)
+    result_cache.set('a', b'document')
+    result_cache.set('b', b'document')
+    assert result_cache.get('a') == b'document'
+    assert result_cache.get('c') is None
+    stats = result_cache.stats()
+    assert (stats['entries'], stats['bytes']) == (2, len(b'document'))
+    old = time.time() - 120
+    os.utime(str(tmp_path / 'keys' / 'a'), (old, old))
+    assert result_cache.get('a') is None
+    assert result_cache.get('b') == b'document'
+    os.utime(str(tmp_path / 'keys' / 'b'), (old, old))
+    result_cache.evict()
+    assert os.listdir(str(tmp_path / 'keys')) == []
+    assert os.listdir(str(tmp_path / 'objects')) == []
+
+
+def test_generate_with_result_cache(generator):
+    first = generator.generate({'name': 'x'}, output='bytes')
+    path = generator.generate({'name': 'x'})
+    with open(path, 'rb') as document:
+        assert document.read() == first
+    assert generator.builder.calls == 1
+    assert generator.result_cache.stats()['hits'] == 1
+    generator.generate({'name': 'y'})
+    generator.generate({'name': 'y'}, out_format='png')
+    assert generator.builder.calls == 3
+
+
+def test_generate_with_result_cache_custom_builder(generator):
+    calls = []
+
+    def build(xslfo, out_format, log, output=None):
+        calls.append(xslfo)
+        return xslfo.encode() if isinstance(xslfo, str) else xslfo
+
+    generator.builder = build
+    first = generator.generate({'name': 'x'}, output='bytes')
+    assert b'<fo:root' in first
+    path = generator.generate({'name': 'x'})
+    with open(path, 'rb') as document:
+        assert document.read() == first
+    assert len(calls) == 1
+    os.remove(path)
+
+
+def test_document_key_changes(generator, tmp_path):
+    def key():
+        return cache.document_key(
+            generator.template, {'name': 'x'}, generator.ssheets, 'pdf'
+        )
+
+    original = key()
+    assert key() == original
+    _touch(tmp_path / 'doc.css', 'b { color: blue; }')
+    changed_style = key()
+    assert changed_style != original
+    _touch(tmp_path / 'doc.fo.mako', '<root>${name}</root>')
+    assert key() not in (original, changed_style)
+
+
+def test_document_key_inherited_templates(tmp_path):
+    (tmp_path / 'base.fo.mako').write_text('<root>${next.body()}</root>')
+    (tmp_path / 'part.fo.mako').write_text('<b/>')
+    (tmp_path / 'doc.fo.mako').write_text(
+        '<%inherit file="base.fo.mako"/><%include file="/part.fo.mako"/>'
+    )
+    factory = pypfop.templates.mako.Factory(str(tmp_path), use_skels=False)
+    template = factory('doc.fo.mako')
+    original = template.fingerprint()
+    assert [part.split(':')[0] for part in original.split('|')] == [
+        '/doc.fo.mako', '/base.fo.mako', '/part.fo.mako'
+    ]
+    assert template.fingerprint() == original
+    _touch(tmp_path / 'base.fo.mako', '<root>${next.body()}!</root>')
+    changed_base = template.fingerprint()
+    assert changed_base != original
+    _touch(tmp_path / 'part.fo.mako', '<i/>')
+    assert template.fingerprint() not in (original, changed_base)
+    # the dependencies of a template are kept once, for its last version.
+    _touch(tmp_path / 'doc.fo.mako', '<%inherit file="base.fo.mako"/>')
+    assert template.fingerprint().count('|') == 1
+    assert pypfop.templates.mako._dependencies[
+        str(tmp_path / 'doc.fo.mako')
+    ][2] == ['base.fo.mako']
+
+
+def test_document_key_skeleton():
+    template = pypfop.templates.mako.Factory()('A4-portrait.fo.mako')
+    assert os.path.join('skeletons', 'mako', 'base.fo.mako:') in \
+        template.fingerprint()
+
+
+class Customer:
+
+    def __init__(self, name):
+        self.name = name
+
+    def cache_key(self):
+        return self.name
+
+
+def test_document_key_params():
+    template = Mock(spec=['render'])
+
+    def key(params):
+        return cache.document_key(template, params, [], 'pdf')
+
+    when = datetime.date(2020, 1, 2)
+    assert key({'when': when, 'total': decimal.Decimal('1.10')}) == \
+        key({'when': datetime.date(2020, 1, 2),
+             'total': decimal.Decimal('1.10')})
+    assert key({'total': decimal.Decimal('1.10')}) != \
+        key({'total': decimal.Decimal('1.1')})
+    assert key({'tags': {'b', 'a'}}) == key({'tags': {'a', 'b'}})
+    assert key({'customer': Customer('a')}) == \
+        key({'customer': Customer('a')})
+    assert key({'customer': Customer('a')}) != \
+        key({'customer': Customer('b')})
+    with pytest.raises(DocumentGeneratorError, match='cache_key'):
+        key({'customer': object()})
+
+
+def test_document_key_without_fingerprint():
+    template = Mock(spec=['render'])
+    params = {'when': time.gmtime(0), 'items': [1, 2]}
+    assert cache.document_key(template, params, [], 'pdf') == \
+        cache.document_key(template, dict(params), [], 'pdf')
+
+
+GRAPHICS_TEMPLATE = """<root><block>${name}\\
+<external-graphic src="url('${base}/logo.png')"/>\\
+<external-graphic src="${base}/photo.jpg"/>\\
+<external-graphic src='url("${base}/logo.png")'/>\\
+<external-graphic src="images/local.png"/></block></root>"""
+
+
+@pytest.fixture
+def graphics_generator(tmp_path, resources_server):
+    (tmp_path / 'graphics.fo.mako').write_text(GRAPHICS_TEMPLATE)
+    factory = pypfop.templates.mako.Factory(str(tmp_path), use_skels=False)
+    return DocumentGenerator(
+        factory('graphics.fo.mako'), builder=CountingBuilder(),
+        instparams={'base': resources_server}, fragment_cache=None,
+        resource_cache=cache.MemoryResourceCache()
+    )
+
+
+def _sources(xslfo):
+    return lxml.etree.fromstring(xslfo).xpath(
+        '//fo:external-graphic/@src',
+        namespaces={'fo': 'http://www.w3.org/1999/XSL/Format'}
+    )
+
+
+def test_memory_resource_cache(graphics_generator):
+    for name in ('x', 'y'):
+        xslfo = graphics_generator.generate({'name': name}, output='bytes')
+    logo = "url('data:image/png;base64,{}')".format(
+        base64.b64encode(b'\x89PNG logo').decode('ascii')
+    )
+    assert _sources(xslfo)[0::2] == [logo, logo]
+    assert _sources(xslfo)[1].startswith("url('data:image/jpeg;base64,")
+    assert _sources(xslfo)[3] == 'images/local.png'
+    assert sorted(FakeResourcesHandler.requests) == [
+        '/logo.png', '/photo.jpg'
+    ]
+    stats = graphics_generator.resource_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (4, 2, 2)
+    # the streamed documents are resolved on the same way.
+    streamed = graphics_generator.generate({'name': 'y'}, output='bytes',
+                                           streaming=True)
+    assert _canonical(streamed) == _canonical(xslfo)
+    assert len(FakeResourcesHandler.requests) == 2
+
+
+def test_memory_resource_cache_byte_limit(resources_server):
+    resource_cache = cache.MemoryResourceCache(maxbytes=150)
+    logo, photo = (resources_server + path
+                   for path in ('/logo.png', '/photo.jpg'))
+    assert resource_cache.resolve(photo) is not None
+    assert resource_cache.resolve(logo) is not None  # evicts the photo.
+    assert resource_cache.stats()['entries'] == 1
+    resource_cache.maxbytes = 100
+    assert resource_cache.resolve(photo) is None  # too big to be cached.
+    assert resource_cache.resolve(logo) is not None
+    resource_cache.timeout = 5
+    copied = pickle.loads(pickle.dumps(resource_cache))
+    assert (copied.maxbytes, copied.timeout) == (100, 5)
+    assert copied.stats()['entries'] == 0
+
+
+def test_resource_cache_failures(resources_server):
+    resource_cache = cache.MemoryResourceCache(retry_after=60)
+    missing = resources_server + '/missing.png'
+    for _ in range(2):
+        assert resource_cache.resolve(missing) is None
+    assert FakeResourcesHandler.requests == ['/missing.png']
+    assert resource_cache.stats()['errors'] == 1
+    resource_cache.retry_after = 0
+    assert resource_cache.resolve(missing) is None
+    assert len(FakeResourcesHandler.requests) == 2
+    assert resource_cache.resolve('data:image/png;base64,AA==') is None
+
+
+def test_resource_cache_failures_expire(resources_server):
+    resource_cache = cache.MemoryResourceCache(retry_after=60)
+    for num in range(3):
+        resource_cache.resolve(
+            '{}/missing-{}.png'.format(resources_server, num)
+        )
+    assert len(resource_cache._failed) == 3
+    now = time.monotonic()
+    with patch.object(cache.time, 'monotonic', return_value=now + 61):
+        resource_cache.resolve(resources_server + '/missing-0.png')
+    # only the new failure is kept.
+    assert list(resource_cache._failed) == [
+        resources_server + '/missing-0.png'
+    ]
+
+
+def test_resource_cache_concurrent_fetch(resources_server):
+    resource_cache = cache.MemoryResourceCache()
+    with ThreadPoolExecutor(8) as executor:
+        sources = set(executor.map(resource_cache.resolve,
+                                   [resources_server + '/logo.png'] * 32))
+    assert len(sources) == 1
+    assert FakeResourcesHandler.requests == ['/logo.png']
+
+
+def test_disk_resource_cache(tmp_path, resources_server):
+    directory = tmp_path / 'resources'
+    resource_cache = cache.DiskResourceCache(str(directory), maxbytes=85)
+    photo = resource_cache.resolve(resources_server + '/photo.jpg')
+    path = pathlib.Path(photo[len('file://'):])
+    assert path.parent == directory and path.suffix == '.jpg'
+    assert path.read_bytes() == b'\xff\xd8 photo' * 10
+    # the cache is shared by the other instances (and processes).
+    shared = pickle.loads(pickle.dumps(resource_cache))
+    assert shared.resolve(resources_server + '/photo.jpg') == photo
+    assert FakeResourcesHandler.requests == ['/photo.jpg']
+    old = time.time() - 60
+    os.utime(str(path), (old, old))
+    logo = shared.resolve(resources_server + '/logo.png')
+    # the least recently used file is removed.
+    assert not path.exists()
+    assert shared.stats()['entries'] == 1
+    assert resource_cache.resolve(resources_server + '/logo.png') == logo
+    resource_cache.clear()
+    assert list(directory.iterdir()) == []
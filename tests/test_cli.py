@@ -0,0 +1,121 @@
+import io
+import sys
+import json
+import tarfile
+
+import pytest
+
+from pypfop import cli
+
+from tests.test_document_generator import FAKE_FOP_CMD
+
+
+TEMPLATE = '''\
+<%
+    if name == 'broken':
+        raise ValueError('broken template')
+%>
+<root><block class="name">${name}</block><block>${text}</block></root>
+'''
+
+PARAMS = [
+    {'name': 'first', 'text': 'one'},
+    {'name': 'second', 'text': 'ERROR'},  # fop fails.
+    {'name': 'broken', 'text': 'x'},
+    {'name': 'fourth', 'text': 'four'},
+]
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    (tmp_path / 'doc.fo.mako').write_text(TEMPLATE)
+    (tmp_path / 'doc.css').write_text('.name { color: red; }')
+    lines = [json.dumps(params) for params in PARAMS]
+    lines[3:3] = ['', 'not json', '[1]']
+    (tmp_path / 'params.jsonl').write_text('\n'.join(lines) + '\n')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _render(*args):
+    return cli.main([
+        'render', 'doc.fo.mako', '-c', 'doc.css', '--no-skels', '-w', '2',
+        '--fop-cmd', '{} {}'.format(sys.executable, FAKE_FOP_CMD)
+    ] + list(args))
+
+
+def _report(text):
+    return sorted((json.loads(line) for line in text.splitlines()),
+                  key=lambda record: record['line'])
+
+
+def test_render_directory(workdir, capsys):
+    assert _render('-i', 'params.jsonl', '-o', 'out', '-n', 'name') == 1
+    report = _report(capsys.readouterr().out)
+    assert [(record['line'], record['status']) for record in report] == [
+        (1, 'ok'), (2, 'error'), (3, 'error'), (5, 'error'), (6, 'error'),
+        (7, 'ok')
+    ]
+    assert 'BuilderError' in report[1]['error']
+    assert 'Invalid JSON' in report[3]['error']
+    assert report[0]['bytes'] > 0
+    assert {'render_seconds', 'build_seconds'} <= set(report[0])
+    assert 'build_seconds' not in report[2]
+    assert sorted(path.name for path in (workdir / 'out').iterdir()) == [
+        'first.pdf', 'fourth.pdf'
+    ]
+    content = (workdir / 'out' / 'first.pdf').read_bytes()
+    assert content.startswith(b'pdf:<?xml')
+    assert b'<fo:block color="red">first</fo:block>' in content
+    # the existing documents are skipped.
+    (workdir / 'out' / 'first.pdf').write_bytes(b'previous')
+    assert _render('-i', 'params.jsonl', '-o', 'out', '-n', 'name',
+                   '-r', 'report.jsonl') == 1
+    report = _report((workdir / 'report.jsonl').read_text())
+    assert [record['status'] for record in report] == [
+        'skipped', 'error', 'error', 'error', 'error', 'skipped'
+    ]
+    assert (workdir / 'out' / 'first.pdf').read_bytes() == b'previous'
+
+
+def test_render_tar(workdir, monkeypatch, capsys):
+    lines = ''.join(json.dumps(params) + '\n'
+                    for params in PARAMS if params['name'] != 'broken')
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(lines))
+    assert _render('-t', 'docs.tar', '-f', 'png') == 1
+    with tarfile.open(workdir / 'docs.tar') as tar:
+        assert sorted(tar.getnames()) == ['000001.png', '000003.png']
+    # the missing document is appended on the next run.
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(
+        lines.replace('ERROR', 'fixed')
+    ))
+    capsys.readouterr()
+    assert _render('-t', 'docs.tar', '-f', 'png') == 0
+    assert [record['status'] for record in
+            _report(capsys.readouterr().out)] == ['skipped', 'ok', 'skipped']
+    with tarfile.open(workdir / 'docs.tar') as tar:
+        assert sorted(tar.getnames()) == [
+            '000001.png', '000002.png', '000003.png'
+        ]
+        assert tar.extractfile('000002.png').read().startswith(b'png:')
+
+
+def test_render_invalid_names(workdir, capsys):
+    (workdir / 'names.jsonl').write_text(
+        '{"name": "../escape", "text": "x"}\n'
+        '{"name": "same", "text": "x"}\n'
+        '{"name": "same", "text": "y"}\n'
+    )
+    assert _render('-i', 'names.jsonl', '-o', 'out', '-n', 'name') == 1
+    report = _report(capsys.readouterr().out)
+    assert [record['status'] for record in report] == ['error', 'ok', 'error']
+    assert 'Duplicated' in report[2]['error']
+    assert [path.name for path in (workdir / 'out').iterdir()] == ['same.pdf']
+
+
+def test_render_validate(workdir, capsys):
+    assert _render('-i', 'params.jsonl', '-o', 'out', '--validate') == 1
+    report = _report(capsys.readouterr().out)
+    assert 'fo:block is not allowed in fo:root' in report[0]['error']
+    assert 'build_seconds' not in report[0]
+    assert list((workdir / 'out').iterdir()) == []
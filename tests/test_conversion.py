@@ -0,0 +1,355 @@
+import os
+from unittest.mock import patch
+
+import cssutils
+import lxml.etree
+import pytest
+
+from pypfop import conversion
+
+
+@pytest.fixture
+def sheets(tmp_path):
+    main = tmp_path / 'main.css'
+    imported = tmp_path / 'imported.css'
+    imported.write_text('block { color: red; }')
+    main.write_text(
+        '@import url("imported.css");\n'
+        'table-cell { padding: 1mm; }'
+    )
+    return main, imported
+
+
+@pytest.fixture
+def cache():
+    return conversion.StylesheetCache(maxsize=2)
+
+
+def _touch(path, content):
+    stat = os.stat(path)
+    path.write_text(content)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_stylesheet_cache_compiles_imports(sheets, cache):
+    main, _ = sheets
+    rules = cache.get(str(main))
+    assert [rule.style for rule in rules] == [
+        {'color': 'red'}, {'padding': '1mm'}
+    ]
+    assert all(rule.compiled.path == rule.xpath for rule in rules)
+
+
+def test_stylesheet_cache_hit_skips_parsing(sheets, cache):
+    main, _ = sheets
+    with patch.object(
+            cssutils, 'parseFile', wraps=cssutils.parseFile
+    ) as parse_file:
+        first = cache.get(str(main))
+        second = cache.get(str(main))
+    assert first is second
+    assert parse_file.call_count == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_stylesheet_cache_invalidates_on_change(sheets, cache):
+    main, _ = sheets
+    cache.get(str(main))
+    _touch(main, 'table-cell { padding: 2mm; }')
+    rules = cache.get(str(main))
+    assert [rule.style for rule in rules] == [{'padding': '2mm'}]
+    assert cache.misses == 2
+
+
+def test_stylesheet_cache_invalidates_on_import_change(sheets, cache):
+    main, imported = sheets
+    cache.get(str(main))
+    _touch(imported, 'block { color: blue; }')
+    rules = cache.get(str(main))
+    assert rules[0].style == {'color': 'blue'}
+
+
+def test_stylesheet_cache_lru_eviction(tmp_path, cache):
+    paths = []
+    for name in ('a', 'b', 'c'):
+        path = tmp_path / '{}.css'.format(name)
+        path.write_text('block { color: red; }')
+        paths.append(str(path))
+    cache.get(paths[0])
+    cache.get(paths[1])
+    cache.get(paths[0])  # "a" is now the most recently used.
+    cache.get(paths[2])
+    assert len(cache) == 2
+    cache.get(paths[0])
+    assert cache.hits == 2
+    cache.get(paths[1])
+    assert cache.misses == 4
+
+
+def test_translate_css_to_xpath(sheets):
+    main, _ = sheets
+    assert conversion.translate_css_to_xpath(str(main)) == [
+        ('descendant-or-self::block', {'color': 'red'}),
+        ('descendant-or-self::table-cell', {'padding': '1mm'}),
+    ]
+
+
+XML_DOCUMENT = (
+    '<root xmlns:fox="http://xmlgraphics.apache.org/fop/extensions">'
+    '<!-- leading comment -->'
+    '<table-cell class="cell" fox:scale="1">'
+    '<block title="a\nb">café &amp; <![CDATA[<tea>]]><?pi data?>cake'
+    '</block><!-- inner -->tail'
+    '</table-cell>'
+    '</root>'
+).encode('utf-8')
+
+
+@pytest.mark.parametrize('with_sheets', [True, False])
+def test_single_pass_matches_former_pipeline(sheets, with_sheets):
+    main, _ = sheets
+    csssheets = [str(main)] if with_sheets else None
+    single = conversion.xml_to_fo_with_style(XML_DOCUMENT, csssheets)
+    former = conversion.xml_to_fo_with_style(
+        XML_DOCUMENT, csssheets, single_pass=False
+    )
+    assert single == former
+
+
+def test_former_pipeline_applies_each_rule(sheets, monkeypatch):
+    main, _ = sheets
+    # the single pass walks the index, the former queries each rule.
+    monkeypatch.setattr(conversion, 'INDEX_MIN_RULES', 0)
+    single = conversion.xml_to_fo_with_style(XML_DOCUMENT, [str(main)])
+    with patch.object(conversion, '_inline_css_indexed') as indexed:
+        former = conversion.xml_to_fo_with_style(
+            XML_DOCUMENT, [str(main)], single_pass=False
+        )
+    assert not indexed.called
+    assert single == former
+
+
+def test_xml_to_fo_with_style(sheets):
+    main, _ = sheets
+    xslfo = conversion.xml_to_fo_with_style(
+        XML_DOCUMENT, str(main), encoding='utf-8'
+    )
+    assert xslfo.startswith(b'<?xml version="1.1" encoding="utf-8"?>\n')
+    assert b'ns0:scale="1" padding="1mm">' in xslfo
+    assert b'<fo:block title="a b" color="red">' in xslfo
+    assert b'class=' not in xslfo
+
+
+SIBLING_RULES = (
+    'block:empty { a: 1; }\n'
+    'cell:last-child { b: 2; }\n'
+    'cell + cell { c: 3; }\n'
+    'row > cell:nth-child(2) block { d: 4; }\n'
+    '.first ~ cell { e: 5; }\n'
+)
+SIBLING_DOCUMENT = (
+    '<root><row><cell class="first"><block/>one</cell>'
+    '<cell><block>two</block><block/></cell>tail<cell/></row>'
+    '<row><cell>three</cell></row></root>'
+)
+
+
+def _canonical(xslfo):
+    def walk(elem):
+        return (
+            lxml.etree.QName(elem).localname, sorted(elem.attrib.items()),
+            elem.text, elem.tail, [walk(child) for child in elem]
+        )
+    return walk(lxml.etree.fromstring(xslfo))
+
+
+def _stream(xmlstring, csssheets, step=7):
+    chunks = []
+    converter = conversion.StreamingFOConverter(
+        chunks.append, csssheets, chunk_size=16
+    )
+    for start in range(0, len(xmlstring), step):
+        converter.feed(xmlstring[start:start + step])
+    converter.close()
+    return b''.join(chunks), converter
+
+
+@pytest.mark.parametrize('document, rules', [
+    (XML_DOCUMENT, None),
+    (XML_DOCUMENT, 'block { color: red; } .cell { padding: 1mm; }'),
+    (SIBLING_DOCUMENT, SIBLING_RULES),
+])
+def test_streaming_matches_whole_document(tmp_path, document, rules):
+    csssheets = None
+    if rules is not None:
+        sheet = tmp_path / 'rules.css'
+        sheet.write_text(rules)
+        csssheets = [str(sheet)]
+    xslfo, _ = _stream(document, csssheets)
+    assert xslfo.startswith(b'<?xml version="1.1"')
+    assert _canonical(xslfo) == _canonical(
+        conversion.xml_to_fo_with_style(document, csssheets)
+    )
+
+
+def test_streaming_drops_written_elements(tmp_path):
+    sheet = tmp_path / 'rules.css'
+    sheet.write_text(SIBLING_RULES)
+    chunks = []
+    converter = conversion.StreamingFOConverter(
+        chunks.append, str(sheet), chunk_size=1
+    )
+    converter.feed('<root><body>')
+    for num in range(100):
+        converter.feed('<row><cell>{}</cell><cell/></row>'.format(num))
+    converter.feed('<row>')
+    body = converter._root.elem[0]
+    # the written rows are gone, only the open one is left.
+    assert len(body) == 1
+    converter.feed('</row></body></root>')
+    converter.close()
+    assert b''.join(chunks).count(b'<fo:cell b="2" c="3">') == 100
+
+
+def test_iter_xml_to_fo_with_style_errors():
+    def render(write):
+        write('<root><block>')
+        raise ValueError('broken template')
+
+    with pytest.raises(ValueError):
+        list(conversion.iter_xml_to_fo_with_style(render, None))
+
+    def render_forever(write):
+        while True:
+            write('<block>text</block>' * 1000)
+
+    chunks = conversion.iter_xml_to_fo_with_style(
+        lambda write: (write('<root>'), render_forever(write)), None,
+        max_pending=2
+    )
+    assert next(chunks).startswith(b'<?xml')
+    chunks.close()  # stops the rendering thread.
+
+
+INDEXED_RULES = SIBLING_RULES + (
+    'cell { f: 6; }\n'
+    '.first { f: 7; }\n'
+    'row[title="x"] block { g: 8; }\n'
+    '#only block, .missing cell { h: 9; }\n'
+    'root > row:not(.none) > cell:first-child { i: 10; }\n'
+)
+
+
+def test_single_pass_matches_rule_by_rule(tmp_path):
+    sheet = tmp_path / 'rules.css'
+    sheet.write_text(INDEXED_RULES)
+    document = SIBLING_DOCUMENT.replace(
+        '<row>', '<row title="x" id="only">', 1
+    )
+    single = conversion._inline_css_indexed(
+        lxml.etree.fromstring(document), [str(sheet)]
+    )
+    by_rule = conversion._inline_css_by_rule(
+        lxml.etree.fromstring(document), [str(sheet)]
+    )
+    assert lxml.etree.tostring(single) == lxml.etree.tostring(by_rule)
+
+
+def test_rule_index_candidates(tmp_path):
+    sheet = tmp_path / 'rules.css'
+    sheet.write_text(INDEXED_RULES)
+    index = conversion.RuleIndex(conversion.compile_css_sheets(str(sheet)))
+    root = lxml.etree.fromstring(SIBLING_DOCUMENT)
+    row = root[0]
+    cell = row[0]
+
+    def styles(elem, ancestors=None):
+        return [rule.style for rule in index.candidates(elem, True, ancestors)]
+
+    # the rules are keyed by the tag, id and classes of the element.
+    assert styles(cell) == [
+        {'b': '2'}, {'c': '3'}, {'e': '5'}, {'f': '6'}, {'f': '7'},
+        {'h': '9'}, {'i': '10'}
+    ]
+    # and skipped when the ancestors can't match.
+    ancestors = index.ancestors_of(
+        index.ancestors_of(frozenset(), root), row
+    )
+    assert {'h': '9'} not in styles(cell, ancestors)
+    assert {'g': '8'} not in styles(cell[0], ancestors)
+    row.set('title', 'x')
+    ancestors = index.ancestors_of(
+        index.ancestors_of(frozenset(), root), row
+    )
+    assert {'g': '8'} in styles(cell[0], ancestors)
+    assert [rule.style for rule in index.candidates(cell[0], held=False)] \
+        == [{'d': '4'}, {'g': '8'}, {'h': '9'}]
+
+
+CASCADE_RULES = (
+    '#main cell { color: blue; }\n'
+    'cell.total { color: green; padding: 1mm; }\n'
+    'cell { color: red; padding: 2mm !important; }\n'
+    'block, .total block { margin: 1mm; }\n'
+    'block { margin: 2mm; }\n'
+)
+
+
+@pytest.mark.parametrize('inline_css', [
+    conversion._inline_css_by_rule, conversion._inline_css_indexed
+])
+def test_cascade_by_importance_and_specificity(tmp_path, inline_css):
+    sheet = tmp_path / 'rules.css'
+    sheet.write_text(CASCADE_RULES)
+    rules = conversion.compile_css_sheets(str(sheet))
+    # the groups are split by selector, each one with its specificity.
+    assert [(rule.selector, rule.specificity) for rule in rules[3:5]] == [
+        ('block', (0, 0, 1)), ('.total block', (0, 1, 1))
+    ]
+    assert rules[2].important == {'padding'}
+    document = lxml.etree.fromstring(
+        '<root id="main"><cell class="total"><block/></cell>'
+        '<cell><block/></cell></root>'
+    )
+    inline_css(document, [str(sheet)])
+    total, cell = document
+    assert dict(total.attrib) == {'color': 'blue', 'padding': '2mm'}
+    assert dict(cell.attrib) == {'color': 'blue', 'padding': '2mm'}
+    assert total[0].get('margin') == '1mm'
+    assert cell[0].get('margin') == '2mm'
+
+
+def test_inline_css_engine_by_rule_count(tmp_path, monkeypatch):
+    sheet = tmp_path / 'rules.css'
+    sheet.write_text(CASCADE_RULES)
+    count = len(conversion.compile_css_sheets(str(sheet)))
+    document = '<root><cell class="total"><block/></cell></root>'
+    styled = {}
+    for min_rules in (count + 1, count):
+        monkeypatch.setattr(conversion, 'INDEX_MIN_RULES', min_rules)
+        with patch.object(conversion, 'RuleIndex',
+                          wraps=conversion.RuleIndex) as rule_index, \
+                patch.object(conversion.lxml.etree, 'iterwalk',
+                             wraps=conversion.lxml.etree.iterwalk) as walk:
+            tree = conversion._inline_css(
+                lxml.etree.fromstring(document), [str(sheet)]
+            )
+        assert rule_index.called
+        styled[min_rules] = (walk.called, lxml.etree.tostring(tree))
+    # the index walks the tree, the rules query it.
+    assert styled[count][0] and not styled[count + 1][0]
+    assert styled[count][1] == styled[count + 1][1]
+
+
+def test_computed_style_memo(tmp_path):
+    sheet = tmp_path / 'rules.css'
+    sheet.write_text(CASCADE_RULES)
+    index = conversion.RuleIndex(conversion.compile_css_sheets(str(sheet)))
+    cells = [lxml.etree.Element('cell', {'class': 'total'})
+             for _ in range(100)]
+    for cell in cells:
+        index.apply(cell)
+    assert (index.hits, index.misses) == (99, 1)
+    assert cells[0].attrib == cells[-1].attrib
+    assert index.computed_style((0, 2)) == {'color': 'blue', 'padding': '2mm'}
+    assert index.misses == 2
@@ -0,0 +1,164 @@
+import os
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+import lxml.etree
+import pytest
+
+import pypfop.templates.mako
+from pypfop import builder, document_generator
+from pypfop.document_generator import DocumentGenerator
+from pypfop.exceptions import DocumentGeneratorError
+
+
+FAKE_FOP_CMD = os.path.join(os.path.dirname(__file__), 'fake_fop.py')
+
+
+class Template:
+
+    def __init__(self):
+        self.renders = 0
+
+    def render(self, params):
+        self.renders += 1
+        return '<root><block>{}</block></root>'.format(params['name'])
+
+
+@pytest.fixture
+def generator(tmp_path):
+    return DocumentGenerator(
+        Template(), tempdir=str(tmp_path),
+        builder=builder.SubprocessBuilder(sys.executable, [FAKE_FOP_CMD])
+    )
+
+
+def test_prepare_and_build_several_formats(generator):
+    prepared = generator.prepare({'name': 'x'})
+    documents = generator.build(prepared, ['pdf', 'PNG', 'pdf'], 'bytes')
+    assert list(documents) == ['pdf', 'png']
+    assert documents['pdf'] == b'pdf:' + prepared.xslfo
+    assert documents['png'] == b'png:' + prepared.xslfo
+    paths = generator.build(prepared, ['ps', 'txt'])
+    for out_format, path in paths.items():
+        with open(path, 'rb') as document:
+            assert document.read() == \
+                out_format.encode() + b':' + prepared.xslfo
+    assert generator.template.renders == 1
+
+
+def test_build_default_format(generator):
+    prepared = generator.prepare({'name': 'x'})
+    assert list(generator.build(prepared, output='bytes')) == ['pdf']
+
+
+def test_build_invalid_arguments(generator):
+    prepared = generator.prepare({'name': 'x'})
+    with pytest.raises(DocumentGeneratorError):
+        generator.build(prepared, ['pdf', 'doc'])
+    with pytest.raises(DocumentGeneratorError):
+        generator.build(prepared, ['pdf', 'png'], Mock(spec=['write']))
+
+
+STREAMING_TEMPLATE = '''\
+<root><table-body>
+% for row in rows:
+<table-row><table-cell><block>${row}</block></table-cell></table-row>
+% endfor
+</table-body></root>
+'''
+
+
+def test_generate_streaming(tmp_path):
+    (tmp_path / 'rows.fo.mako').write_text(STREAMING_TEMPLATE)
+    (tmp_path / 'rows.css').write_text('table-row:last-child { color: red; }')
+    factory = pypfop.templates.mako.Factory(str(tmp_path), use_skels=False)
+    generator = DocumentGenerator(
+        factory('rows.fo.mako'), 'rows.css', style_dir=str(tmp_path),
+        builder=builder.SubprocessBuilder(sys.executable, [FAKE_FOP_CMD])
+    )
+    params = {'rows': range(1000)}
+    streamed = generator.generate(params, output='bytes', streaming=True)
+    assert streamed.startswith(b'pdf:<?xml')
+    assert streamed.count(b'<fo:table-row>') == 999
+    assert b'<fo:table-row color="red">' in streamed
+    whole = generator.generate(params, output='bytes')
+    assert lxml.etree.tostring(lxml.etree.fromstring(streamed[4:])) == \
+        lxml.etree.tostring(lxml.etree.fromstring(whole[4:]))
+
+
+def test_no_logger_per_generator():
+    loggers = len(logging.Logger.manager.loggerDict)
+    generators = [DocumentGenerator(Template(), builder=builder.Builder())
+                  for _ in range(10)]
+    assert len(logging.Logger.manager.loggerDict) <= loggers + 1
+    assert generators[0].log.logger is generators[1].log.logger
+    assert generators[0].log.extra != generators[1].log.extra
+
+
+def test_debug_payloads_only_on_debug(generator, caplog):
+    with patch.object(document_generator, '_debug_payload') as payload:
+        generator.generate({'name': 'x'}, output='bytes')
+    assert not payload.called
+    generator.log.setLevel(logging.DEBUG)
+    generator.debug_payload_size = 10
+    with caplog.at_level(logging.DEBUG, 'pypfop'):
+        generator.generate({'name': 'x' * 100}, output='bytes')
+    xml_record = caplog.records[0]
+    assert xml_record.getMessage() == \
+        'Generated XML: <root><blo... (118 more)'
+    assert xml_record.generator == generator.log.extra['generator']
+
+
+def test_debug_dir(generator, tmp_path):
+    generator.debug_dir = str(tmp_path / 'debug')
+    os.mkdir(generator.debug_dir)
+    document = generator.generate({'name': 'x'}, output='bytes')
+    dumps = sorted(os.listdir(generator.debug_dir))
+    assert [os.path.splitext(name)[1] for name in dumps] == ['.fo', '.xml']
+    with open(os.path.join(generator.debug_dir, dumps[0]), 'rb') as dump:
+        assert b'pdf:' + dump.read() == document
+    with open(os.path.join(generator.debug_dir, dumps[1])) as dump:
+        assert dump.read() == '<root><block>x</block></root>'
+
+
+class EchoBuilder(builder.Builder):
+    concurrent_formats = True
+
+    def __call__(self, xslfo, out_format, log, output=None):
+        return xslfo
+
+
+def test_generator_shared_by_threads(tmp_path):
+    (tmp_path / 'doc.fo.mako').write_text(
+        '<root title="${title}"><block class="name">${name}</block>\n'
+        '% for item in items:\n<block>${item}</block>\n% endfor\n'
+        '<block>${company}</block></root>'
+    )
+    (tmp_path / 'doc.css').write_text('.name { color: red; }')
+    factory = pypfop.templates.mako.Factory(str(tmp_path), use_skels=False)
+
+    class Generator(DocumentGenerator):
+        __defparams__ = {'company': 'ACME'}
+
+    generator = Generator(
+        factory('doc.fo.mako'), 'doc.css', style_dir=str(tmp_path),
+        instparams={'title': 'Invoice'}, builder=EchoBuilder()
+    )
+    params = [{'name': 'doc-{}'.format(num), 'items': list(range(num % 7))}
+              for num in range(500)]
+    originals = [dict(doc_params) for doc_params in params]
+    with ThreadPoolExecutor(16) as executor:
+        documents = list(executor.map(generator.generate, params))
+    # the params of the callers and the generator are untouched.
+    assert params == originals
+    assert Generator.__defparams__ == {'company': 'ACME'}
+    assert generator.defparams == {'company': 'ACME', 'title': 'Invoice'}
+    for doc_params, document in zip(params, documents):
+        root = lxml.etree.fromstring(document)
+        assert root.get('title') == 'Invoice'
+        assert [block.text for block in root] == \
+            [doc_params['name']] + \
+            [str(item) for item in doc_params['items']] + ['ACME']
+        assert root[0].get('color') == 'red'
@@ -0,0 +1,214 @@
+import os
+import sys
+import pickle
+
+import pytest
+
+import pypfop.templates.mako
+from pypfop import builder, conversion, fragments
+from pypfop.document_generator import DocumentGenerator
+from pypfop.exceptions import TemplateError
+
+from tests.test_conversion import _canonical
+from tests.test_document_generator import FAKE_FOP_CMD
+
+
+TEMPLATE = '''\
+<%namespace name="fragment" module="pypfop.fragments"/>
+<root><row>
+<%fragment:cached key="letterhead">head<cell class="logo">${company}<block>\
+<%fragment:cached key="address">
+<block class="street">Main St.</block></%fragment:cached></block></cell>\
+<!-- comment -->tail<cell/></%fragment:cached>
+<cell class="name">${name}</cell></row></root>'''
+
+RULES = (
+    '.logo { color: red; }\n'
+    'cell + cell { padding: 1mm; }\n'
+    '.street { margin: 2mm; }\n'
+    '.logo ~ .name { font-weight: bold; }\n'
+)
+
+
+@pytest.fixture
+def template(tmp_path):
+    (tmp_path / 'doc.fo.mako').write_text(TEMPLATE)
+    factory = pypfop.templates.mako.Factory(str(tmp_path), use_skels=False)
+    return factory('doc.fo.mako')
+
+
+@pytest.fixture
+def sheets(tmp_path):
+    sheet = tmp_path / 'rules.css'
+    sheet.write_text(RULES)
+    return [str(sheet)]
+
+
+def _generate(template, sheets, cache, params):
+    scope = cache.scope(template, sheets)
+    with scope:
+        xml = template.render(params)
+    return xml, conversion.xml_to_fo_with_style(xml, sheets,
+                                                fragments=scope)
+
+
+def test_fragments_are_spliced(template, sheets):
+    cache = fragments.FragmentCache()
+    params = {'company': 'ACME', 'name': 'doc'}
+    expected = conversion.xml_to_fo_with_style(
+        template.render(params), sheets
+    )
+    xml, xslfo = _generate(template, sheets, cache, params)
+    assert b'<?pypfop-fragment-start letterhead 0?>' in xml
+    assert xslfo == expected
+    assert len(cache) == 2
+    for _ in range(2):
+        # the company is part of the cached fragment.
+        xml, xslfo = _generate(template, sheets, cache,
+                               dict(params, company='other'))
+        assert b'<?pypfop-fragment letterhead 0?>' in xml
+        assert b'Main St.' not in xml
+        assert xslfo == expected
+    assert cache.stats()['hits'] == 2
+
+
+def test_fragments_keyed_by_sheets(template, sheets, tmp_path):
+    cache = fragments.FragmentCache()
+    params = {'company': 'ACME', 'name': 'doc'}
+    _generate(template, sheets, cache, params)
+    other = tmp_path / 'other.css'
+    other.write_text('.logo { color: blue; }')
+    xml, xslfo = _generate(template, [str(other)], cache, params)
+    assert b'<?pypfop-fragment-start letterhead 0?>' in xml
+    assert b'color="blue"' in xslfo
+    assert cache.invalidate('letterhead') == 2
+    assert len(cache) == 2
+
+
+def test_fragments_without_scope(template):
+    xml = template.render({'company': 'ACME', 'name': 'doc'})
+    assert b'<?pypfop' not in xml
+    assert b'Main St.' in xml
+
+
+def test_invalid_fragment_key(tmp_path):
+    (tmp_path / 'bad.fo.mako').write_text(
+        '<%namespace name="fragment" module="pypfop.fragments"/>'
+        '<root><%fragment:cached key="a?>b"/></root>'
+    )
+    factory = pypfop.templates.mako.Factory(str(tmp_path), use_skels=False)
+    with pytest.raises(TemplateError):
+        factory('bad.fo.mako').render({})
+
+
+def test_generator_fragment_cache(template, sheets, tmp_path):
+    cache = fragments.FragmentCache()
+    generator = DocumentGenerator(
+        template, sheets, tempdir=str(tmp_path), fragment_cache=cache,
+        builder=builder.SubprocessBuilder(sys.executable, [FAKE_FOP_CMD])
+    )
+    params = {'company': 'ACME', 'name': 'doc'}
+    first = generator.generate(params, output='bytes')
+    assert generator.generate(params, output='bytes') == first
+    # the streamed documents render the fragments.
+    streamed = generator.generate(params, output='bytes', streaming=True)
+    assert _canonical(streamed[4:]) == _canonical(first[4:])
+    assert cache.stats()['hits'] == 1
+
+
+def test_fragment_cache_pickle():
+    assert pickle.loads(pickle.dumps(fragments.fragment_cache)) is \
+        fragments.fragment_cache
+    cache = fragments.FragmentCache(maxsize=3)
+    cache.set(('key', ), fragments.Fragment(None, ()))
+    copied = pickle.loads(pickle.dumps(cache))
+    assert (copied.maxsize, len(copied)) == (3, 0)
+
+
+SKELETON_PARAMS = dict.fromkeys((
+    'FONT_SIZE', 'FONT_FAMILY', 'SUBJECT', 'GENERATOR',
+    'REGION_BEFORE_EXTEND', 'REGION_AFTER_EXTEND', 'REGION_START_EXTEND',
+    'REGION_END_EXTEND'
+), None)
+
+
+@pytest.mark.parametrize('skeleton', [
+    'A4-landscape', 'A4-portrait', 'letter-landscape', 'letter-portrait'
+])
+def test_skeleton_fragments(tmp_path, sheets, skeleton):
+    (tmp_path / 'page.fo.mako').write_text(
+        '<%inherit file="{}.fo.mako"/><block>${{name}}</block>'
+        .format(skeleton)
+    )
+    template = pypfop.templates.mako.Factory(str(tmp_path))('page.fo.mako')
+    cache = fragments.FragmentCache()
+    for num, (title, margin) in enumerate([
+            ('one', '1cm'), ('two', '1cm'), ('one', '1cm'), ('one', '2cm')
+    ]):
+        params = dict(SKELETON_PARAMS, name=num, TITLE=title, AUTHOR=None,
+                      REGION_BODY_MARGIN=margin)
+        xml, xslfo = _generate(template, sheets, cache, params)
+        assert xslfo == conversion.xml_to_fo_with_style(
+            template.render(params), sheets
+        )
+    # the layout and the declarations are cached by their params.
+    assert xml.count(b'<?pypfop-fragment ') == 1
+    assert cache.stats()['hits'] == 4
+    assert len(cache) == 4
+
+
+LAYOUT_TEMPLATE = """<%inherit file="A4-portrait.fo.mako"/>{}\\
+<%block name="_page_layout"><simple-page-master master-name="page" \\
+page-height="${{PAGE_HEIGHT}}"><region-body/></simple-page-master>\\
+</%block><block>${{name}}</block>"""
+
+
+@pytest.mark.parametrize('declaration, cached', [
+    ('', 0),
+    ("<%! LAYOUT_PARAMS = ('PAGE_HEIGHT', ) %>", 1),
+])
+def test_custom_page_layout(tmp_path, sheets, declaration, cached):
+    (tmp_path / 'page.fo.mako').write_text(
+        LAYOUT_TEMPLATE.format(declaration)
+    )
+    template = pypfop.templates.mako.Factory(str(tmp_path))('page.fo.mako')
+    cache = fragments.FragmentCache()
+    for height in ('11in', '5in', '11in'):
+        params = dict(SKELETON_PARAMS, name='doc', TITLE=None, AUTHOR=None,
+                      REGION_BODY_MARGIN=None, PAGE_HEIGHT=height)
+        xml, xslfo = _generate(template, sheets, cache, params)
+        assert 'page-height="{}"'.format(height).encode() in xslfo
+    # the layout is cached only by the declared params of the template
+    # that defines it, the declarations always are.
+    assert cache.stats()['hits'] == 2 + cached
+
+
+def test_custom_skeleton_changes(tmp_path, sheets):
+    skel_dir = tmp_path / 'skeletons'
+    skel_dir.mkdir()
+    skeleton = skel_dir / 'mine.fo.mako'
+    layout = """<%inherit file="base.fo.mako"/><%! LAYOUT_PARAMS = () %>\\
+<%block name="_page_layout"><simple-page-master master-name="{}">\\
+<region-body/></simple-page-master></%block>${{next.body()}}"""
+    skeleton.write_text(layout.format('first'))
+    (tmp_path / 'page.fo.mako').write_text(
+        '<%inherit file="mine.fo.mako"/><block>${name}</block>'
+    )
+    template = pypfop.templates.mako.Factory(
+        str(tmp_path), skel_dirs=str(skel_dir)
+    )('page.fo.mako')
+    cache = fragments.FragmentCache()
+    params = dict(SKELETON_PARAMS, name='doc', TITLE=None, AUTHOR=None,
+                  REGION_BODY_MARGIN=None)
+    _generate(template, sheets, cache, params)
+    stat = os.stat(str(skeleton))
+    skeleton.write_text(layout.format('second'))
+    os.utime(str(skeleton), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    xml, xslfo = _generate(template, sheets, cache, params)
+    assert b'master-name="second"' in xslfo
+    assert b'<?pypfop-fragment ' not in xml
+
+
+def test_generator_without_fragment_cache(template):
+    assert DocumentGenerator(template, builder=builder.Builder()) \
+        .fragment_cache is None
@@ -0,0 +1,175 @@
+import os
+import sys
+import time
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import pytest
+
+from pypfop import helpers
+from pypfop.builder import Builder
+
+
+def test_freeze():
+    assert helpers.freeze(['a', ['b'], {'c': [1], 'd': {2}}]) == \
+        helpers.freeze(['a', ('b', ), {'d': frozenset([2]), 'c': (1, )}])
+    assert helpers.freeze({'a': 1}) != helpers.freeze([('a', 1)])
+    with pytest.raises(TypeError):
+        helpers.freeze([bytearray()])
+
+
+@pytest.fixture
+def template_dir(tmp_path):
+    (tmp_path / 'doc.fo.mako').write_text('<root>${name}</root>')
+    (tmp_path / 'doc.css').write_text('root { color: red; }')
+    return tmp_path
+
+
+def test_get_document_generator_with_lists(template_dir):
+    helpers.get_document_generator.clear()
+    kwargs = {'lookup_dirs': [str(template_dir)], 'use_skels': False,
+              'style_dir': str(template_dir), 'builder': Builder()}
+    generator = helpers.get_document_generator(
+        'doc.fo.mako', ['doc.css'], **kwargs
+    )
+    assert helpers.get_document_generator(
+        'doc.fo.mako', ['doc.css'], **kwargs
+    ) is generator
+    assert generator.ssheets == [str(template_dir / 'doc.css')]
+    stats = helpers.get_document_generator.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+    assert helpers.get_document_generator.invalidate(
+        'doc.fo.mako', ['doc.css'], **kwargs
+    )
+    assert helpers.get_document_generator(
+        'doc.fo.mako', ['doc.css'], **kwargs
+    ) is not generator
+
+
+def test_factory_cache_bounds():
+    cache = helpers.FactoryCache(lambda *args: object(), maxsize=2, ttl=10)
+    first = cache(1)
+    cache(2)
+    assert cache(1) is first
+    cache(3)  # evicts 2, the least recently used.
+    assert cache.stats()['evictions'] == 1
+    assert cache(1) is first
+    now = time.monotonic()
+    with patch.object(helpers.time, 'monotonic', return_value=now + 11):
+        assert cache(1) is not first
+    assert cache.stats()['entries'] == 2
+    assert cache([1]) is cache([1])
+    cache(bytearray())
+    assert cache.stats()['uncached'] == 1
+
+
+def test_factory_cache_configure():
+    cache = helpers.FactoryCache(lambda *args: object())
+    assert cache.maxsize == helpers.CACHE_SIZE
+    for num in range(4):
+        cache(num)
+    cache.configure(maxsize=2, ttl=5)
+    stats = cache.stats()
+    assert (stats['entries'], stats['evictions']) == (2, 2)
+    assert (stats['maxsize'], stats['ttl']) == (2, 5)
+    cache.configure(ttl=10)
+    assert (cache.maxsize, cache.ttl) == (2, 10)
+    cache.configure(maxsize=None, ttl=None)
+    assert (cache.maxsize, cache.ttl) == (None, None)
+    for num in range(4):
+        cache(num)
+    assert cache.stats()['entries'] == 4
+
+
+@pytest.mark.parametrize('value, size, warned', [
+    ('7', 7, False), ('abc', 128, True), ('-1', 128, True),
+])
+def test_cache_size_from_environment(value, size, warned):
+    code = ('from pypfop import helpers; '
+            'print(helpers.get_document_generator.maxsize)')
+    env = dict(os.environ, **{helpers.CACHE_SIZE_ENV_VAR: value})
+    process = subprocess.run([sys.executable, '-c', code], env=env,
+                             capture_output=True, check=True)
+    assert process.stdout.strip() == str(size).encode()
+    assert (b'Invalid PYPFOP_CACHE_SIZE' in process.stderr) is warned
+
+
+def test_factory_cache_concurrent_calls():
+    calls = []
+    barrier = threading.Barrier(8)
+
+    def build(key):
+        calls.append(key)
+        time.sleep(0.05)
+        return object()
+
+    cache = helpers.FactoryCache(build)
+    results = []
+
+    def call():
+        barrier.wait()
+        results.append(cache('key'))
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == ['key']
+    assert len(set(map(id, results))) == 1
+
+
+def test_factory_cache_errors_are_not_cached():
+    results = iter([ValueError('first'), 'second'])
+
+    def build():
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    cache = helpers.FactoryCache(build)
+    with pytest.raises(ValueError):
+        cache()
+    assert cache() == 'second'
+
+
+class EchoBuilder(Builder):
+
+    def __call__(self, xslfo, out_format, log, output=None):
+        return xslfo
+
+
+def test_document_decorator_shared(template_dir):
+    (template_dir / 'other.fo.mako').write_text('<other>${name}</other>')
+    echo = EchoBuilder()
+    document = helpers.make_document_decorator(
+        str(template_dir), False, builder=echo
+    )
+    assert helpers.make_document_decorator(
+        str(template_dir), False, builder=echo
+    ) is document
+
+    @document(template='doc.fo.mako')
+    def doc(name):
+        return {'name': name}
+
+    @document(template='other.fo.mako')
+    def other(name):
+        return {'name': name}
+
+    assert (doc.__name__, other.__name__) == ('doc', 'other')
+    assert doc.generator is not other.generator
+    names = [str(num) for num in range(50)]
+    with ThreadPoolExecutor(8) as executor:
+        docs = executor.map(doc, names)
+        others = executor.map(other, names)
+        for name, doc_result, other_result in zip(names, docs, others):
+            assert doc_result.endswith(
+                '>{}</fo:root>'.format(name).encode()
+            )
+            assert other_result.endswith(
+                '>{}</fo:other>'.format(name).encode()
+            )
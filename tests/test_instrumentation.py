@@ -0,0 +1,119 @@
+import os
+import sys
+
+import pytest
+
+from pypfop import builder
+from pypfop.cache import MemoryResultCache
+from pypfop.document_generator import DocumentGenerator
+from pypfop.exceptions import BuilderError
+from pypfop.instrumentation import (
+    instrumentation, Instrumentation, PrometheusExporter
+)
+
+
+FAKE_FOP_CMD = os.path.join(os.path.dirname(__file__), 'fake_fop.py')
+
+
+class Template:
+
+    def render(self, params):
+        return '<root><block class="name">{}</block></root>'.format(
+            params['name']
+        )
+
+
+@pytest.fixture
+def spans():
+    spans = []
+    instrumentation.add_hook(spans.append)
+    yield spans
+    instrumentation.remove_hook(spans.append)
+
+
+@pytest.fixture
+def generator(tmp_path):
+    (tmp_path / 'doc.css').write_text('.name { color: red; }')
+    return DocumentGenerator(
+        Template(), 'doc.css', style_dir=str(tmp_path),
+        builder=builder.SubprocessBuilder(sys.executable, [FAKE_FOP_CMD])
+    )
+
+
+def test_no_spans_without_hooks():
+    registry = Instrumentation()
+    assert not registry.enabled
+    with registry.span('render') as span:
+        span.set(bytes_out=1)
+    assert registry.span('render') is registry.span('fo')
+
+
+def test_generate_spans(generator, spans):
+    document = generator.generate({'name': 'x'}, output='bytes')
+    assert [span.name for span in spans] == [
+        'render', 'css', 'fo', 'build', 'generate'
+    ]
+    render, css, fo, build, generate = spans
+    assert render.attributes['bytes_out'] == len(Template().render(
+        {'name': 'x'}
+    ))
+    assert css.attributes['rules'] == 1
+    assert build.attributes == {
+        'builder': 'SubprocessBuilder', 'format': 'pdf',
+        'bytes_in': fo.attributes['bytes_out'],
+        'bytes_out': len(document), 'exit_status': 0
+    }
+    assert all(span.parent is generate for span in spans[:-1])
+    assert generate.parent is None
+    assert all(span.duration >= 0 for span in spans)
+
+
+def test_build_error_span(generator, spans):
+    with pytest.raises(BuilderError):
+        generator.generate({'name': 'ERROR'}, output='bytes')
+    build = spans[-2]
+    assert build.attributes['exit_status'] == 1
+    assert isinstance(build.error, BuilderError)
+
+
+def test_result_cache_span(generator, spans):
+    generator.result_cache = MemoryResultCache()
+    generator.generate({'name': 'x'})
+    generator.generate({'name': 'x'})
+    assert [span.attributes['cache_hit'] for span in spans
+            if span.name == 'result_cache'] == [False, True]
+
+
+def test_broken_hook_is_ignored(generator):
+    def broken(span):
+        raise ValueError('broken hook')
+
+    instrumentation.add_hook(broken)
+    try:
+        assert generator.generate({'name': 'x'}, output='bytes')
+    finally:
+        instrumentation.remove_hook(broken)
+    assert not instrumentation.enabled
+
+
+def test_prometheus_exporter(generator):
+    exporter = PrometheusExporter(buckets=[60])
+    instrumentation.add_hook(exporter)
+    try:
+        generator.generate({'name': 'x'}, output='bytes')
+        with pytest.raises(BuilderError):
+            generator.generate({'name': 'ERROR'}, output='bytes')
+    finally:
+        instrumentation.remove_hook(exporter)
+    metrics = exporter.render().splitlines()
+    assert '# TYPE pypfop_stage_duration_seconds histogram' in metrics
+    assert 'pypfop_stage_duration_seconds_bucket{le="60",stage="build"} 2' \
+        in metrics
+    assert 'pypfop_stage_duration_seconds_count{stage="render"} 2' \
+        in metrics
+    assert 'pypfop_stage_errors_total{stage="build"} 1' in metrics
+    assert 'pypfop_stage_rules{stage="css"} 1' in metrics
+    assert 'pypfop_fop_exit_total{builder="SubprocessBuilder",status="0"} 1' \
+        in metrics
+    assert 'pypfop_fop_exit_total{builder="SubprocessBuilder",status="1"} 1' \
+        in metrics
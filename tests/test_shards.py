@@ -0,0 +1,225 @@
+import os
+import re
+import sys
+
+import pytest
+
+import pypfop.templates.mako
+from pypfop import builder, pdf, shards
+from pypfop.document_generator import DocumentGenerator
+from pypfop.exceptions import BuilderError, DocumentGeneratorError
+
+
+FAKE_FOP_PDF_CMD = os.path.join(os.path.dirname(__file__), 'fake_fop_pdf.py')
+
+TEMPLATE = r'''\
+<root><layout-master-set><simple-page-master master-name="page">\
+<region-body/></simple-page-master></layout-master-set>\
+<page-sequence master-reference="page"${start}>\
+% if numbered:
+<static-content flow-name="xsl-region-after"><block><page-number/></block>\
+</static-content>\
+% endif
+<flow flow-name="xsl-region-body">\
+% if SHARD_INDEX == 0 and title:
+<block>${title}</block>\
+% endif
+<table><table-header><table-row><table-cell><block>Name</block></table-cell>\
+</table-row></table-header><table-body>\
+% for row in rows:
+<table-row><table-cell><block>${row}</block></table-cell></table-row>\
+% endfor
+</table-body></table></flow></page-sequence></root>'''
+
+
+class RecordingBuilder(builder.SubprocessBuilder):
+    """Keep the initial page number of each built shard."""
+
+    def __init__(self):
+        super().__init__(sys.executable, [FAKE_FOP_PDF_CMD])
+        self.starts = []
+
+    def __call__(self, xslfo, out_format, log, output=None):
+        self.starts.append(shards.initial_page_number(xslfo))
+        return super().__call__(xslfo, out_format, log, output)
+
+
+@pytest.fixture
+def generator(tmp_path):
+    (tmp_path / 'table.fo.mako').write_text(TEMPLATE)
+    factory = pypfop.templates.mako.Factory(str(tmp_path), use_skels=False)
+    return DocumentGenerator(
+        factory('table.fo.mako'), builder=RecordingBuilder()
+    )
+
+
+def _page_texts(document):
+    """Return the text of each page of the `document` built by the fake
+    fop, following the page tree.
+    """
+    document = pdf.read_pdf(document)
+
+    def reference(number, name):
+        return int(re.search(rb'/' + name + rb' (\d+) 0 R',
+                             document.objects[number]).group(1))
+
+    def walk(number):
+        kids = re.search(rb'/Kids \[([^\]]*)\]', document.objects[number])
+        if kids is None:
+            content = document.objects[reference(number, b'Contents')]
+            yield re.search(rb'\((.*)\) Tj', content).group(1).decode()
+            return
+        for kid in re.findall(rb'(\d+) 0 R', kids.group(1)):
+            yield from walk(int(kid))
+    return list(walk(reference(document.root, b'Pages')))
+
+
+@pytest.mark.parametrize('numbered, start, title, builds', [
+    # the shards guess that they start after the 5 pages of the first.
+    (True, '', '', [None, 6, 11, 16, 21]),
+    (True, ' initial-page-number="7"', '', [7, 12, 17, 22, 27]),
+    # the title page of the first shard makes the guesses of the shards
+    # after the second one wrong, they are built again.
+    (True, '', 'Report', [None, 7, 13, 19, 25, 12, 17, 22]),
+    (False, '', 'Report', [None, None, None, None, None]),
+])
+def test_generate_sharded(generator, numbered, start, title, builds):
+    params = {'rows': ['row {}'.format(num) for num in range(22)],
+              'numbered': numbered, 'start': start, 'title': title}
+    whole = generator.generate(dict(params, SHARD_INDEX=0), output='bytes')
+    generator.builder.starts = []
+    sharded = generator.generate_sharded(
+        params, shards.split_list('rows', 5), output='bytes'
+    )
+    pages = 23 if title else 22
+    assert pdf.page_count(sharded) == pages
+    assert _page_texts(sharded) == _page_texts(whole)
+    # the table header is on each page.
+    assert _page_texts(sharded)[pages - 1].endswith('Name | row 21')
+    first_page = 7 if start else 1
+    assert b'/PageLabels << /Nums [0 << /S /D /St %d >>] >>' % first_page \
+        in sharded
+    # the first builds run in parallel, the rebuilds of the wrong guesses
+    # after them.
+    assert sorted(generator.builder.starts[:5], key=str) == \
+        sorted(builds[:5], key=str)
+    assert generator.builder.starts[5:] == builds[5:]
+    # the document is always the same.
+    assert generator.generate_sharded(
+        params, shards.split_list('rows', 5), output='bytes'
+    ) == sharded
+
+
+def test_generate_sharded_errors(generator):
+    params = {'rows': [], 'numbered': False, 'start': ''}
+    with pytest.raises(DocumentGeneratorError):
+        generator.generate_sharded(params, shards.split_list('rows', 5),
+                                   out_format='png')
+    with pytest.raises(DocumentGeneratorError):
+        generator.generate_sharded(params, lambda params: [])
+    with pytest.raises(DocumentGeneratorError):
+        shards.split_list('rows', 0)
+
+
+def test_split_list():
+    splitter = shards.split_list('rows', 2)
+    assert list(splitter({'rows': (1, 2, 3), 'title': 't'})) == [
+        {'rows': [1, 2], 'title': 't'}, {'rows': [3], 'title': 't'}
+    ]
+    assert list(splitter({'rows': []})) == [{'rows': []}]
+
+
+def test_set_initial_page_number():
+    xslfo = (b'<fo:root><fo:page-sequence master-reference="a">'
+             b'</fo:page-sequence><fo:page-sequence/></fo:root>')
+    assert shards.initial_page_number(xslfo) is None
+    numbered = shards.set_initial_page_number(xslfo, 3)
+    assert numbered.startswith(
+        b'<fo:root><fo:page-sequence master-reference="a" '
+        b'initial-page-number="3">'
+    )
+    assert shards.initial_page_number(numbered) == 3
+    assert shards.initial_page_number(
+        shards.set_initial_page_number(numbered, 12)
+    ) == 12
+    with pytest.raises(DocumentGeneratorError):
+        shards.set_initial_page_number(b'<fo:root/>', 1)
+    assert shards.set_initial_page_number(b'<fo:page-sequence/>', 2) == \
+        b'<fo:page-sequence initial-page-number="2"/>'
+
+
+def test_initial_page_number_after_sequence_master():
+    xslfo = (b'<fo:root><fo:layout-master-set>'
+             b'<fo:page-sequence-master master-name="pages" '
+             b'initial-page-number="9"><fo:repeatable-page-master-'
+             b'alternatives><fo:conditional-page-master-reference '
+             b'master-reference="odd" odd-or-even="odd"/>'
+             b'<fo:conditional-page-master-reference master-reference="even" '
+             b'odd-or-even="even"/></fo:repeatable-page-master-alternatives>'
+             b'</fo:page-sequence-master></fo:layout-master-set>'
+             b'<fo:page-sequence-wrapper><fo:page-sequence '
+             b'master-reference="pages"></fo:page-sequence>'
+             b'</fo:page-sequence-wrapper></fo:root>')
+    assert shards.initial_page_number(xslfo) is None
+    numbered = shards.set_initial_page_number(xslfo, 4)
+    assert shards.initial_page_number(numbered) == 4
+    assert b'<fo:page-sequence master-reference="pages" ' \
+        b'initial-page-number="4">' in numbered
+    assert numbered.count(b'initial-page-number="9"') == 1
+
+
+def test_pdf_incremental_update(generator):
+    document = generator.generate(
+        {'rows': ['a', 'b'], 'numbered': False, 'start': '',
+         'SHARD_INDEX': 1}, output='bytes'
+    )
+    startxref = int(re.search(rb'startxref\n(\d+)', document).group(1))
+    content = b'BT (updated) Tj ET'
+    update = b'3 0 obj\n<< /Length %d >>\nstream\n%s\nendstream\nendobj\n' \
+        % (len(content), content)
+    offset = len(document)
+    xref = offset + len(update)
+    updated = document + update + (
+        b'xref\n3 1\n%010d 00000 n \ntrailer\n<< /Size 12 /Root 10 0 R '
+        b'/Prev %d >>\nstartxref\n%d\n%%%%EOF\n' % (offset, startxref, xref)
+    )
+    assert _page_texts(updated) == ['updated', 'Name | b']
+    merged = pdf.concatenate([updated, document])
+    assert _page_texts(merged) == ['updated', 'Name | b', 'Name | a',
+                                   'Name | b']
+
+
+def test_pdf_concatenate_objects():
+    title = rb'(see 3 0 R \) and (nested 2 0 R))'
+    document = pdf._write_pdf(4, [
+        b'<< /Type /Catalog /Pages 3 0 R /Lang (en) >>',
+        b'<< /Title %s /Producer (fop) >>' % title,
+        b'<< /Type /Pages /Kids [4 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 3 0 R /Contents 5 0 R >>',
+        b'<< /Length 12 >>\nstream\n(Keep 4 0 R)\nendstream',
+    ], b'/Size 6 /Root 1 0 R /Info 2 0 R')
+    merged = pdf.read_pdf(pdf.concatenate([document, document]))
+    # the objects of the documents without their catalogs, the page tree
+    # and the new catalog.
+    assert len(merged.objects) == 10
+    assert merged.root == 10
+    assert [content for content in merged.objects.values()
+            if b'/Catalog' in content] == [
+        b'<< /Type /Catalog /Pages 9 0 R /Lang (en) >>'
+    ]
+    assert merged.objects[merged.info] == \
+        b'<< /Title %s /Producer (fop) >>' % title
+    assert merged.objects[7] == \
+        b'<< /Type /Page /Parent 6 0 R /Contents 8 0 R >>'
+    assert merged.objects[8].endswith(b'stream\n(Keep 4 0 R)\nendstream')
+    assert pdf.page_count(merged) == 2
+
+
+@pytest.mark.parametrize('document', [
+    b'not a pdf',
+    b'%PDF-1.5\n1 0 obj\n<< /Type /XRef >>\nstream\n\nendstream\nendobj\n'
+    b'startxref\n9\n%%EOF\n',
+])
+def test_pdf_unsupported(document):
+    with pytest.raises(BuilderError):
+        pdf.page_count(document)
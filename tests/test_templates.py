@@ -0,0 +1,254 @@
+import inspect
+import pickle
+from unittest.mock import patch
+
+import mako.template
+import pytest
+from lxml.builder import E
+
+import pypfop.templates
+import pypfop.templates.mako
+import pypfop.templates.native
+from pypfop import cli, conversion, fragments
+from pypfop.document_generator import DocumentGenerator
+from pypfop.exceptions import DocumentGeneratorError, TemplateError
+from tests.test_document_generator import EchoBuilder
+
+
+@pytest.fixture
+def lookup_dir(tmp_path):
+    templates = tmp_path / 'templates'
+    (templates / 'parts').mkdir(parents=True)
+    (templates / '.hidden').mkdir()
+    (templates / 'doc.fo.mako').write_text(
+        '<%inherit file="parts/base.fo.mako" /><block>${name}</block>'
+    )
+    (templates / 'parts' / 'base.fo.mako').write_text(
+        '<root>${next.body()}</root>'
+    )
+    (templates / '.hidden' / 'skip.fo.mako').write_text('${')
+    (templates / 'notes.txt').write_text('not a template')
+    return str(templates)
+
+
+def test_find_templates(lookup_dir):
+    assert list(pypfop.templates.mako.find_templates([lookup_dir])) == [
+        '/doc.fo.mako', '/parts/base.fo.mako'
+    ]
+
+
+def test_factory_module_directory(lookup_dir, tmp_path):
+    module_dir = tmp_path / 'modules'
+    factory = pypfop.templates.mako.Factory(
+        lookup_dir, use_skels=False, module_directory=str(module_dir)
+    )
+    assert factory.precompile() == ['/doc.fo.mako', '/parts/base.fo.mako']
+    assert (module_dir / 'doc.fo.mako.py').exists()
+    assert (module_dir / 'parts' / 'base.fo.mako.py').exists()
+    with patch.object(
+            mako.template, '_compile_module_file',
+            wraps=mako.template._compile_module_file
+    ) as compile_module:
+        factory = pypfop.templates.mako.Factory(
+            lookup_dir, use_skels=False, module_directory=str(module_dir)
+        )
+        assert factory('doc.fo.mako').render({'name': 'x'}) == \
+            b'<root><block>x</block></root>'
+    assert not compile_module.called
+    template = pickle.loads(pickle.dumps(factory('doc.fo.mako')))
+    assert template.lookup.template_args['module_directory'] == \
+        str(module_dir)
+
+
+def test_factory_preload(lookup_dir):
+    factory = pypfop.templates.mako.Factory(
+        lookup_dir, use_skels=True, preload=True
+    )
+    with patch.object(mako.template.Template, '__init__') as template_init:
+        factory('doc.fo.mako').render({'name': 'x'})
+        factory.lookup.get_template('/letter-portrait.fo.mako')
+    assert not template_init.called
+
+
+def test_factory_preload_invalid_template(lookup_dir, tmp_path):
+    (tmp_path / 'templates' / 'broken.fo.mako').write_text('${')
+    with pytest.raises(TemplateError):
+        pypfop.templates.mako.Factory(
+            lookup_dir, use_skels=False, preload=True
+        )
+
+
+def test_cli_precompile(lookup_dir, tmp_path, capsys):
+    module_dir = tmp_path / 'modules'
+    assert cli.main([
+        'precompile', '-l', lookup_dir, '-m', str(module_dir), '--no-skels'
+    ]) == 0
+    assert capsys.readouterr().out.split() == [
+        '/doc.fo.mako', '/parts/base.fo.mako'
+    ]
+    assert (module_dir / 'doc.fo.mako.py').exists()
+
+
+CUSTOM_SKELETON = '''\
+<%inherit file="base.fo.mako" />
+<%!
+   MASTER_NAME = 'custom'
+   LAYOUT_PARAMS = ('WIDTH', )
+%>
+<%block name="_page_layout">
+    <simple-page-master master-name="custom" page-width="${WIDTH}"/>
+</%block>
+${next.body()}'''
+
+
+def test_factory_custom_skeletons(lookup_dir, tmp_path):
+    skel_dir = tmp_path / 'skeletons'
+    skel_dir.mkdir()
+    (skel_dir / 'custom.fo.mako').write_text(CUSTOM_SKELETON)
+    (tmp_path / 'templates' / 'page.fo.mako').write_text(
+        '<%inherit file="custom.fo.mako" />'
+    )
+    factory = pypfop.templates.mako.Factory(
+        lookup_dir, skel_dirs=str(skel_dir)
+    )
+    assert factory.skel_dirs == [str(skel_dir), factory.skel_dir]
+    assert factory.lookup.directories[-2:] == factory.skel_dirs
+    template = factory('page.fo.mako')
+    cache = fragments.FragmentCache()
+    for width in ('1in', '2in', '1in'):
+        scope = cache.scope(template, [])
+        with scope:
+            xml = template.render({'WIDTH': width})
+        xslfo = conversion.xml_to_fo_with_style(xml, [], fragments=scope)
+    assert b'<?pypfop-fragment skeleton:layout-master-set' in xml
+    assert b'master-name="custom" page-width="1in"' in xslfo
+    # the declarations on the second and third, the layout on the third.
+    assert cache.stats()['hits'] == 3
+
+
+def test_cli_precompile_custom_skeletons(tmp_path, capsys):
+    skel_dir = tmp_path / 'skeletons'
+    skel_dir.mkdir()
+    (skel_dir / 'custom.fo.mako').write_text(CUSTOM_SKELETON)
+    assert cli.main([
+        'precompile', '-l', str(tmp_path / 'empty'), '-s', str(skel_dir),
+        '-m', str(tmp_path / 'modules')
+    ]) == 0
+    uris = capsys.readouterr().out.split()
+    assert uris[0] == '/custom.fo.mako'
+    assert '/base.fo.mako' in uris
+
+
+def test_engine_registry():
+    assert pypfop.templates.get_engine('mako') is \
+        pypfop.templates.mako.Factory
+    assert pypfop.templates.get_engine('native') is \
+        pypfop.templates.native.Factory
+    with pytest.raises(TemplateError):
+        pypfop.templates.get_engine('jinja2')
+
+    class Factory(pypfop.templates.Factory):
+        name = 'jinja2'
+
+    try:
+        assert pypfop.templates.register_engine(Factory) is Factory
+        assert pypfop.templates.get_engine('jinja2') is Factory
+        assert pypfop.templates.engine_names() == [
+            'jinja2', 'mako', 'native'
+        ]
+    finally:
+        del pypfop.templates._engines['jinja2']
+    with pytest.raises(TemplateError):
+        pypfop.templates.register_engine(pypfop.templates.Factory)
+
+
+class OneArgument:
+
+    def render(self, params):
+        return '<root/>'
+
+
+class TwoArguments:
+
+    def render(self, params, out_format):
+        return '<root/>'
+
+
+def test_check_template_once_per_type():
+    with patch.object(inspect, 'getfullargspec',
+                      wraps=inspect.getfullargspec) as getfullargspec:
+        for _ in range(3):
+            assert pypfop.templates.check_template(OneArgument()) == \
+                pypfop.templates.TEXT_OUTPUT
+        assert getfullargspec.call_count == 1
+    with pytest.raises(TemplateError):
+        pypfop.templates.check_template(TwoArguments())
+    with pytest.raises(DocumentGeneratorError):
+        DocumentGenerator(TwoArguments(), builder=EchoBuilder())
+    # the render attributes of the instances are checked each time.
+    template = OneArgument()
+    template.render = TwoArguments().render
+    with pytest.raises(TemplateError):
+        pypfop.templates.check_template(template)
+    template.render = lambda params: '<root/>'
+    assert pypfop.templates.check_template(template) == \
+        pypfop.templates.TEXT_OUTPUT
+
+
+def receipt(params):
+    return E.root(
+        E.block('Receipt', {'class': 'title'}),
+        *[E.block(item) for item in params['items']]
+    )
+
+
+RECEIPT = r'''<root><block class="title">Receipt</block>\
+% for item in items:
+<block>${item | x}</block>\
+% endfor
+</root>'''
+
+
+def test_native_template(tmp_path):
+    (tmp_path / 'receipt.fo.mako').write_text(RECEIPT)
+    (tmp_path / 'receipt.css').write_text('.title { font-weight: bold; }')
+    factory = pypfop.templates.mako.Factory(str(tmp_path), use_skels=False)
+    params = {'items': ['a', 'b & c']}
+    text = DocumentGenerator(
+        factory('receipt.fo.mako'), 'receipt.css', style_dir=str(tmp_path),
+        builder=EchoBuilder()
+    )
+    template = pypfop.templates.native.Factory()(
+        'tests.test_templates:receipt'
+    )
+    assert template.function is receipt
+    assert template.output == pypfop.templates.TREE_OUTPUT
+    tree = DocumentGenerator(template, 'receipt.css',
+                             style_dir=str(tmp_path), builder=EchoBuilder())
+    xslfo = text.generate(params)
+    assert b'font-weight="bold"' in xslfo
+    with patch.object(conversion.lxml.etree, 'fromstring') as fromstring:
+        assert tree.generate(params) == xslfo
+        assert tree.generate(params, streaming=True) == xslfo
+    assert not fromstring.called
+    template = pickle.loads(pickle.dumps(template))
+    assert template.function is receipt
+    assert template.fingerprint().startswith(
+        'tests.test_templates:receipt:' + __file__
+    )
+
+
+def test_native_template_errors():
+    factory = pypfop.templates.native.Factory()
+    with pytest.raises(TemplateError):
+        factory('tests.test_templates')
+    with pytest.raises(TemplateError):
+        factory('tests.test_templates:missing')
+    with pytest.raises(TemplateError):
+        factory('missing.module:receipt')
+    with pytest.raises(TemplateError):
+        factory(42)
+    with pytest.raises(TemplateError):
+        factory(lambda params: '<root/>').render({})
+    with pytest.raises(TemplateError):
+        factory(receipt).render({})
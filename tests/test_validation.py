@@ -0,0 +1,134 @@
+import pickle
+from unittest.mock import Mock
+
+import pytest
+
+import pypfop.templates.mako
+from pypfop import validation
+from pypfop.document_generator import DocumentGenerator
+from pypfop.exceptions import DocumentGeneratorError
+from pypfop.validation import FOSchema, fo_schema
+
+from tests.test_document_generator import EchoBuilder
+from tests.test_fragments import SKELETON_PARAMS
+
+
+def _fo(body):
+    return (
+        '<?xml version="1.1" encoding="utf-8"?>\n'
+        '<fo:root xmlns:fo="http://www.w3.org/1999/XSL/Format">'
+        '<fo:layout-master-set><fo:simple-page-master master-name="page">'
+        '<fo:region-body/></fo:simple-page-master></fo:layout-master-set>'
+        '<fo:page-sequence master-reference="page">'
+        '<fo:flow flow-name="xsl-region-body">{}</fo:flow>'
+        '</fo:page-sequence></fo:root>'.format(body)
+    ).encode('utf-8')
+
+
+def test_valid_document():
+    xslfo = _fo(
+        '<fo:block>text <fo:inline>x</fo:inline><fo:block/></fo:block>'
+        '<fo:table><fo:table-body><fo:table-row><fo:table-cell><fo:block/>'
+        '</fo:table-cell></fo:table-row></fo:table-body></fo:table>'
+        '<fo:block><fo:instream-foreign-object><svg:svg '
+        'xmlns:svg="http://www.w3.org/2000/svg"><svg:g/></svg:svg>'
+        '</fo:instream-foreign-object></fo:block>'
+    )
+    assert list(fo_schema.iter_errors(xslfo)) == []
+    fo_schema.validate(xslfo)
+
+
+def test_invalid_document():
+    xslfo = _fo(
+        '<fo:inline>x</fo:inline>'
+        '<fo:block><fo:table-row/><fo:external-graphic/></fo:block>'
+        '<fo:blok/>'
+    )
+    flow = '/fo:root/fo:page-sequence/fo:flow'
+    assert list(fo_schema.iter_errors(xslfo)) == [
+        (flow + '/fo:inline', 'fo:inline is not allowed in fo:flow'),
+        (flow + '/fo:block/fo:table-row',
+         'fo:table-row is not allowed in fo:block'),
+        (flow + '/fo:block/fo:external-graphic',
+         'missing the src attribute'),
+        (flow + '/fo:blok', 'unknown element fo:blok'),
+    ]
+    with pytest.raises(DocumentGeneratorError) as error:
+        fo_schema.validate(xslfo, max_errors=2)
+    assert str(error.value).splitlines()[1:] == [
+        '  {}/fo:inline: fo:inline is not allowed in fo:flow'.format(flow),
+        '  {}/fo:block/fo:table-row: fo:table-row is not allowed in '
+        'fo:block'.format(flow),
+        '  ...'
+    ]
+
+
+@pytest.mark.parametrize('xslfo, message', [
+    (b'<fo:root><fo:block>', 'not well-formed'),
+    (b'<block/>', 'the root element must be fo:root'),
+])
+def test_malformed_document(xslfo, message):
+    [(path, error)] = fo_schema.iter_errors(xslfo)
+    assert path == '/'
+    assert error.startswith(message)
+
+
+def test_schema_from_text():
+    schema = FOSchema.from_text(
+        '# comment\n'
+        '@content = block\n'
+        '         wrapper  # continued\n'
+        'root: @content\n'
+        'block [id]: @content\n'
+        'wrapper: *\n'
+    )
+    assert schema.rules[validation._clark('block')] == (
+        frozenset(map(validation._clark, ('block', 'wrapper'))), ('id', )
+    )
+    assert schema.rules[validation._clark('wrapper')] == (None, ())
+    assert pickle.loads(pickle.dumps(schema)).rules == schema.rules
+    assert pickle.loads(pickle.dumps(fo_schema)) is fo_schema
+    assert FOSchema.load(validation.SCHEMA_PATH) is fo_schema
+
+
+@pytest.mark.parametrize('text', [
+    'root: @missing',
+    'root: block',
+    '@group: block',
+    'root = block',
+    '  root:',
+])
+def test_invalid_schema(text):
+    with pytest.raises(DocumentGeneratorError):
+        FOSchema.from_text(text)
+
+
+@pytest.mark.parametrize('skeleton', [
+    'A4-landscape', 'A4-portrait', 'letter-landscape', 'letter-portrait'
+])
+def test_skeletons_are_valid(tmp_path, skeleton):
+    (tmp_path / 'page.fo.mako').write_text(
+        '<%inherit file="{}.fo.mako"/><block>${{name}}</block>'
+        .format(skeleton)
+    )
+    template = pypfop.templates.mako.Factory(str(tmp_path))('page.fo.mako')
+    generator = DocumentGenerator(template, builder=EchoBuilder(),
+                                  fo_schema=fo_schema, fragment_cache=None)
+    params = dict(SKELETON_PARAMS, name='x', TITLE='t', AUTHOR='a',
+                  REGION_BODY_MARGIN='1cm')
+    assert b'fo:simple-page-master' in generator.generate(params)
+
+
+def test_generator_fails_before_the_builder():
+    template = Mock()
+    template.render = lambda params: '<root><table-row/></root>'
+    doc_builder = Mock(side_effect=AssertionError('the builder was called'))
+    generator = DocumentGenerator(template, builder=doc_builder,
+                                  fo_schema=fo_schema)
+    with pytest.raises(DocumentGeneratorError) as error:
+        generator.generate({})
+    assert '/fo:root/fo:table-row: fo:table-row is not allowed in ' \
+        'fo:root' in str(error.value)
+    generator.fo_schema = None
+    with pytest.raises(AssertionError):
+        generator.generate({})